@@ -0,0 +1,190 @@
+"""analysis.py
+A persistent cache of what was measured in each sample.
+
+Measuring a sample means reading all of its audio, which is slow off a card
+and was thrown away after every command.  The results are kept in a SQLite
+database in the local cache dir instead, so asking again is free as long as
+the sample hasn't changed.
+
+Entries are keyed by the sample's path and a fingerprint: its size, mtime and
+a hash of its first block, which holds the header.  The hash catches
+rewrites that keep the size within the card's coarse (2 second) mtimes.
+"""
+import collections
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+
+import bbeditor.stats as stats
+from bbeditor.cachedir import cache_dir
+
+FINGERPRINT_BYTES = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+  path TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  digest TEXT NOT NULL,
+  peak REAL NOT NULL,
+  rms REAL NOT NULL,
+  frames INTEGER NOT NULL,
+  rate INTEGER NOT NULL,
+  channels INTEGER NOT NULL,
+  width INTEGER NOT NULL,
+  is_float INTEGER NOT NULL,
+  zero_start INTEGER,
+  zero_end INTEGER,
+  PRIMARY KEY (path)
+);
+CREATE TABLE IF NOT EXISTS loudness (
+  path TEXT NOT NULL,
+  k_weighted INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  digest TEXT NOT NULL,
+  loudness REAL,
+  peak REAL NOT NULL,
+  PRIMARY KEY (path, k_weighted)
+);
+"""
+
+
+class Analysis(collections.namedtuple('Analysis', [
+    'peak', 'rms', 'frames', 'rate', 'channels', 'width', 'is_float',
+    'zero_start', 'zero_end'])):
+  """What a full pass over a sample found.
+
+  peak and rms are fractions of full scale.  width is in bytes.  zero_start
+  and zero_end are where a trim to zero crossings would cut, see
+  effects.Effector.trim_to_zero_crossings, both None if it can't.
+  """
+  __slots__ = ()
+
+  def duration(self):
+    """Length in seconds."""
+    return self.frames / float(self.rate) if self.rate else 0.0
+
+
+def fingerprint(path):
+  """Returns (size, mtime_ns, digest) of a file.
+
+  Raises:
+    OSError
+  """
+  st = os.stat(path)
+  with open(path, 'rb') as f:
+    head = f.read(FINGERPRINT_BYTES)
+  stats.incr('bytes.read', len(head))
+  return (st.st_size, st.st_mtime_ns, hashlib.sha1(head).hexdigest())
+
+
+class AnalysisCache(object):
+  """Sample measurements, by path and fingerprint.
+
+  Safe to share between threads.  The database is only opened on first use.
+
+  Arguments:
+    path: the SQLite database file, defaults to one in the local cache dir
+  """
+
+  def __init__(self, path=None):
+    self._path = path or cache_dir('analysis.sqlite')
+    self._conn = None
+    self._lock = threading.RLock()
+
+  def _db(self):
+    if self._conn is None:
+      if self._path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+      self._conn = sqlite3.connect(self._path, check_same_thread=False)
+      self._conn.executescript(SCHEMA)
+    return self._conn
+
+  def _get(self, table, key, columns, filenames, compute):
+    """Looks filenames up in table, computing and storing the misses.
+
+    key is a dict of the columns besides path that pick the entry.  compute
+    is called once with the list of misses and returns a dict of filename ->
+    tuple of columns.  Files that can't be read are left to compute, so its
+    errors come through.
+
+    Returns: a dict of filename -> tuple of columns
+    """
+    prints = {}
+    for f in filenames:
+      try:
+        prints[f] = fingerprint(f)
+      except OSError:
+        pass
+    where = ''.join(' AND %s = ?' % k for k in sorted(key))
+    query = 'SELECT size, mtime_ns, digest, %s FROM %s WHERE path = ?%s' % (
+        ', '.join(columns), table, where)
+    found = {}
+    with self._lock:
+      db = self._db()
+      for f, fp in prints.items():
+        row = db.execute(query, (os.path.abspath(f),) + tuple(key[k] for k in sorted(key))
+                         ).fetchone()
+        if row is not None and tuple(row[:3]) == fp:
+          found[f] = tuple(row[3:])
+    misses = [f for f in filenames if f not in found]
+    stats.incr('analysis.hit', len(found))
+    stats.incr('analysis.miss', len(misses))
+    if not misses:
+      return found
+
+    computed = compute(misses)
+    names = ['path'] + sorted(key) + ['size', 'mtime_ns', 'digest'] + list(columns)
+    insert = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(names), ', '.join('?' * len(names)))
+    with self._lock:
+      db = self._db()
+      with db:
+        db.executemany(insert, [
+            (os.path.abspath(f),) + tuple(key[k] for k in sorted(key)) + prints[f] + tuple(v)
+            for f, v in computed.items() if f in prints])
+    found.update((f, tuple(v)) for f, v in computed.items())
+    return found
+
+  def analyses(self, filenames, compute):
+    """Returns a dict of filename -> Analysis.
+
+    compute(misses) measures the files that aren't cached or changed, and
+    returns a dict of filename -> Analysis.
+    """
+    found = self._get('samples', {}, Analysis._fields, filenames, compute)
+    return {f: Analysis(*v[:6], bool(v[6]), *v[7:]) for f, v in found.items()}
+
+  def loudness(self, filenames, k_weighted, compute):
+    """Returns a dict of filename -> (loudness, peak), see effects.WavFile.loudness.
+
+    compute(misses) is as for analyses().
+    """
+    return self._get('loudness', {'k_weighted': int(k_weighted)}, ('loudness', 'peak'),
+                     filenames, compute)
+
+  def forget(self, filenames):
+    """Drops everything measured in filenames.
+
+    For files this tool just wrote: a gain keeps the size, the card's mtimes
+    are coarse and a leading silence keeps the first block, so the
+    fingerprint alone can miss the change.
+    """
+    paths = [(os.path.abspath(f),) for f in filenames]
+    with self._lock:
+      if self._conn is None and self._path != ':memory:' and not os.path.exists(self._path):
+        # Nothing was ever measured.
+        return
+      db = self._db()
+      with db:
+        db.executemany('DELETE FROM samples WHERE path = ?', paths)
+        db.executemany('DELETE FROM loudness WHERE path = ?', paths)
+
+  def close(self):
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bbeditor.analysis as analysis
+import bbeditor.backups as backups
+import bbeditor.effects as effects
+import bbeditor.stats as stats
+import bbeditor.testutil as testutil
+
+
+class AnalysisCacheTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._store = backups.BackupStore(os.path.join(self._dir, 'backups'))
+    self._cache = analysis.AnalysisCache(os.path.join(self._dir, 'analysis.sqlite'))
+    self._name = os.path.join(self._dir, 'a.wav')
+    testutil.write_wav(self._name, [500, 400, 3, 200, 100, -2, 300], channels=1)
+    self._computed = []
+
+  def tearDown(self):
+    self._cache.close()
+    shutil.rmtree(self._dir)
+
+  def _analyze(self, misses):
+    self._computed.extend(misses)
+    return {f: effects.analyze(f) for f in misses}
+
+  def test_analyze(self):
+    a = self._cache.analyses([self._name], self._analyze)[self._name]
+    self.assertEqual(analysis.Analysis(500 / 32768.0, a.rms, 7, 48000, 1, 2, False, 2, 6), a)
+    self.assertAlmostEqual(7 / 48000.0, a.duration())
+
+  def test_cached_until_changed(self):
+    first = self._cache.analyses([self._name], self._analyze)
+    # A new instance, as in the next session.
+    self._cache.close()
+    self._cache = analysis.AnalysisCache(os.path.join(self._dir, 'analysis.sqlite'))
+    before = stats.STATS.snapshot()['wav.scan']
+    self.assertEqual(first, self._cache.analyses([self._name], self._analyze))
+    self.assertEqual([self._name], self._computed)
+    self.assertEqual(before, stats.STATS.snapshot()['wav.scan'])
+
+    # Same size and mtime, different content.
+    st = os.stat(self._name)
+    testutil.write_wav(self._name, [5, 400, 3, 200, 100, -2, 300], channels=1)
+    os.utime(self._name, ns=(st.st_atime_ns, st.st_mtime_ns))
+    second = self._cache.analyses([self._name], self._analyze)[self._name]
+    self.assertEqual(0, second.zero_start)
+    self.assertEqual([self._name, self._name], self._computed)
+
+  def test_loudness_by_weighting(self):
+    def measure(k_weighted):
+      def compute(misses):
+        self._computed.extend(misses)
+        return {f: effects.WavFile(f).loudness(k_weighted) for f in misses}
+      return compute
+    lufs = self._cache.loudness([self._name], True, measure(True))
+    rms = self._cache.loudness([self._name], False, measure(False))
+    self.assertEqual(2, len(self._computed))
+    self.assertEqual(lufs, self._cache.loudness([self._name], True, measure(True)))
+    self.assertEqual(rms, self._cache.loudness([self._name], False, measure(False)))
+    self.assertEqual(2, len(self._computed))
+
+  def test_missing_file_not_cached(self):
+    missing = os.path.join(self._dir, 'missing.wav')
+    self.assertRaises(OSError, self._cache.analyses, [missing], self._analyze)
+
+  def test_effector_reads_cache(self):
+    effects.Effector(self._name, self._store, self._cache).get_normalize_gain()
+    before = stats.STATS.snapshot()['wav.scan']
+    self.assertAlmostEqual(
+        36.23, effects.Effector(self._name, self._store, self._cache).get_normalize_gain(),
+        places=2)
+    effects.Effector(self._name, self._store, self._cache).trim_to_zero_crossings()
+    self.assertEqual(before, stats.STATS.snapshot()['wav.scan'])
+    self.assertEqual([3, 200, 100, -2], testutil.read_wav(self._name))
+
+
+  def _same_tick(self, func):
+    """Runs func, then puts the clip's mtime back as a coarse card clock would."""
+    st = os.stat(self._name)
+    func()
+    os.utime(self._name, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+  def test_normalize_twice_in_one_tick(self):
+    # Silence longer than the fingerprint's first block, so it can't tell.
+    testutil.write_wav(self._name, [0] * analysis.FINGERPRINT_BYTES + [1000, -1000],
+                           channels=1)
+    for _ in range(2):
+      self._same_tick(lambda: effects.Effector(self._name, self._store, self._cache).normalize())
+      self.assertAlmostEqual(32391, max(testutil.read_wav(self._name)), delta=2)
+    for _ in range(2):
+      self._same_tick(lambda: effects.normalize_preset(
+          [self._name], workers=1, progress=None, store=self._store, cache=self._cache))
+      self.assertAlmostEqual(32391, max(testutil.read_wav(self._name)), delta=2)
+
+
+if __name__ == "__main__":
+  unittest.main()
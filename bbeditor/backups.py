@@ -0,0 +1,201 @@
+"""backups.py
+A content-addressed store of clip versions with an undo history per clip.
+
+The store lives on local disk rather than on the card.  Every version of a
+clip is stored once under the hash of its content, so backing up a clip that
+hasn't changed, or restoring a version that is already stored, copies nothing
+new.  Objects can optionally be compressed (losslessly, with zlib).
+"""
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import zlib
+
+from bbeditor.cachedir import cache_dir
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class NoHistory(Error):
+  def __init__(self, filename):
+    self.filename = filename
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _read_chunks(filename):
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      yield chunk
+
+
+def _compress(chunks):
+  z = zlib.compressobj()
+  for chunk in chunks:
+    yield z.compress(chunk)
+  yield z.flush()
+
+
+def _decompress(chunks):
+  z = zlib.decompressobj()
+  for chunk in chunks:
+    yield z.decompress(chunk)
+  yield z.flush()
+
+
+def _write_atomic(path, chunks):
+  """Writes chunks of bytes to path via a temp file in the same dir, so it's
+  all or nothing."""
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      for chunk in chunks:
+        f.write(chunk)
+    if os.path.exists(path):
+      shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+
+
+class BackupStore(object):
+  """Stores clip versions by content hash and keeps an undo history per clip.
+
+  A clip's history is an ordered list of versions plus a position, the version
+  the file on disk is at.  record() adds the file's current content at the
+  position, undo() and redo() move the position and restore that version.
+  Recording after an undo drops the versions that could have been redone, like
+  an editor's undo.
+
+  Arguments:
+    path: where to keep the store, defaults to the local cache dir
+    compress: whether to zlib-compress newly stored objects
+  """
+
+  def __init__(self, path=None, compress=False):
+    self._path = path or cache_dir('backups')
+    self._compress = compress
+
+  def _object_path(self, digest):
+    return os.path.join(self._path, 'objects', digest[:2], digest)
+
+  def _history_path(self, filename):
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(self._path, 'history', key + '.json')
+
+  def _hash(self, filename):
+    h = hashlib.sha256()
+    for chunk in _read_chunks(filename):
+      h.update(chunk)
+    return h.hexdigest()
+
+  def has(self, digest):
+    path = self._object_path(digest)
+    return os.path.isfile(path) or os.path.isfile(path + '.z')
+
+  def put(self, filename):
+    """Stores the content of filename if it isn't stored yet.
+
+    Returns: the content hash
+    """
+    digest = self._hash(filename)
+    if self.has(digest):
+      return digest
+    if self._compress:
+      _write_atomic(self._object_path(digest) + '.z', _compress(_read_chunks(filename)))
+    else:
+      _write_atomic(self._object_path(digest), _read_chunks(filename))
+    return digest
+
+  def get(self, digest, filename):
+    """Restores stored content to filename, replacing it atomically."""
+    path = self._object_path(digest)
+    if os.path.isfile(path):
+      _write_atomic(filename, _read_chunks(path))
+    else:
+      _write_atomic(filename, _decompress(_read_chunks(path + '.z')))
+
+  def history(self, filename):
+    """Returns (versions, position) for a clip.
+
+    versions is a list of dicts with 'hash', 'size' and 'time' keys, oldest
+    first.  position is the index of the version the file is at.
+    """
+    try:
+      with open(self._history_path(filename)) as f:
+        h = json.load(f)
+    except (OSError, ValueError):
+      return ([], -1)
+    return (h['versions'], h['position'])
+
+  def _save_history(self, filename, versions, position):
+    data = {'path': os.path.abspath(filename), 'versions': versions, 'position': position}
+    _write_atomic(self._history_path(filename), [json.dumps(data).encode('utf-8')])
+
+  def record(self, filename):
+    """Adds the current content of filename to its history.
+
+    Does nothing if the content is the version the history is already at.
+
+    Returns: the content hash
+    """
+    digest = self.put(filename)
+    versions, position = self.history(filename)
+    if versions and versions[position]['hash'] == digest:
+      return digest
+    versions = versions[:position + 1]
+    versions.append({'hash': digest, 'size': os.path.getsize(filename), 'time': time.time()})
+    self._save_history(filename, versions, len(versions) - 1)
+    return digest
+
+  def rename(self, old, new):
+    """Moves old's history to new, after the file itself was renamed.
+
+    Replaces any history new had.  Does nothing if old has none.
+    """
+    versions, position = self.history(old)
+    if not versions:
+      return
+    self._save_history(new, versions, position)
+    os.remove(self._history_path(old))
+
+  def _move(self, filename, steps):
+    if not self.history(filename)[0]:
+      raise NoHistory(filename)
+    # Keep the current content, in case it changed since the last record.
+    self.record(filename)
+    versions, position = self.history(filename)
+    target = position + steps
+    if not versions or target < 0 or target >= len(versions):
+      raise NoHistory(filename)
+    self.get(versions[target]['hash'], filename)
+    self._save_history(filename, versions, target)
+    return target
+
+  def undo(self, filename, steps=1):
+    """Restores the version steps before the current one.
+
+    Returns: the new position in the history
+
+    Raises:
+      NoHistory
+    """
+    return self._move(filename, -steps)
+
+  def redo(self, filename, steps=1):
+    """Restores the version steps after the current one.
+
+    Returns: the new position in the history
+
+    Raises:
+      NoHistory
+    """
+    return self._move(filename, steps)
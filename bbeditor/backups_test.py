@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bbeditor.backups as backups
+
+
+class BackupStoreTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._clip = os.path.join(self._dir, 'clip.wav')
+    self._store = backups.BackupStore(os.path.join(self._dir, 'store'))
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _write(self, content):
+    with open(self._clip, 'wb') as f:
+      f.write(content)
+
+  def _read(self):
+    with open(self._clip, 'rb') as f:
+      return f.read()
+
+  def _objects(self):
+    return sum(len(files) for _, _, files in os.walk(os.path.join(self._dir, 'store', 'objects')))
+
+  def test_undo_redo(self):
+    for content in (b'one', b'two', b'three'):
+      self._write(content)
+      self._store.record(self._clip)
+
+    self._store.undo(self._clip, 2)
+    self.assertEqual(b'one', self._read())
+    self._store.redo(self._clip)
+    self.assertEqual(b'two', self._read())
+    with self.assertRaises(backups.NoHistory):
+      self._store.redo(self._clip, 2)
+    self.assertEqual(b'two', self._read())
+
+    # A new edit after an undo drops what could have been redone.
+    self._write(b'four')
+    self._store.record(self._clip)
+    versions, position = self._store.history(self._clip)
+    self.assertEqual(3, len(versions))
+    self.assertEqual(2, position)
+    self.assertEqual(4, self._objects())
+
+  def test_rename(self):
+    for content in (b'one', b'two'):
+      self._write(content)
+      self._store.record(self._clip)
+    renamed = os.path.join(self._dir, 'renamed.wav')
+    os.rename(self._clip, renamed)
+    self._store.rename(self._clip, renamed)
+    self.assertEqual(([], -1), self._store.history(self._clip))
+    self._store.undo(renamed)
+    with open(renamed, 'rb') as f:
+      self.assertEqual(b'one', f.read())
+    # Nothing to move.
+    self._store.rename(self._clip, renamed)
+    self.assertEqual(2, len(self._store.history(renamed)[0]))
+
+  def test_dedupe(self):
+    self._write(b'same')
+    self._store.record(self._clip)
+    self._store.record(self._clip)
+    other = os.path.join(self._dir, 'other.wav')
+    shutil.copy(self._clip, other)
+    self._store.record(other)
+    self.assertEqual(1, len(self._store.history(self._clip)[0]))
+    self.assertEqual(1, self._objects())
+
+  def test_compressed(self):
+    store = backups.BackupStore(os.path.join(self._dir, 'store'), compress=True)
+    self._write(b'x' * 10000)
+    store.record(self._clip)
+    self._write(b'y')
+    store.record(self._clip)
+    store.undo(self._clip)
+    self.assertEqual(b'x' * 10000, self._read())
+
+  def test_no_history(self):
+    self._write(b'one')
+    with self.assertRaises(backups.NoHistory):
+      self._store.undo(self._clip)
+    self.assertEqual(0, self._objects())
+
+
+if __name__ == "__main__":
+  unittest.main()
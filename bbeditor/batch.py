@@ -0,0 +1,221 @@
+"""batch.py
+Run editor commands non-interactively from a script.
+
+Scripts use the same command grammar as the prompt, one command per line.
+Blank lines and lines starting with # are ignored.  XML edits are collected
+per preset and every touched preset is written once, at the end.
+"""
+import os.path
+
+import bbeditor.backups as backups
+import bbeditor.handlers as handlers
+import bbeditor.prompt as prompt
+import bbeditor.safewrite as safewrite
+import bbeditor.stats as stats
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class BatchError(Error):
+  def __init__(self, lineno, line, message):
+    self.lineno = lineno
+    self.line = line
+    self.message = message
+
+  def __str__(self):
+    return 'line %d: %s: %s' % (self.lineno, self.line, self.message)
+
+
+def describe_error(e):
+  """Returns a user-facing description of a handlers.Error."""
+  if isinstance(e, handlers.NoClipError):
+    return 'No clip at that position'
+  if isinstance(e, handlers.FileNotFound):
+    return 'File not found: %s' % e.filename
+  if isinstance(e, handlers.FileAlreadyExists):
+    return 'Destination file already exists: %s' % e.filename
+  if isinstance(e, handlers.MkdirError):
+    return 'Error creating dir for %s: %s' % (e.path, e.err)
+  if isinstance(e, handlers.FileMoveError):
+    return 'Error moving file: %s' % e.err
+  if isinstance(e, handlers.RewriteError):
+    return 'Error rewriting preset %s, nothing was changed: %s' % (e.preset_name, e.err)
+  return str(e) or e.__class__.__name__
+
+
+class Batch(object):
+  """Runs a script of commands against a card.
+
+  Arguments:
+    root: the bitbox directory, can also be set by a dir command in the script
+    handler: the handlers.Handler to use
+    profile_dir: if given, a cProfile of each command is written there
+    durability: the safewrite policy presets are written with, if no handler
+      is given
+    compress_backups: whether to compress the clip versions kept for undo, if
+      no handler is given
+  """
+
+  def __init__(self, root=None, handler=None, profile_dir=None, durability=safewrite.BATCH,
+               compress_backups=False):
+    self._root = root
+    self._profile_dir = profile_dir
+    # Only close the handler at the end if it is ours.
+    self._owns_handler = handler is None
+    if handler is None:
+      handler = handlers.Handler(writer=safewrite.AtomicWriter(durability),
+                                 backup_store=backups.BackupStore(compress=compress_backups))
+    self._handler = handler
+    self._cur_preset = None
+    # preset name -> open transaction, flushed by flush()
+    self._txns = {}
+
+  def _txn(self):
+    return self._txns[self._cur_preset]
+
+  def _one_coord(self, command):
+    if len(command['coords']) != 1:
+      raise Error('Expected coordinates after command, like: 0,0')
+    return command['coords'][0]
+
+  def _need_clip(self, coords):
+    if not self._handler.get_clip(self._root, self._cur_preset, coords, self._txn()):
+      raise handlers.NoClipError
+
+  def run_command(self, command):
+    """Runs one parsed command.
+
+    Returns false if asked to quit.
+
+    Raises:
+      Error
+      handlers.Error
+    """
+    name = command['command']
+    if name == 'q':
+      return False
+    if name == 'dir':
+      if not command['arg'] or not os.path.isdir(command['arg']):
+        raise Error('bad path: %s' % command['arg'])
+      self.flush()
+      self._root = command['arg']
+      self._cur_preset = None
+      return True
+
+    if not self._root:
+      raise Error("Please set 'dir foo/bar' for bitbox directory")
+
+    if name == 'l':
+      print ('\n'.join(self._handler.list_presets(self._root)))
+      return True
+    if name == 'c':
+      preset_name = command['arg']
+      if preset_name not in self._txns:
+        if not os.path.isfile(os.path.join(self._root, '%s.xml' % preset_name)):
+          raise Error("Didn't find preset: '%s'" % preset_name)
+        self._txns[preset_name] = self._handler.begin(self._root, preset_name)
+      self._cur_preset = preset_name
+      return True
+
+    if self._cur_preset is None:
+      raise Error('Please choose a preset with c')
+
+    root, preset, txn = self._root, self._cur_preset, self._txn()
+    if name == 'r':
+      if not command['arg']:
+        raise Error('Expected coordinates and new filename')
+      clip_filename = self._handler.get_clip(root, preset, self._one_coord(command), txn)
+      if not clip_filename:
+        raise handlers.NoClipError
+      # Presets with pending edits get the repoint in their transaction.
+      self._handler.rename_sample(root, clip_filename, command['arg'], self._txns)
+    elif name == 'f':
+      if not command['arg']:
+        raise Error('Expected coordinates and correct filename')
+      self._handler.repoint_clip(root, preset, self._one_coord(command), command['arg'], txn)
+    elif name == 's':
+      if len(command['coords']) != 2:
+        raise Error('Expected two sets of coordinates, like: 0,0 1,2')
+      self._handler.swap_clips(root, preset, command['coords'][0], command['coords'][1], txn)
+    elif name == 'm':
+      if not command['arg']:
+        raise Error('Wrong number of arguments, want a new preset name')
+      # The rename has to see the edits, so this preset is flushed early.
+      self._handler.commit(root, preset, self._txns.pop(preset))
+      self._handler.move_preset(root, preset, command['arg'])
+      self._cur_preset = command['arg']
+      self._txns[self._cur_preset] = self._handler.begin(root, self._cur_preset)
+    elif name in ('norm', 'trim', 'mono', 'undo', 'redo'):
+      coords = self._one_coord(command)
+      self._need_clip(coords)
+      op = {
+          'norm': self._handler.normalize_clip,
+          'trim': self._handler.trim_clip,
+          'mono': self._handler.clip_to_mono,
+          'undo': self._handler.undo_clip,
+          'redo': self._handler.redo_clip,
+        }[name]
+      op(root, preset, coords, txn)
+    elif name == 'normall':
+      try:
+        options = prompt.parse_normall(command['arg'])
+      except ValueError:
+        raise Error('Expected nothing, or lufs or rms and an optional target')
+      self._handler.normalize_preset(root, preset, txn, **options)
+    elif name == 'trimall':
+      self._handler.trim_all(root, preset, txn)
+    else:
+      raise Error('Command not supported in batch mode: %s' % name)
+    return True
+
+  def flush(self):
+    """Writes every preset with pending edits, each one exactly once."""
+    txns, self._txns = self._txns, {}
+    self._handler.commit_all(self._root, txns)
+
+  def run(self, lines):
+    """Runs all the commands in lines, stopping at the first error.
+
+    Edits made by the commands that succeeded are always flushed, so the XML
+    keeps matching any files that were already moved.  If that fails after a
+    command failed, the command's BatchError says both.
+
+    Raises:
+      BatchError
+    """
+    lineno, failed = 0, None
+    try:
+      for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        command = prompt.parse_command(line)
+        if not command['command']:
+          raise BatchError(lineno, line, 'Could not parse command')
+        try:
+          with stats.command(command['command'], self._profile_dir):
+            running = self.run_command(command)
+          if not running:
+            break
+        except handlers.Error as e:
+          raise BatchError(lineno, line, describe_error(e))
+        except Error as e:
+          raise BatchError(lineno, line, str(e))
+    except BaseException as e:
+      failed = e
+      raise
+    finally:
+      try:
+        # Most of the writing happens here, so it gets its own stats.
+        with stats.command('flush', self._profile_dir):
+          self.flush()
+      except handlers.Error as e:
+        message = 'writing the edited presets: %s' % describe_error(e)
+        if failed is None:
+          raise BatchError(lineno, 'end of script', message)
+        if isinstance(failed, BatchError):
+          failed.message += '; also failed %s' % message
+      finally:
+        if self._owns_handler:
+          self._handler.close()
@@ -0,0 +1,105 @@
+import os
+import unittest
+
+import bbeditor.batch as batch
+import bbeditor.handlers as handlers
+import bbeditor.testutil as testutil
+
+
+class CountingHandler(handlers.Handler):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.commits = []
+
+  def commit_all(self, root, txns):
+    self.commits.extend(txns)
+    super().commit_all(root, txns)
+
+
+class FailingHandler(handlers.Handler):
+  def commit_all(self, root, txns):
+    if txns:
+      raise handlers.RewriteError(sorted(txns)[0], OSError(28, 'No space left on device'))
+
+
+class BatchTest(testutil.CardTest):
+  def setUp(self):
+    super().setUp()
+    files = testutil.empty_clips()
+    files[0][0] = 'KICK.WAV'
+    files[0][1] = 'SNARE.WAV'
+    for name in ('KICK.WAV', 'SNARE.WAV', 'HAT.WAV'):
+      open(os.path.join(self._root, name), 'wb').close()
+    for name in ('one', 'two'):
+      testutil.write_preset(self._root, name, files)
+    self._h = testutil.make_handler(self._local, CountingHandler)
+    self._b = batch.Batch(self._root, self._h)
+
+  def _files(self, preset):
+    return self.make_handler().get_clips_filenames(self._root, preset)
+
+  def test_grouped_by_preset(self):
+    self._b.run([
+        '# reorganise',
+        'c one',
+        's 0,0 0,1',
+        'c two',
+        'f 2,2 HAT.WAV',
+        '',
+        'c one',
+        'r 0,0 drums/SNARE.WAV',
+        'f 3,3 HAT.WAV',
+      ])
+    self.assertEqual(['one', 'two'], sorted(self._h.commits))
+
+    one = self._files('one')
+    self.assertEqual('drums\\SNARE.WAV', one[0][0])
+    self.assertEqual('KICK.WAV', one[0][1])
+    self.assertEqual('HAT.WAV', one[3][3])
+    self.assertTrue(os.path.isfile(os.path.join(self._root, 'drums', 'SNARE.WAV')))
+    self.assertEqual('HAT.WAV', self._files('two')[2][2])
+    # The rename repointed the other preset using the file as well.
+    self.assertEqual('drums\\SNARE.WAV', self._files('two')[0][1])
+
+  def test_stops_at_first_error(self):
+    with self.assertRaises(batch.BatchError) as cm:
+      self._b.run([
+          'c one',
+          'r 0,0 MOVED.WAV',
+          'f 1,1 NOPE.WAV',
+          'f 2,2 HAT.WAV',
+        ])
+    self.assertEqual(3, cm.exception.lineno)
+    # The rename that already happened on disk is still written out.
+    files = self._files('one')
+    self.assertEqual('MOVED.WAV', files[0][0])
+    self.assertEqual('', files[2][2])
+
+  def test_flush_fails(self):
+    b = batch.Batch(self._root, testutil.make_handler(self._local, FailingHandler))
+    with self.assertRaises(batch.BatchError) as cm:
+      b.run(['c one', 's 0,0 0,1'])
+    self.assertEqual(2, cm.exception.lineno)
+    self.assertIn('No space left', str(cm.exception))
+
+    # The command's error isn't lost behind the flush's.
+    with self.assertRaises(batch.BatchError) as cm:
+      b.run(['c one', 's 0,0 0,1', 'f 1,1 NOPE.WAV'])
+    self.assertEqual(3, cm.exception.lineno)
+    self.assertIn('File not found', str(cm.exception))
+    self.assertIn('No space left', str(cm.exception))
+
+  def test_compress_backups(self):
+    b = batch.Batch(self._root, compress_backups=True)
+    self.assertTrue(b._handler._backups._compress)
+    self.assertFalse(batch.Batch(self._root)._handler._backups._compress)
+
+  def test_needs_preset(self):
+    with self.assertRaises(batch.BatchError):
+      self._b.run(['s 0,0 0,1'])
+    with self.assertRaises(batch.BatchError):
+      self._b.run(['c three'])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,10 +2,25 @@
 Process BitBox XML files, with different filters for different operations.
 """
 
-import copy
+import os.path
 import pathlib
+import re
 import xml.sax
-from xml.sax.saxutils import XMLFilterBase, XMLGenerator
+from xml.sax.saxutils import XMLFilterBase, XMLGenerator, escape
+
+import bbeditor.model as model
+import bbeditor.stats as stats
+
+class Error(Exception):
+  pass
+
+
+class PatchError(Error):
+  """The XML can't be patched in place, re-serialize it instead."""
+  def __init__(self, reason):
+    super().__init__(reason)
+    self.reason = reason
+
 
 class BBXML(XMLFilterBase):
   """Base class for BitBox XML Processing.
@@ -13,148 +28,394 @@ class BBXML(XMLFilterBase):
   Loads clip data for each clip into memory for access.
   """
 
-  TEMPLATE_CLIP = {
-      'reverse': 0,
-      'file': 0,
-      'slicemode': 0,
-      'trigtype': 0,
-      'start': 0,
-      'length': 0,
-      'level': 0,
-      'quant': 0,
-      'loop': 0,
-      'pitch': 0,
-      'filename': '',
-      'slize': 0,
-      'midimode': 0,
-      'slices': [],
-    }
-
   def __init__(self, parser):
     """parser: a xml.sax.make_parser() object"""
     super().__init__(parser)
+    self._reset()
+
+  def _reset(self):
     self._cur_track = -1
     self._cur_clip = -1
-    self._clips = [[copy.deepcopy(self.TEMPLATE_CLIP) for j in range(0,4)] for i in range(0,4)]
+    self._tracks = [[model.EMPTY_CLIP] * 4 for i in range(0, 4)]
+    self._clip_attrs = None
+    self._clip_slices = None
 
   def parse(self, source):
-    self._cur_track = -1
-    self._cur_clip = -1
-    self._clips = [[copy.deepcopy(self.TEMPLATE_CLIP) for j in range(0,4)] for i in range(0,4)]
-    super().parse(source)
+    self._reset()
+    stats.incr('xml.parse')
+    if isinstance(source, str) and os.path.isfile(source):
+      stats.incr('bytes.read', os.path.getsize(source))
+    with stats.timer('xml.parse'):
+      super().parse(source)
 
   def clips(self):
-    """Returns a copy of the list of clips (readonly)."""
-    return copy.deepcopy(self._clips)
+    """Returns the clips as a model.Preset, which is immutable."""
+    return model.Preset.from_clips(self._tracks)
 
   def startElement(self, name, attrs):
     if name == 'track':
       self._cur_track += 1
     elif name == 'clip':
       self._cur_clip += 1
+      # Empty slots keep the shared empty clip, whatever their attributes.
       if attrs['filename']:
-        for k in dict(attrs):
-          self._clips[self._cur_track][self._cur_clip][k] = attrs[k]
-    elif name == 'slice':
-      self._clips[self._cur_track][self._cur_clip]['slices'].append(attrs['pos'])
+        self._clip_attrs = dict(attrs)
+        self._clip_slices = []
+    elif name == 'slice' and self._clip_slices is not None:
+      self._clip_slices.append(attrs['pos'])
 
   def endElement(self, name):
     if name == 'track':
       self._cur_clip = -1
+    elif name == 'clip' and self._clip_attrs is not None:
+      self._tracks[self._cur_track][self._cur_clip] = model.Clip.from_attrs(
+          self._clip_attrs, self._clip_slices)
+      self._clip_attrs = None
+      self._clip_slices = None
 
 
-class BBXMLRepoint(BBXML):
-  """Repoints filenames in the XML.
+class BBXMLEdit(BBXML):
+  """Applies any number of clip edits in a single pass over the XML.
 
-  Silently converts paths to Windows-style path separators.
+  Clips without edits are passed through untouched.  An edit is a dictionary
+  of attributes to set on the clip, and may include a 'slices' key to replace
+  the clip's slices.  Attributes not named in the edit keep their old values.
 
   Arguments:
     parser: the xml.sax.make_parser() object
     output: the output file object
-    coords: a coordinate dictionary with int keys 'track' and 'clip'
-    newname: the new name for the clip at those coordinates
+    edits: a dictionary mapping (track, clip) int tuples to edit dictionaries
   """
 
-  def __init__(self, parser, output, coords, newname):
+  def __init__(self, parser, output, edits):
     super().__init__(parser)
     self._output = XMLGenerator(output)
-    self._coords = coords
-    # BitBox uses windows-style paths
-    self._newname = pathlib.PureWindowsPath(newname) if newname != '' else ''
+    self._edits = edits
+    self._in_clip = False
+
+  def _cur_edit(self):
+    return self._edits.get((self._cur_track, self._cur_clip))
+
+  def _replacing_slices(self):
+    edit = self._cur_edit()
+    return edit is not None and 'slices' in edit
 
   def startElement(self, name, attrs):
     super().startElement(name, attrs)
     new_attrs = dict(attrs)
     if name == 'clip':
-      if self._cur_track == self._coords['track'] and self._cur_clip == self._coords['clip']:
-        new_attrs['file'] = "0"
-        new_attrs['filename'] = str(self._newname)
+      self._in_clip = True
+      edit = self._cur_edit()
+      if edit is not None:
+        for k in edit:
+          if k == 'slices':
+            continue
+          new_attrs[k] = str(edit[k])
+      self._output.startElement(name, new_attrs)
+      if self._replacing_slices():
+        self._output.characters('\n                ')
+        self._output.startElement('slices', {})
+        for sl in edit['slices']:
+          self._output.characters('\n                    ')
+          self._output.startElement('slice', {'pos': str(sl)})
+          self._output.endElement('slice')
+        if edit['slices']:
+          self._output.characters('\n                ')
+        self._output.endElement('slices')
+      return
+    if name.startswith('slice') and self._in_clip and self._replacing_slices():
+      return
     self._output.startElement(name, new_attrs)
 
   def endElement(self, name):
     super().endElement(name)
+    if name.startswith('slice') and self._in_clip and self._replacing_slices():
+      # To make whitespace preservation work, we say we're done with a clip
+      # after we see the close tag for the slices.
+      if name == 'slices':
+        self._in_clip = False
+      return
+    if name == 'slices':
+      self._in_clip = False
     self._output.endElement(name)
 
   def characters(self, content):
+    if self._in_clip and self._replacing_slices():
+      return
     self._output.characters(content)
 
 
-class BBXMLOverwrite(BBXML):
+class BBXMLRepoint(BBXMLEdit):
+  """Repoints filenames in the XML.
+
+  Silently converts paths to Windows-style path separators.
+
+  Arguments:
+    parser: the xml.sax.make_parser() object
+    output: the output file object
+    coords: a coordinate dictionary with int keys 'track' and 'clip'
+    newname: the new name for the clip at those coordinates
+  """
+
+  def __init__(self, parser, output, coords, newname):
+    super().__init__(parser, output,
+                     {(coords['track'], coords['clip']): repoint_edit(newname)})
+
+
+class BBXMLOverwrite(BBXMLEdit):
   """Overwrites clip metadata in the XML.
 
   Arguments:
     parser: the xml.sax.make_parser() object
     output: the output file object
     coords: a coordinate dictionary with int keys 'track' and 'clip'
-    clipdata: a dictionary of clip data as returned by clips()
+    clipdata: a model.Clip, or a dictionary of attributes as from Clip.attrs()
   """
 
   def __init__(self, parser, output, coords, clipdata):
-    super().__init__(parser)
-    self._output = XMLGenerator(output)
-    self._coords = coords
-    self._clipdata = clipdata
-    self._in_clip = False
+    if isinstance(clipdata, model.Clip):
+      clipdata = clipdata.attrs()
+    super().__init__(parser, output, {(coords['track'], coords['clip']): clipdata})
 
-  def startElement(self, name, attrs):
-    super().startElement(name, attrs)
-    new_attrs = dict(attrs)
-    if name == 'clip':
-      self._in_clip = True
-      if self._cur_track == self._coords['track'] and self._cur_clip == self._coords['clip']:
-        for k in self._clipdata:
-          if k == 'slices':
-            continue
-          new_attrs[k] = str(self._clipdata[k])
-        self._output.startElement(name, new_attrs)
-        self._output.characters('\n                ')
-        self._output.startElement('slices', {})
-        for sl in self._clipdata['slices']:
-          self._output.characters('\n                    ')
-          self._output.startElement('slice', {'pos': sl})
-          self._output.endElement('slice')
-        if self._clipdata['slices']:
-          self._output.characters('\n                ')
-        self._output.endElement('slices')
-        return
-    if name.startswith('slice'):
-      if self._cur_track == self._coords['track'] and self._cur_clip == self._coords['clip']:
-        return
-    self._output.startElement(name, new_attrs)
 
-  def endElement(self, name):
-    super().endElement(name)
-    # To make whitespace preservation work, we say we're done with a clip after
-    # we see the close tag for the slices.
-    if name == 'slices':
-      self._in_clip = False
-    if name.startswith('slice'):
-      if self._cur_track == self._coords['track'] and self._cur_clip == self._coords['clip']:
-        return
-    self._output.endElement(name)
+def repoint_edit(newname):
+  """Returns the edit dictionary that points a clip at newname."""
+  # BitBox uses windows-style paths
+  newname = str(pathlib.PureWindowsPath(newname)) if newname != '' else ''
+  return {'file': '0', 'filename': newname}
 
-  def characters(self, content):
-    if self._in_clip:
-      if self._cur_track == self._coords['track'] and self._cur_clip == self._coords['clip']:
-        return
-    self._output.characters(content)
+
+# One markup token: a comment, processing instruction, CDATA section, doctype
+# or tag.  For tags, groups are (slash, name, attributes, self-closing slash).
+_TOKEN = re.compile(
+    rb'<!--.*?-->|<\?.*?\?>|<!\[CDATA\[.*?\]\]>|<!DOCTYPE[^>]*>'
+    rb'|<(/?)([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>',
+    re.S)
+_ATTR = re.compile(rb'([^\s=/>]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_ENCODING = re.compile(rb'<\?xml[^>]*encoding\s*=\s*["\']([^"\']+)["\']')
+
+
+class _ClipSpan(object):
+  """Where one clip's markup is in the raw XML.
+
+  attrs maps attribute name to (value start, value end, quote character).
+  attrs_end is where new attributes go.  slices is the (start, end) of the
+  whole <slices> element, or None if the clip has none.
+  """
+  __slots__ = ('attrs', 'attrs_end', 'slices', 'indent', 'step')
+
+  def __init__(self, attrs, attrs_end, indent):
+    self.attrs = attrs
+    self.attrs_end = attrs_end
+    self.slices = None
+    self.indent = indent
+    self.step = b'    '
+
+
+def _indent_at(data, offset):
+  """Returns the whitespace between the previous newline and offset."""
+  line = data.rfind(b'\n', 0, offset) + 1
+  indent = data[line:offset]
+  return indent if not indent.strip() else None
+
+
+class OffsetIndex(object):
+  """Byte offsets of every clip and its attributes in a preset's raw XML.
+
+  Built with a single pass of a small tokenizer, counting tracks and clips
+  the same way BBXML does.  patch() splices edits into the original bytes,
+  so everything it doesn't change stays byte for byte as the device wrote it.
+
+  Raises:
+    PatchError: if the XML is something the tokenizer doesn't handle, like a
+      non-UTF-8 encoding
+  """
+
+  def __init__(self, data):
+    self._data = data
+    self._clips = {}
+    self._scan()
+
+  def _scan(self):
+    data = self._data
+    encoding = _ENCODING.match(data.lstrip())
+    if encoding and encoding.group(1).lower().replace(b'_', b'-') not in (b'utf-8', b'utf8'):
+      raise PatchError('encoding %s' % encoding.group(1).decode('ascii', 'replace'))
+    track = clip = -1
+    span = None
+    slices_start = None
+    pos = 0
+    while True:
+      start = data.find(b'<', pos)
+      if start < 0:
+        break
+      m = _TOKEN.match(data, start)
+      if m is None:
+        raise PatchError('unexpected markup at byte %d' % start)
+      pos = m.end()
+      closing, name, empty = m.group(1), m.group(2), m.group(4)
+      if name is None:
+        continue
+      if not closing:
+        if name == b'track':
+          track += 1
+        elif name == b'clip':
+          clip += 1
+          attrs = {}
+          for a in _ATTR.finditer(m.group(3)):
+            value = 2 if a.group(2) is not None else 3
+            attrs[a.group(1).decode('utf-8')] = (m.start(3) + a.start(value),
+                                                  m.start(3) + a.end(value),
+                                                  '"' if value == 2 else "'")
+          span = _ClipSpan(attrs, m.end(3), _indent_at(data, start))
+          self._clips[(track, clip)] = span
+        elif name == b'slices' and span is not None:
+          slices_start = start
+          indent = _indent_at(data, start)
+          if span.indent is not None and indent is not None and indent.startswith(span.indent):
+            span.step = indent[len(span.indent):] or span.step
+          if empty:
+            span.slices = (start, pos)
+      if closing or empty:
+        if name == b'track':
+          clip = -1
+        elif name == b'clip':
+          span = None
+        elif name == b'slices' and closing and span is not None:
+          span.slices = (slices_start, pos)
+
+  def _slices_markup(self, span, slices):
+    if not slices:
+      return b'<slices></slices>'
+    if span.indent is None:
+      raise PatchError('can\'t tell the indentation for slices')
+    outer = b'\n' + span.indent + span.step
+    lines = [outer + span.step + b'<slice pos="%d"></slice>' % int(sl) for sl in slices]
+    return b'<slices>' + b''.join(lines) + outer + b'</slices>'
+
+  def patch(self, edits):
+    """Returns the XML with edits applied, as bytes.
+
+    Arguments:
+      edits: a dictionary mapping (track, clip) int tuples to edit
+        dictionaries, as BBXMLEdit takes
+
+    Raises:
+      PatchError: if an edit is for a clip or slices that aren't there
+    """
+    splices = []
+    for key, edit in edits.items():
+      span = self._clips.get(key)
+      if span is None:
+        raise PatchError('no clip at %s' % (key,))
+      new_attrs = []
+      for k, v in sorted(edit.items()):
+        if k == 'slices':
+          if span.slices is None:
+            raise PatchError('no slices for clip at %s' % (key,))
+          splices.append(span.slices + (self._slices_markup(span, v),))
+        elif k in span.attrs:
+          start, end, quote = span.attrs[k]
+          value = escape(str(v), {quote: '&quot;' if quote == '"' else '&apos;'})
+          splices.append((start, end, value.encode('utf-8')))
+        else:
+          value = escape(str(v), {'"': '&quot;'})
+          new_attrs.append((' %s="%s"' % (k, value)).encode('utf-8'))
+      if new_attrs:
+        splices.append((span.attrs_end, span.attrs_end, b''.join(new_attrs)))
+
+    out = []
+    pos = 0
+    for start, end, replacement in sorted(splices, key=lambda s: (s[0], s[1])):
+      out.append(self._data[pos:start])
+      out.append(replacement)
+      pos = end
+    out.append(self._data[pos:])
+    return b''.join(out)
+
+
+class Transaction(object):
+  """Collects clip edits against a preset and writes them out in one pass.
+
+  Keeps a working copy of the clips so that edits compose: a swap after a
+  repoint swaps the repointed clip.  Only the attributes that actually changed
+  are written, so untouched clips and attributes are passed through as-is.
+  The working copy is a model.Preset, so starting a transaction copies
+  nothing and each edit only rebuilds the track it touches.
+
+  Arguments:
+    clips: the clips of the preset as returned by BBXML.clips()
+  """
+
+  def __init__(self, clips):
+    self._clips = clips
+    self._dirty = {}
+
+  def clip(self, coords):
+    """Returns the working copy of the clip at coords, a model.Clip."""
+    return self._clips.clip(coords)
+
+  def clips(self):
+    """Returns the working copy of all the clips, a model.Preset."""
+    return self._clips
+
+  def _mark(self, coords, keys):
+    key = (coords['track'], coords['clip'])
+    self._dirty.setdefault(key, set()).update(keys)
+
+  def set_attrs(self, coords, attrs):
+    """Sets clip attributes, eg {'level': '400'} or {'slices': [0, 512]}."""
+    self._clips = self._clips.with_clip(coords, self.clip(coords).with_attrs(attrs))
+    self._mark(coords, attrs.keys())
+
+  def set_slices(self, coords, slices):
+    self.set_attrs(coords, {'slices': slices})
+
+  def repoint(self, coords, newname):
+    self.set_attrs(coords, repoint_edit(newname))
+
+  def overwrite(self, coords, clipdata):
+    """Replaces all the data of the clip at coords, slices included.
+
+    clipdata is a model.Clip.
+    """
+    self._clips = self._clips.with_clip(coords, clipdata)
+    self._mark(coords, clipdata.attrs().keys())
+
+  def swap(self, this_coords, that_coords):
+    this_clip = self.clip(this_coords)
+    self.overwrite(this_coords, self.clip(that_coords))
+    self.overwrite(that_coords, this_clip)
+
+  def edits(self):
+    """Returns the edits to apply, in the form BBXMLEdit takes."""
+    edits = {}
+    for (track, clip), keys in self._dirty.items():
+      data = self._clips[track][clip].attrs()
+      edits[(track, clip)] = {k: data[k] for k in keys if k in data}
+    return edits
+
+  def is_dirty(self):
+    return bool(self._dirty)
+
+  def apply(self, parser, source, output):
+    """Streams source through to output with all the edits applied.
+
+    Arguments:
+      parser: the xml.sax.make_parser() object
+      source: the original XML, anything xml.sax can parse
+      output: the output file object
+    """
+    editor = BBXMLEdit(parser, output, self.edits())
+    editor.parse(source)
+
+  def patch(self, data):
+    """Returns data, the original XML as bytes, with all the edits spliced in.
+
+    Unlike apply(), only the changed attribute values and slices are
+    touched; every other byte is kept as it was.
+
+    Raises:
+      PatchError: if the XML can't be patched in place, use apply() instead
+    """
+    return OffsetIndex(data).patch(self.edits())
@@ -3,7 +3,8 @@ import unittest
 import xml.sax
 
 
-import bbxml
+import bbeditor.bbxml as bbxml
+import bbeditor.model as model
 
 
 class PromptTest(unittest.TestCase):
@@ -93,26 +94,40 @@ class PromptTest(unittest.TestCase):
     xmlfilter = bbxml.BBXML(parser)
     xmlfilter.parse(self._xml)
     got = xmlfilter.clips()
-    self.assertEqual([{'level': '420', 'length': '0', 'slicemode': '0',
-                       'quant': '4', 'file': '0',
-                       'slices': ['0', '22016', '44032', '66560'],
-                       'midimode': '0', 'start': '0', 'trigtype': '3',
-                       'loop': '1', 'pitch': '0', 'reverse': '0', 'slize': '1024',
-                       'filename': '130\\09\\slitekick01.wav'},
-                       {'level': '400', 'length': '0', 'slicemode': '0',
-                        'quant': '4', 'file': '0',
-                        'slices': ['0', '22016', '44032', '66304'],
-                        'midimode': '0', 'start': '0', 'trigtype': '3',
-                        'loop': '1', 'pitch': '0', 'reverse': '0',
-                        'slize': '1024', 'filename': '130\\09\\sbigkick01.wav'},
-                       {'level': 0, 'length': 0, 'slicemode': 0, 'quant': 0,
-                        'file': 0, 'slices': [], 'midimode': 0, 'start': 0,
-                        'trigtype': 0, 'loop': 0, 'pitch': 0, 'reverse': 0,
-                        'slize': 0, 'filename': ''},
-                       {'level': 0, 'length': 0, 'slicemode': 0, 'quant': 0,
-                        'file': 0, 'slices': [], 'midimode': 0, 'start': 0,
-                        'trigtype': 0, 'loop': 0, 'pitch': 0, 'reverse': 0,
-                        'slize': 0, 'filename': ''}], got[0])
+    self.assertEqual(model.Clip(reverse=0, file=0, slicemode=0, trigtype=3, start=0, length=0,
+                                level=420, quant=4, loop=1, pitch=0,
+                                filename='130\\09\\slitekick01.wav', slize=1024, midimode=0,
+                                slices=model.make_slices([0, 22016, 44032, 66560]), extra=()),
+                     got[0][0])
+    self.assertEqual('130\\09\\sbigkick01.wav', got[0][1].filename)
+    self.assertEqual([0, 22016, 44032, 66304], list(got[0][1].slices))
+    self.assertEqual({'level': '400', 'length': '0', 'slicemode': '0',
+                      'quant': '4', 'file': '0',
+                      'slices': [0, 22016, 44032, 66304],
+                      'midimode': '0', 'start': '0', 'trigtype': '3',
+                      'loop': '1', 'pitch': '0', 'reverse': '0',
+                      'slize': '1024', 'filename': '130\\09\\sbigkick01.wav'}, got[0][1].attrs())
+    # Empty slots are all the same shared clip.
+    self.assertIs(model.EMPTY_CLIP, got[0][2])
+    self.assertIs(model.EMPTY_CLIP, got[3][3])
+    self.assertEqual([['130\\09\\slitekick01.wav', '130\\09\\sbigkick01.wav', '', ''],
+                      ['130\\09\\WUBWUB01.WAV', '130\\09\\MODHAT01.WAV', '', ''],
+                      ['130\\09\\ZAP01.WAV', '130\\09\\KLAX01.WAV', '130\\09\\REVZAP01.WAV',
+                       '130\\09\\SPARK01.WAV'],
+                      ['', '', '', '']], got.filenames())
+
+  def test_unknown_attributes_kept(self):
+    xml_text = self._make_xmlio().getvalue().replace('slize="4"', 'slize="4" polymode="2"')
+    clips = self._read(io.StringIO(xml_text))
+    self.assertEqual((('polymode', '2'),), clips[1][1].extra)
+    txn = bbxml.Transaction(clips)
+    txn.swap({'track': 1, 'clip': 1}, {'track': 3, 'clip': 0})
+    with io.StringIO() as out:
+      txn.apply(xml.sax.make_parser(), io.StringIO(xml_text), out)
+      out.seek(0)
+      got = self._read(out)
+    self.assertEqual(clips[1][1], got[3][0])
+    self.assertEqual('', got[1][1].filename)
 
   def test_repoint_xml_windowspath(self):
     with io.StringIO() as out:
@@ -130,10 +145,10 @@ class PromptTest(unittest.TestCase):
 
       self.assertEqual({'level': '420', 'length': '0', 'slicemode': '0',
                        'quant': '4', 'file': '0',
-                       'slices': ['0', '22016', '44032', '66560'],
+                       'slices': [0, 22016, 44032, 66560],
                        'midimode': '0', 'start': '0', 'trigtype': '3',
                        'loop': '1', 'pitch': '0', 'reverse': '0', 'slize': '1024',
-                       'filename': '130\\09\\slitenewname.wav'}, got[0][0])
+                       'filename': '130\\09\\slitenewname.wav'}, got[0][0].attrs())
 
   def test_repoint_xml_unixpath(self):
     """Unix paths are converted to windows paths"""
@@ -149,7 +164,7 @@ class PromptTest(unittest.TestCase):
       xmlfilter.parse(out)
       got = xmlfilter.clips()
 
-      self.assertEqual('130\\09\\unixslash.wav', got[0][1]['filename'])
+      self.assertEqual('130\\09\\unixslash.wav', got[0][1].filename)
 
   def test_overwrite(self):
     """Test overwriting clip data from one to another, deleting slices"""
@@ -193,6 +208,99 @@ class PromptTest(unittest.TestCase):
 
       self.assertEqual(clips[0][0], got[3][0])
 
+  def _read(self, source):
+    xmlfilter = bbxml.BBXML(xml.sax.make_parser())
+    xmlfilter.parse(source)
+    return xmlfilter.clips()
+
+  def test_transaction(self):
+    """Several edits, including a swap after a repoint, in a single pass"""
+    clips = self._read(self._xml)
+    txn = bbxml.Transaction(clips)
+    txn.repoint({'track': 1, 'clip': 0}, '130/09/new.wav')
+    txn.swap({'track': 1, 'clip': 0}, {'track': 0, 'clip': 1})
+    txn.set_attrs({'track': 2, 'clip': 3}, {'level': '77'})
+    txn.set_slices({'track': 2, 'clip': 2}, ['0', '512'])
+    self.assertEqual('130\\09\\new.wav', txn.clip({'track': 0, 'clip': 1}).filename)
+    # The caller's clips are left alone.
+    self.assertEqual('130\\09\\WUBWUB01.WAV', clips[1][0].filename)
+
+    with io.StringIO() as out:
+      txn.apply(xml.sax.make_parser(), self._make_xmlio(), out)
+      out.seek(0)
+      got = self._read(out)
+
+    self.assertEqual(clips[0][1], got[1][0])
+    self.assertEqual('130\\09\\new.wav', got[0][1].filename)
+    self.assertEqual(0, got[0][1].level)
+    self.assertEqual(77, got[2][3].level)
+    self.assertEqual(clips[2][3].slices, got[2][3].slices)
+    self.assertEqual([0, 512], list(got[2][2].slices))
+    self.assertEqual(clips[0][0], got[0][0])
+    self.assertEqual(clips[3], got[3])
+
+  def test_transaction_clean(self):
+    """Without edits the document comes out the same"""
+    txn = bbxml.Transaction(self._read(self._xml))
+    self.assertFalse(txn.is_dirty())
+    with io.StringIO() as out:
+      txn.apply(xml.sax.make_parser(), self._make_xmlio(), out)
+      out.seek(0)
+      self.assertEqual(self._read(self._make_xmlio()), self._read(out))
+
+  def _transaction_edits(self, txn):
+    txn.repoint({'track': 1, 'clip': 0}, '130/09/new.wav')
+    txn.swap({'track': 1, 'clip': 0}, {'track': 0, 'clip': 1})
+    txn.set_attrs({'track': 2, 'clip': 3}, {'level': '77'})
+    txn.set_slices({'track': 2, 'clip': 2}, ['0', '512'])
+
+  def test_patch_matches_apply(self):
+    txn = bbxml.Transaction(self._read(self._xml))
+    self._transaction_edits(txn)
+    with io.StringIO() as out:
+      txn.apply(xml.sax.make_parser(), self._make_xmlio(), out)
+      out.seek(0)
+      applied = self._read(out)
+    data = self._make_xmlio().getvalue().encode('utf-8')
+    patched = self._read(io.BytesIO(txn.patch(data)))
+    self.assertEqual(applied, patched)
+
+  def test_patch_keeps_other_bytes(self):
+    data = self._make_xmlio().getvalue().replace('<session>', '<!-- <clip> -->\n<session>')
+    data = data.encode('utf-8')
+    txn = bbxml.Transaction(self._read(io.BytesIO(data)))
+    txn.repoint({'track': 0, 'clip': 1}, '130/09/new & improved.wav')
+    got = txn.patch(data)
+    old = b'filename="130\\09\\sbigkick01.wav"'
+    new = b'filename="130\\09\\new &amp; improved.wav"'
+    self.assertEqual(data.replace(old, new), got)
+
+  def test_patch_slices_and_new_attrs(self):
+    data = self._make_xmlio().getvalue().encode('utf-8')
+    txn = bbxml.Transaction(self._read(io.BytesIO(data)))
+    txn.set_attrs({'track': 1, 'clip': 1}, {'slices': [0, 512], 'polymode': '2'})
+    txn.set_slices({'track': 0, 'clip': 0}, [])
+    got = txn.patch(data).decode('utf-8')
+    self.assertIn('filename="130\\09\\MODHAT01.WAV" slize="4" midimode="0" polymode="2">\n'
+                  '                <slices>\n'
+                  '                    <slice pos="0"></slice>\n'
+                  '                    <slice pos="512"></slice>\n'
+                  '                </slices>\n'
+                  '            </clip>', got)
+    self.assertIn('slitekick01.wav" slize="1024" midimode="0">\n'
+                  '                <slices></slices>\n', got)
+    self.assertEqual(1, got.count('<slice pos="512">'))
+
+  def test_patch_unsupported(self):
+    data = self._make_xmlio().getvalue()
+    txn = bbxml.Transaction(self._read(io.StringIO(data)))
+    txn.set_attrs({'track': 0, 'clip': 0}, {'level': '1'})
+    latin = ('<?xml version="1.0" encoding="ISO-8859-1"?>\n' + data).encode('latin-1')
+    with self.assertRaises(bbxml.PatchError):
+      txn.patch(latin)
+    with self.assertRaises(bbxml.PatchError):
+      txn.patch(data.replace('<track excl="1"', '<track excl="1" <', 1).encode('utf-8'))
+
 
 if __name__ == "__main__":
   unittest.main()
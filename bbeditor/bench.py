@@ -0,0 +1,303 @@
+"""bench.py
+Times common operations against a generated card.
+
+Builds a synthetic card (presets, WAVs in nested folders) in a temp dir, runs
+each operation a few times through the Handler and the Prompt, and reports
+the timings as JSON.  Given a baseline from an earlier run, any operation
+that got slower by more than the tolerance is reported and the exit status
+is 1.
+
+  python -m bbeditor.bench --presets 50 --out results.json
+  python -m bbeditor.bench --baseline results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy
+
+CLIP = ('            <clip reverse="0" file="%d" slicemode="0" trigtype="3" start="0" '
+        'length="%d" level="0" quant="4" loop="1" pitch="0" filename="%s" slize="1" '
+        'midimode="0">\n'
+        '                <slices></slices>\n'
+        '            </clip>\n')
+
+DEFAULTS = {
+    'presets': 20,
+    'density': 0.75,
+    'seconds': 0.5,
+    'bits': [16, 24],
+    'depth': 2,
+    'channels': 2,
+    'rate': 48000,
+    'repeat': 5,
+    'seed': 1,
+  }
+
+
+def preset_xml(filenames, lengths):
+  """Builds preset XML from a 4x4 list of windows-style clip filenames."""
+  xml = '<?xml version="1.0" encoding="UTF-8"?>\n<document>\n    <session>\n'
+  for track in filenames:
+    xml += '        <track excl="0" out="3" level="0">\n'
+    for f in track:
+      xml += CLIP % (1 if f else 0, lengths.get(f, 0), f)
+    xml += '        </track>\n'
+  xml += '    </session>\n</document>\n'
+  return xml
+
+
+def make_card(root, config):
+  """Fills root with a synthetic card.
+
+  About two slots share each sample, spread over folders config['depth']
+  deep.  Samples are noise at half scale that fades in and out of a little
+  silence, so trimming has something to do, with a bit depth picked from
+  config['bits'].
+
+  Returns: (preset names, sample paths relative to root with '/')
+  """
+  import bbeditor.effects as effects
+
+  rng = random.Random(config['seed'])
+  noise = numpy.random.RandomState(config['seed'])
+  frames = int(config['seconds'] * config['rate'])
+  n_samples = max(1, int(config['presets'] * 16 * config['density'] / 2))
+  t = numpy.arange(frames)
+  fade = max(1, frames // 10)
+  envelope = numpy.clip((numpy.minimum(t, frames - 1 - t) - frames // 100) / float(fade), 0, 1)
+
+  samples = []
+  for i in range(n_samples):
+    dirs = ['DIR%d' % rng.randrange(4) for _ in range(config['depth'])]
+    rel = '/'.join(dirs + ['S%05d.WAV' % i])
+    os.makedirs(os.path.join(root, *dirs), exist_ok=True)
+    width = rng.choice(config['bits']) // 8
+    scale = float(1 << (width * 8 - 1)) / 2
+    data = noise.uniform(-scale, scale, (frames, config['channels'])) * envelope[:, None]
+    effects.write_wav(os.path.join(root, rel), data, config['rate'], width)
+    samples.append(rel)
+
+  lengths = {rel.replace('/', '\\'): frames for rel in samples}
+  presets = []
+  for p in range(config['presets']):
+    filenames = [[rng.choice(samples).replace('/', '\\') if rng.random() < config['density'] else ''
+                  for c in range(0, 4)] for t in range(0, 4)]
+    # Every preset gets at least one clip, so there is something to work on.
+    if not any(f for track in filenames for f in track):
+      filenames[0][0] = samples[p % len(samples)].replace('/', '\\')
+    name = 'PRESET%03d' % p
+    with open(os.path.join(root, '%s.xml' % name), 'w') as f:
+      f.write(preset_xml(filenames, lengths))
+    presets.append(name)
+  return presets, samples
+
+
+def time_op(func, repeat):
+  """Runs func repeat times, returns the list of durations in seconds."""
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    func(i)
+    times.append(time.perf_counter() - start)
+  return times
+
+
+def summarize(times):
+  return {
+      'runs': len(times),
+      'min': min(times),
+      'median': statistics.median(times),
+      'max': max(times),
+    }
+
+
+def first_clip(handler, root, preset):
+  clips = handler.get_clips_filenames(root, preset)
+  for t in range(0, 4):
+    for c in range(0, 4):
+      if clips[t][c]:
+        return {'track': t, 'clip': c}, clips[t][c]
+  return None, None
+
+
+def run_benchmarks(root, presets, config):
+  """Times the operations against the card in root.
+
+  Local state (backups, the reference index) goes in a 'state' dir next to
+  root.
+
+  Returns: a dict of operation name -> summarize() dict
+  """
+  import bbeditor.analysis as analysis
+  import bbeditor.backups as backups
+  import bbeditor.handlers as handlers
+  import bbeditor.playback as playback
+  import bbeditor.prompt as prompt
+  import bbeditor.refindex as refindex
+
+  state = os.path.join(os.path.dirname(root), 'state')
+  repeat = config['repeat']
+  results = {}
+
+  def bench(name, func, n=repeat):
+    results[name] = summarize(time_op(func, n))
+
+  def new_handler():
+    return handlers.Handler(backup_store=backups.BackupStore(os.path.join(state, 'backups')),
+                            ref_index=refindex.RefIndex(os.path.join(state, 'refindex.sqlite')),
+                            player=playback.Player(playback.NullBackend()),
+                            analysis_cache=analysis.AnalysisCache(
+                                os.path.join(state, 'analysis.sqlite')))
+
+  h = new_handler()
+  bench('handler.list', lambda i: h.list_presets(root))
+  bench('handler.read_cold', lambda i: new_handler().get_clips_filenames(root, presets[i % len(presets)]))
+  bench('handler.read_cached', lambda i: h.get_clips_filenames(root, presets[0]))
+  bench('handler.refresh_index_cold',
+        lambda i: refindex.RefIndex(':memory:').refresh(root, h), n=max(1, repeat // 2))
+  bench('handler.refresh_index_warm', lambda i: h.refresh_index(root))
+
+  preset = presets[0]
+  coords, clipname = first_clip(h, root, preset)
+  other = {'track': 3 - coords['track'], 'clip': 3 - coords['clip']}
+  bench('handler.swap', lambda i: h.swap_clips(root, preset, coords, other))
+
+  names = [clipname.replace('\\', '/'), 'RENAMED/' + os.path.basename(clipname.replace('\\', '/'))]
+  bench('handler.rename', lambda i: h.rename_sample(root, names[i % 2], names[(i + 1) % 2]))
+  if repeat % 2:
+    h.rename_sample(root, names[1], names[0])
+
+  coords, _ = first_clip(h, root, preset)
+  bench('handler.normalize_clip', lambda i: h.normalize_clip(root, preset, coords))
+  bench('handler.trim_clip', lambda i: h.trim_clip(root, preset, coords))
+  bench('handler.normalize_preset',
+        lambda i: h.normalize_preset(root, presets[i % len(presets)], progress=None))
+  bench('handler.trim_all', lambda i: h.trim_all(root, presets[i % len(presets)]))
+
+  p = prompt.Prompt(os.path.join(state, 'history'))
+  p.run_command(p.parse_command('dir %s' % root))
+
+  def run(text):
+    return lambda i: p.run_command(p.parse_command(text(i) if callable(text) else text))
+
+  bench('prompt.list', run('l'))
+  bench('prompt.choose', run(lambda i: 'c %s' % presets[i % len(presets)]))
+  p.run_command(p.parse_command('c %s' % preset))
+  bench('prompt.show', lambda i: p.show_current_preset())
+  bench('prompt.swap', run('s 0,0 3,3'))
+  p.run_command(p.parse_command('q'))
+  return results
+
+
+def compare(results, baseline, tolerance=0.2, min_delta=0.001):
+  """Finds operations that got slower than in the baseline.
+
+  An operation regresses when its median is more than tolerance (a fraction)
+  slower and at least min_delta seconds slower, so tiny timings don't flap.
+
+  Returns: a list of (name, baseline median, new median), sorted by name
+  """
+  regressions = []
+  for name, result in sorted(results.items()):
+    if name not in baseline:
+      continue
+    old = baseline[name]['median']
+    new = result['median']
+    if new > old * (1 + tolerance) and new - old >= min_delta:
+      regressions.append((name, old, new))
+  return regressions
+
+
+def run(config, keep=None):
+  """Builds a card, runs the benchmarks and returns the report dict."""
+  workdir = keep or tempfile.mkdtemp(prefix='bbbench-')
+  root = os.path.join(workdir, 'card')
+  os.makedirs(root, exist_ok=True)
+  try:
+    start = time.perf_counter()
+    presets, samples = make_card(root, config)
+    setup = time.perf_counter() - start
+    # The prompt keeps its state in the cache dir, point that at ours too.
+    # Everything prints a lot, which isn't what is being measured.
+    old_cache = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'state')
+    try:
+      with contextlib.redirect_stdout(io.StringIO()):
+        results = run_benchmarks(root, presets, config)
+    finally:
+      if old_cache is None:
+        del os.environ['XDG_CACHE_HOME']
+      else:
+        os.environ['XDG_CACHE_HOME'] = old_cache
+  finally:
+    if keep is None:
+      shutil.rmtree(workdir)
+  return {
+      'config': config,
+      'card': {'presets': len(presets), 'samples': len(samples), 'setup_seconds': setup},
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'time': time.time(),
+      'results': results,
+    }
+
+
+def print_report(report, regressions, out=sys.stdout):
+  out.write('%-28s %10s %10s\n' % ('operation', 'median ms', 'min ms'))
+  for name, r in sorted(report['results'].items()):
+    out.write('%-28s %10.2f %10.2f\n' % (name, r['median'] * 1000, r['min'] * 1000))
+  for name, old, new in regressions:
+    out.write('REGRESSION %s: %.2f ms -> %.2f ms (%+.0f%%)\n'
+              % (name, old * 1000, new * 1000, (new / old - 1) * 100))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark bitbox-editor against a synthetic card.')
+  parser.add_argument('--presets', type=int, default=DEFAULTS['presets'])
+  parser.add_argument('--density', type=float, default=DEFAULTS['density'],
+                      help='fraction of slots with a clip')
+  parser.add_argument('--seconds', type=float, default=DEFAULTS['seconds'],
+                      help='length of each sample')
+  parser.add_argument('--bits', default=','.join(str(b) for b in DEFAULTS['bits']),
+                      help='comma separated bit depths to pick from, of 16, 24, 32')
+  parser.add_argument('--depth', type=int, default=DEFAULTS['depth'],
+                      help='how many folders deep samples are')
+  parser.add_argument('--repeat', type=int, default=DEFAULTS['repeat'])
+  parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+  parser.add_argument('--out', metavar='FILE', help='write the results as JSON to FILE')
+  parser.add_argument('--baseline', metavar='FILE', help='compare against results from FILE')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='how much slower than the baseline is a regression, as a fraction')
+  parser.add_argument('--keep', metavar='DIR', help='build the card in DIR and leave it there')
+  args = parser.parse_args(argv)
+
+  config = dict(DEFAULTS)
+  config.update(presets=args.presets, density=args.density, seconds=args.seconds,
+                bits=[int(b) for b in args.bits.split(',')], depth=args.depth,
+                repeat=args.repeat, seed=args.seed)
+  report = run(config, args.keep)
+
+  regressions = []
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(report['results'], json.load(f)['results'], args.tolerance)
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  print_report(report, regressions)
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
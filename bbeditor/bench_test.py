@@ -0,0 +1,36 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import bbeditor.bench as bench
+
+
+class BenchTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_compare(self):
+    baseline = {'fast': {'median': 0.0001}, 'slow': {'median': 0.010}, 'gone': {'median': 1}}
+    results = {'fast': {'median': 0.0005}, 'slow': {'median': 0.020}, 'new': {'median': 5}}
+    self.assertEqual([('slow', 0.010, 0.020)], bench.compare(results, baseline, tolerance=0.2))
+    self.assertEqual([], bench.compare(results, baseline, tolerance=1.5))
+
+  def test_tiny_card(self):
+    config = dict(bench.DEFAULTS, presets=2, seconds=0.01, repeat=1, bits=[16, 24, 32])
+    report = bench.run(config, keep=self._dir)
+    self.assertEqual(2, report['card']['presets'])
+    self.assertIn('prompt.swap', report['results'])
+    self.assertIn('handler.rename', report['results'])
+    self.assertEqual(2, len([n for n in os.listdir(os.path.join(self._dir, 'card')) if n.endswith('.xml')]))
+    # Round trips as JSON, and a run never regresses against itself.
+    report = json.loads(json.dumps(report))
+    self.assertEqual([], bench.compare(report['results'], report['results']))
+
+
+if __name__ == "__main__":
+  unittest.main()
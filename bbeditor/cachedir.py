@@ -0,0 +1,10 @@
+"""cachedir.py
+Where bitbox-editor keeps its local (off-card) state.
+"""
+import os
+import os.path
+
+def cache_dir(*parts):
+  """Returns a path under the local cache dir, $XDG_CACHE_HOME/bitbox-editor."""
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'bitbox-editor', *parts)
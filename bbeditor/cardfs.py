@@ -0,0 +1,59 @@
+"""cardfs.py
+Fast scans over the files on a card.
+
+Cards can hold tens of thousands of recordings spread over many directories,
+and on removable media each directory listing is a round trip.  The walker
+lists directories in parallel so those round trips overlap.
+"""
+import concurrent.futures
+import os
+import os.path
+
+def _list_dir(path):
+  """Returns ([(name, size)], [subdir names]) for one directory."""
+  files = []
+  dirs = []
+  try:
+    with os.scandir(path) as it:
+      for entry in it:
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.name)
+          elif entry.is_file(follow_symlinks=False):
+            files.append((entry.name, entry.stat(follow_symlinks=False).st_size))
+        except OSError:
+          pass
+  except OSError:
+    pass
+  return files, dirs
+
+
+def walk_files(root, match=None, workers=8):
+  """Lists every file under root, walking directories in parallel.
+
+  Arguments:
+    root: the directory to walk
+    match: optional function of a file name, only files it accepts are listed
+    workers: how many directories to list at once
+
+  Returns: a list of (relative path, size in bytes), with '/' separators
+  """
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = {pool.submit(_list_dir, root): ''}
+    while pending:
+      done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        rel = pending.pop(future)
+        files, dirs = future.result()
+        for name, size in files:
+          if match is None or match(name):
+            results.append((rel + name, size))
+        for d in dirs:
+          sub = rel + d + '/'
+          pending[pool.submit(_list_dir, os.path.join(root, sub))] = sub
+  return results
+
+
+def is_wav(name):
+  return name.lower().endswith('.wav') and not name.startswith('.')
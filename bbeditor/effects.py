@@ -4,124 +4,781 @@
 * normalize
 * trim to zero crossings?
 * normalize a group of clips so they stay relatively the same
+* normalize a group of clips to the same loudness
+
+Audio is decoded into a numpy-backed SampleBuffer.  Playback is
+playback.Player's, pydub only lends its dB conversions.
 """
 
+import collections
+import concurrent.futures
 import logging
+import mmap
+import multiprocessing
+import os
 import os.path
 import shutil
+import struct
+import sys
 
-import pydub
-from pydub.playback import play
+import numpy
 from pydub.utils import db_to_float, ratio_to_db
 
+import bbeditor.analysis as analysis
+import bbeditor.backups as backups
+import bbeditor.stats as stats
+
 #l = logging.getLogger("pydub.converter")
 #l.setLevel(logging.DEBUG)
 #l.addHandler(logging.StreamHandler())
 
-class Effector(object):
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class WavFormatError(Error):
+  def __init__(self, filename, reason):
+    self.filename = filename
+    self.reason = reason
+
+  def __str__(self):
+    return '%s: %s' % (self.filename, self.reason)
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavStats = collections.namedtuple('WavStats', ['peak', 'rms', 'clipped', 'frames'])
+# loudness in LUFS (dBFS for plain RMS), None if the clip is silent.  peak in dBFS.
+Loudness = collections.namedtuple('Loudness', ['loudness', 'peak'])
+
+# BS.1770 loudness is measured over 400ms blocks, overlapping by 75%.
+SEGMENT_SECONDS = 0.1
+SEGMENTS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def _biquad_power(b, a, w):
+  """|H|^2 of a biquad at angular frequencies w (radians per sample)."""
+  z = numpy.exp(-1j * w)
+  h = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+  return numpy.abs(h) ** 2
+
+
+def k_weighting(rate, n):
+  """The power response of the BS.1770 K-weighting filter for an n point rfft.
+
+  The filter is a high shelf (+4dB above about 1.7kHz) followed by a high pass
+  at about 38Hz.  Coefficients are derived for any rate, they match the
+  standard's at 48kHz.
+  """
+  w = 2 * numpy.pi * numpy.fft.rfftfreq(n)
+  # Stage 1, the shelf.
+  k = numpy.tan(numpy.pi * 1681.974450955533 / rate)
+  q = 0.7071752369554196
+  vh = 10 ** (3.999843853973347 / 20.0)
+  vb = vh ** 0.4996667741545416
+  shelf_b = (vh + vb * k / q + k * k, 2 * (k * k - vh), vh - vb * k / q + k * k)
+  shelf_a = (1 + k / q + k * k, 2 * (k * k - 1), 1 - k / q + k * k)
+  # Stage 2, the high pass.
+  k = numpy.tan(numpy.pi * 38.13547087602444 / rate)
+  q = 0.5003270373238773
+  a0 = 1 + k / q + k * k
+  hp_a = (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+  return _biquad_power(shelf_b, shelf_a, w) * _biquad_power((1.0, -2.0, 1.0), hp_a, w)
+
+
+def _segment_power(segments, weights):
+  """Mean square of each (segment, frame, channel) segment, weighted in frequency.
+
+  weights is a power response for the rfft bins, or None for plain mean
+  square.  Returns a (segment, channel) array.
+  """
+  n = segments.shape[1]
+  if weights is None:
+    return numpy.mean(segments * segments, axis=1)
+  spectrum = numpy.fft.rfft(segments, axis=1)
+  power = spectrum.real ** 2 + spectrum.imag ** 2
+  # Parseval: every bin but DC (and Nyquist for even n) stands for two.
+  scale = numpy.full(power.shape[1], 2.0)
+  scale[0] = 1.0
+  if n % 2 == 0:
+    scale[-1] = 1.0
+  return numpy.einsum('sfc,f->sc', power, scale * weights) / (n * n)
+
+
+def _gated_loudness(block_power, offset):
+  """BS.1770 gating over (block, channel) mean squares.
+
+  offset is added to every level, -0.691 for LUFS.  Returns the level or None.
+  """
+  energy = block_power.sum(axis=1)
+  with numpy.errstate(divide='ignore'):
+    levels = offset + 10 * numpy.log10(energy)
+  kept = energy[levels > ABSOLUTE_GATE]
+  if not len(kept):
+    return None
+  relative = offset + 10 * numpy.log10(kept.mean()) + RELATIVE_GATE
+  kept = kept[offset + 10 * numpy.log10(kept) > relative]
+  return float(offset + 10 * numpy.log10(kept.mean()))
+
+
+def _zero_crossing_bounds(head, tail, frames, threshold):
+  """Finds the first quiet frame in head and the last one in tail.
+
+  head and tail are the first and last frames of frames in all, as
+  (frames, channels) arrays.  A frame is quiet when every channel is within
+  threshold of 0.
+
+  Returns: (start, end) such that the clip's frames [start, end) start and
+  end on a quiet frame, or None if either end has none
+  """
+  head = numpy.all(numpy.abs(head) <= threshold, axis=1)
+  tail = numpy.all(numpy.abs(tail) <= threshold, axis=1)
+  if not head.any() or not tail.any():
+    return None
+  start = int(numpy.argmax(head))
+  end = frames - int(numpy.argmax(tail[::-1]))
+  if end <= start:
+    return None
+  return (start, end)
+
+
+class WavFile(object):
+  """A RIFF WAV file, read straight from its header.
+
+  Only the header is read on construction.  The sample data is scanned in
+  fixed-size blocks through a memory map, so memory use doesn't depend on the
+  length of the file.  Handles 8/16/24/32 bit integer and 32/64 bit float data.
+
+  Attributes:
+    filename: the path of the file
+    is_float: whether samples are IEEE floats rather than integers
+    channels, rate: as in the header
+    width: bytes per sample
+    data_offset, data_size: where the sample data lives in the file
+    frames: number of sample frames
+  """
+
+  BLOCK_FRAMES = 64 * 1024
+
   def __init__(self, filename):
+    self.filename = filename
+    self._read_header()
+
+  def _read_header(self):
+    fmt = None
+    with open(self.filename, 'rb') as f:
+      file_size = os.fstat(f.fileno()).st_size
+      riff = f.read(12)
+      if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise WavFormatError(self.filename, 'not a RIFF WAVE file')
+      while True:
+        header = f.read(8)
+        if len(header) < 8:
+          raise WavFormatError(self.filename, 'no data chunk')
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+          fmt = f.read(chunk_size)
+          if chunk_size % 2:
+            f.seek(1, os.SEEK_CUR)
+        elif chunk_id == b'data':
+          self.data_offset = f.tell()
+          # Recordings cut short can claim more data than there is.
+          self.data_size = min(chunk_size, file_size - self.data_offset)
+          break
+        else:
+          f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if fmt is None or len(fmt) < 16:
+      raise WavFormatError(self.filename, 'missing fmt chunk')
+    tag, self.channels, self.rate, _, self.block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+      tag = struct.unpack('<H', fmt[24:26])[0]
+    if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+      raise WavFormatError(self.filename, 'unsupported format tag 0x%04x' % tag)
+    self.is_float = tag == WAVE_FORMAT_IEEE_FLOAT
+    self.width = (bits + 7) // 8
+    if self.is_float and self.width not in (4, 8):
+      raise WavFormatError(self.filename, 'unsupported float width %d' % bits)
+    if not self.is_float and self.width not in (1, 2, 3, 4):
+      raise WavFormatError(self.filename, 'unsupported sample width %d' % bits)
+    if self.channels < 1 or self.block_align != self.width * self.channels:
+      raise WavFormatError(self.filename, 'bad block alignment')
+    self.frames = self.data_size // self.block_align
+
+  def duration(self):
+    """Length in seconds."""
+    return self.frames / float(self.rate) if self.rate else 0.0
+
+  def max_possible_amplitude(self):
+    if self.is_float:
+      return 1.0
+    return float(1 << (self.width * 8 - 1))
+
+  def decode(self, raw):
+    """Converts raw sample bytes to a (frames, channels) array.
+
+    Integers come back as int32 (int64 for 32 bit), floats as float64, all at
+    their original scale.
+    """
+    if self.is_float:
+      samples = numpy.frombuffer(raw, dtype='<f%d' % self.width).astype(numpy.float64)
+    elif self.width == 1:
+      # 8 bit wav is unsigned
+      samples = numpy.frombuffer(raw, dtype=numpy.uint8).astype(numpy.int32) - 128
+    elif self.width == 2:
+      samples = numpy.frombuffer(raw, dtype='<i2').astype(numpy.int32)
+    elif self.width == 3:
+      b = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+      samples = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16))
+      samples = (samples << 8) >> 8
+    else:
+      samples = numpy.frombuffer(raw, dtype='<i4').astype(numpy.int64)
+    return samples.reshape(-1, self.channels)
+
+  def blocks(self, block_frames=None):
+    """Yields the sample data as a series of (frames, channels) arrays."""
+    if self.frames == 0:
+      return
+    block_bytes = (block_frames or self.BLOCK_FRAMES) * self.block_align
+    end = self.data_offset + self.frames * self.block_align
+    with open(self.filename, 'rb') as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start in range(self.data_offset, end, block_bytes):
+          raw = mm[start:min(start + block_bytes, end)]
+          stats.incr('bytes.read', len(raw))
+          yield self.decode(raw)
+
+  def read_frames(self, start, count):
+    """Decodes count frames from frame start, or up to the end."""
+    count = max(0, min(count, self.frames - start))
+    with open(self.filename, 'rb') as f:
+      f.seek(self.data_offset + start * self.block_align)
+      raw = f.read(count * self.block_align)
+    stats.incr('bytes.read', len(raw))
+    return self.decode(raw)
+
+  def zero_crossing_bounds(self, threshold, window=1000):
+    """Finds the first and last quiet frames within window frames of each end.
+
+    Only the two ends are read.  Returns as _zero_crossing_bounds.
+    """
+    head = self.read_frames(0, window)
+    tail = self.read_frames(max(0, self.frames - window), window)
+    return _zero_crossing_bounds(head, tail, self.frames, threshold)
+
+  def scan(self, block_frames=None):
+    """Computes the peak, RMS and number of clipped samples in one pass.
+
+    Peak and RMS are in sample units, see max_possible_amplitude().
+
+    Returns: a WavStats
+    """
+    if self.is_float:
+      top, bottom = 1.0, -1.0
+    else:
+      top = (1 << (self.width * 8 - 1)) - 1
+      bottom = -top - 1
+    peak = 0
+    sum_squares = 0.0
+    clipped = 0
+    stats.incr('wav.scan')
+    with stats.timer('wav.scan'):
+      for block in self.blocks(block_frames):
+        peak = max(peak, block.max(), -block.min())
+        flat = block.ravel().astype(numpy.float64)
+        sum_squares += float(numpy.dot(flat, flat))
+        clipped += int(numpy.count_nonzero((block >= top) | (block <= bottom)))
+    count = self.frames * self.channels
+    rms = (sum_squares / count) ** 0.5 if count else 0.0
+    peak = float(peak) if self.is_float else int(peak)
+    return WavStats(peak, rms, clipped, self.frames)
+
+  def loudness(self, k_weighted=True):
+    """Measures integrated loudness and peak in one pass.
+
+    Follows BS.1770: mean square over 400ms blocks overlapping by 75%, gated
+    at -70 LUFS and then 10 LU below the ungated loudness.  K-weighting is
+    applied to each 100ms segment's spectrum rather than with the IIR filters,
+    so it is all vectorized; the difference is a small fraction of a dB.
+    Clips shorter than a block are measured as one block.  Every channel
+    counts equally.
+
+    Arguments:
+      k_weighted: False for plain RMS in dBFS, with the same gating
+
+    Returns: a Loudness
+    """
+    segment = max(1, int(round(self.rate * SEGMENT_SECONDS)))
+    if self.frames < segment * SEGMENTS_PER_BLOCK:
+      segment = max(1, self.frames)
+    full_scale = self.max_possible_amplitude()
+    weights = k_weighting(self.rate, segment) if k_weighted else None
+    powers = []
+    peak = 0.0
+    stats.incr('wav.scan')
+    with stats.timer('wav.loudness'):
+      # Whole segments per block, so they never straddle two blocks.
+      block_frames = max(1, self.BLOCK_FRAMES // segment) * segment
+      for block in self.blocks(block_frames):
+        if not len(block):
+          continue
+        peak = max(peak, float(block.max()), -float(block.min()))
+        whole = len(block) // segment * segment
+        if whole:
+          samples = block[:whole].astype(numpy.float64) / full_scale
+          powers.append(_segment_power(samples.reshape(-1, segment, self.channels), weights))
+    peak_db = 20 * numpy.log10(peak / full_scale) if peak else float('-inf')
+    if not powers:
+      return Loudness(None, peak_db)
+    powers = numpy.concatenate(powers)
+    if len(powers) < SEGMENTS_PER_BLOCK:
+      blocks = powers
+    else:
+      # Each block is the mean of 4 consecutive segments.
+      cumulative = numpy.cumsum(numpy.vstack([numpy.zeros((1, self.channels)), powers]), axis=0)
+      blocks = (cumulative[SEGMENTS_PER_BLOCK:] - cumulative[:-SEGMENTS_PER_BLOCK]) / SEGMENTS_PER_BLOCK
+    return Loudness(_gated_loudness(blocks, -0.691 if k_weighted else 0.0), float(peak_db))
+
+  def apply_gain(self, db, block_frames=None):
+    """Applies gain to the sample data in place, one block at a time.
+
+    Only the bytes of the data chunk are rewritten.  The sample width, the
+    header and every other chunk in the file are left exactly as they were.
+    """
+    if self.frames == 0:
+      return
+    ratio = db_to_float(db)
+    block_bytes = (block_frames or self.BLOCK_FRAMES) * self.block_align
+    end = self.data_offset + self.frames * self.block_align
+    stats.incr('wav.write')
+    with open(self.filename, 'r+b') as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as mm:
+        for start in range(self.data_offset, end, block_bytes):
+          stop = min(start + block_bytes, end)
+          samples = self.decode(mm[start:stop]) * ratio
+          mm[start:stop] = encode_samples(samples, self.width, self.is_float)
+          stats.incr('bytes.read', stop - start)
+          stats.incr('bytes.written', stop - start)
+        mm.flush()
+
+
+def write_wav(filename, data, rate, width, is_float=False):
+  """Writes a (frames, channels) array of samples as a WAV file.
+
+  data must already be at the scale of the target format, see SampleBuffer.
+  """
+  channels = data.shape[1]
+  raw = encode_samples(data, width, is_float)
+  tag = WAVE_FORMAT_IEEE_FLOAT if is_float else WAVE_FORMAT_PCM
+  block_align = channels * width
+  fmt = struct.pack('<HHIIHH', tag, channels, rate, rate * block_align, block_align, width * 8)
+  pad = b'\x00' if len(raw) % 2 else b''
+  riff_size = 4 + (8 + len(fmt)) + (8 + len(raw) + len(pad))
+  stats.incr('wav.write')
+  stats.incr('bytes.written', 8 + riff_size)
+  with open(filename, 'wb') as f:
+    f.write(b'RIFF' + struct.pack('<I', riff_size) + b'WAVE')
+    f.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+    f.write(b'data' + struct.pack('<I', len(raw)))
+    f.write(raw)
+    f.write(pad)
+
+
+def encode_samples(data, width, is_float=False):
+  """Converts samples at the scale of the target format to raw bytes."""
+  if is_float:
+    return data.astype('<f%d' % width).tobytes()
+  top = (1 << (width * 8 - 1)) - 1
+  ints = numpy.clip(numpy.rint(data), -top - 1, top).astype(numpy.int64)
+  if width == 1:
+    return (ints + 128).astype(numpy.uint8).tobytes()
+  if width == 2:
+    return ints.astype('<i2').tobytes()
+  if width == 3:
+    return ints.astype('<i4').view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+  return ints.astype('<i4').tobytes()
+
+
+class SampleBuffer(object):
+  """Decoded audio held as a (frames, channels) float64 numpy array.
+
+  Samples stay at the scale of their format (eg -32768..32767 for 16 bit) so
+  a buffer can be written back out without rescaling.  Every operation works
+  on the whole array at once.
+  """
+
+  def __init__(self, data, rate, width, is_float=False):
+    self.data = data
+    self.rate = rate
+    self.width = width
+    self.is_float = is_float
+
+  @classmethod
+  def from_wav(cls, filename):
+    wav = WavFile(filename)
+    stats.incr('wav.decode')
+    with stats.timer('wav.decode'):
+      blocks = list(wav.blocks())
+    if blocks:
+      data = numpy.concatenate(blocks).astype(numpy.float64)
+    else:
+      data = numpy.zeros((0, wav.channels))
+    return cls(data, wav.rate, wav.width, wav.is_float)
+
+  def channels(self):
+    return self.data.shape[1]
+
+  def frames(self):
+    return self.data.shape[0]
+
+  def max_possible_amplitude(self):
+    if self.is_float:
+      return 1.0
+    return float(1 << (self.width * 8 - 1))
+
+  def apply_gain(self, db):
+    self.data *= db_to_float(db)
+
+  def to_mono(self):
+    """Downmixes by averaging the channels."""
+    self.data = self.data.mean(axis=1, keepdims=True)
+
+  def trim(self, start, end):
+    self.data = self.data[start:end]
+
+  def write(self, filename):
+    write_wav(filename, self.data, self.rate, self.width, self.is_float)
+
+
+class Effector(object):
+  # How far from 0 a 16 bit sample can be and still count as a zero crossing.
+  ZERO_THRESHOLD_16 = 10
+  # How many frames at each end to search for a zero crossing.
+  ZERO_WINDOW = 1000
+
+  def __init__(self, filename, store=None, cache=None):
+    """store: the backups.BackupStore that keeps the clip's undo history
+    cache: the analysis.AnalysisCache to measure through, None to always measure
+    """
     self._filename = filename
-    self._seg = pydub.AudioSegment.from_wav(self._filename)
+    self._buffer = None
+    self._store = store if store is not None else backups.BackupStore()
+    self._cache = cache
     base, ext = os.path.splitext(self._filename)
+    # Where older versions kept their single backup.
     self._backupname = base + '.bak'
 
-  def play(self):
-    play(self._seg)
+  @property
+  def _buf(self):
+    # Only decode when an operation actually needs the audio.
+    if self._buffer is None:
+      self._buffer = SampleBuffer.from_wav(self._filename)
+    return self._buffer
 
   def get_filename(self):
     return self._filename
 
   def _backup_clip(self):
-    shutil.copy(self._filename, self._backupname)
+    self._store.record(self._filename)
+
+  def _written(self):
+    """Forgets what was known about the clip, after it was written."""
+    self._buffer = None
+    if self._cache is not None:
+      self._cache.forget([self._filename])
 
   def _export(self):
     self._backup_clip()
-    # pydub outputs 24bit as 32, and the files don't play in bitbox.  Instead drop to 16
-    self._seg = self._seg.set_sample_width(2)
-    self._seg.export(self._filename, format="wav")
+    try:
+      self._buf.write(self._filename)
+    finally:
+      self._written()
+    self._store.record(self._filename)
 
   def normalize(self):
-    self._seg = self._seg.normalize()
-    self._export()
+    self.apply_gain(self.get_normalize_gain())
 
-  def undo(self):
-    if not os.path.isfile(self._backupname):
-      print ('no backup to restore, sorry')
-    shutil.copy(self._backupname, self._filename)
+  def undo(self, steps=1):
+    """Restores the clip to the version steps edits ago."""
+    try:
+      self._store.undo(self._filename, steps)
+    except backups.NoHistory:
+      if steps == 1 and os.path.isfile(self._backupname):
+        shutil.copy(self._backupname, self._filename)
+      else:
+        print ('no backup to restore, sorry')
+    self._written()
 
-  def get_normalize_gain(self, headroom=0.1):
-    # cribbed from pydub's code
-    peak_sample_val = self._seg.max
+  def redo(self, steps=1):
+    """Re-applies edits that were undone."""
+    try:
+      self._store.redo(self._filename, steps)
+    except backups.NoHistory:
+      print ('nothing to redo')
+    self._written()
 
-    # if the max is 0, this audio segment is silent, and can't be normalized
-    if peak_sample_val == 0:
-      return 0
+  def history(self):
+    """Returns (versions, position) of the clip's undo history."""
+    return self._store.history(self._filename)
 
-    target_peak = self._seg.max_possible_amplitude * db_to_float(-headroom)
+  def analyze(self):
+    """Returns the clip's analysis.Analysis, from the cache if it has one."""
+    return _analyze_clips([self._filename], self._cache, 1, None)[self._filename]
 
-    return ratio_to_db(target_peak / peak_sample_val)
+  def get_normalize_gain(self, headroom=0.1):
+    return normalize_gain(self.analyze(), headroom)
 
   def apply_gain(self, boost):
-    self._seg = self._seg.apply_gain(boost)
-    self._export()
+    """Applies gain straight to the file, without decoding it."""
+    self._backup_clip()
+    try:
+      WavFile(self._filename).apply_gain(boost)
+    finally:
+      self._written()
+    self._store.record(self._filename)
 
   def trim_to_zero_crossings(self):
     """Make samples loop-compatible with hopefully minimal affect on the length.
 
-    Starts at the beginning and deletes samples until something ~0 is found.
-    Does the same from the end.
+    Looks for the first frame near 0 at the beginning and drops everything
+    before it.  Does the same from the end.
     Reports how many samples were deleted
     """
-
-    samples = self._seg.get_array_of_samples()
-    oldlen = len(samples)
-    # assuming stereo?
-    trimsize = 0
-    while trimsize < 1000:
-      if abs(samples[0]) > 10 or abs(samples[1]) > 10:
-        samples = samples[2:]
-      trimsize += 1
-
-    if trimsize == 1000:
+    measured = self.analyze()
+    if measured.zero_start is None:
       print ("%s: Didn't find a good zero crossing" % self._filename)
       return
 
-    trimsize = 0
-    while trimsize < 1000:
-      if abs(samples[-1]) > 10 or abs(samples[-2]) > 10:
-        samples = samples[:-2]
-      trimsize += 1
-
-    if trimsize == 1000:
-      print ("%s: Didn't find a good zero crossing" % self._filename)
-      return
-
-    print ('%s Trimming %d samples' % (self._filename, oldlen - len(samples)))
-
-    self._seg = self._seg._spawn(samples)
+    buf = self._buf
+    oldlen = buf.frames()
+    buf.trim(measured.zero_start, measured.zero_end)
+    print ('%s Trimming %d samples' % (self._filename, (oldlen - buf.frames()) * buf.channels()))
     self._export()
 
   def to_mono(self):
-    # Still broken!
-    self._seg = self._seg.apply_gain(0.5)
-    self._seg = self._seg.set_channels(1)
+    self._buf.to_mono()
     self._export()
 
 
-def normalize_preset(filenames):
+def print_progress(phase, done, total, filename):
+  """Default progress display for long operations over many clips."""
+  sys.stdout.write('\r%s: %d/%d %s\033[K' % (phase, done, total, os.path.basename(filename)))
+  if done == total:
+    sys.stdout.write('\n')
+  sys.stdout.flush()
+
+
+def analyze(filename):
+  """Measures everything the analysis cache keeps about a clip.
+
+  One pass over the data for the peak and RMS, plus the two ends for the
+  zero crossings trim_to_zero_crossings would cut at.
+
+  Returns: an analysis.Analysis
+  """
+  wav = WavFile(filename)
+  scan = wav.scan()
+  full_scale = wav.max_possible_amplitude()
+  threshold = Effector.ZERO_THRESHOLD_16 * full_scale / 32768.0
+  bounds = wav.zero_crossing_bounds(threshold, Effector.ZERO_WINDOW) or (None, None)
+  return analysis.Analysis(scan.peak / full_scale, scan.rms / full_scale, wav.frames,
+                           wav.rate, wav.channels, wav.width, wav.is_float, *bounds)
+
+
+def normalize_gain(measured, headroom=0.1):
+  """The gain in dB that brings an Analysis's peak to headroom dB below full scale.
+
+  A silent clip can't be normalized and gets 0.
+  """
+  # cribbed from pydub's code
+  if measured.peak == 0:
+    return 0
+  return ratio_to_db(db_to_float(-headroom) / measured.peak)
+
+
+def _apply_gain(filename, gain, store):
+  Effector(filename, store).apply_gain(gain)
+
+
+def _map_clips(func, filenames, extra_args, workers, phase, progress):
+  """Runs func(filename, *extra_args) for every file, spread over a process pool.
+
+  Each worker only ever holds the one clip it is working on, so peak memory is
+  one decoded clip per worker no matter how many clips there are.
+
+  Returns a dict of filename -> result.
+  """
+  results = {}
+  if not filenames:
+    return results
+  if workers is None:
+    workers = os.cpu_count() or 1
+  workers = max(1, min(workers, len(filenames)))
+
+  if workers == 1:
+    for done, f in enumerate(filenames, 1):
+      results[f] = func(f, *extra_args)
+      if progress:
+        progress(phase, done, len(filenames), f)
+    return results
+
+  # Not forked: we may be in a job's thread while other threads hold locks,
+  # which a forked child would inherit held.
+  method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+    futures = {pool.submit(func, f, *extra_args): f for f in filenames}
+    try:
+      for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+        f = futures[future]
+        results[f] = future.result()
+        if progress:
+          progress(phase, done, len(filenames), f)
+    except BaseException:
+      # Eg progress cancelled us, don't start the clips that are left.
+      for future in futures:
+        future.cancel()
+      raise
+  return results
+
+
+def _unique(filenames):
+  """Drops repeated files, keeping the order.  A sample can be in many slots.
+
+  Files are told apart by device and inode, so two spellings of one file on
+  the case-insensitive card (KICK.WAV, kick.wav) count once.
+  """
+  seen = set()
+  unique = []
+  for f in filenames:
+    try:
+      st = os.stat(f)
+      key = (st.st_dev, st.st_ino)
+    except OSError:
+      # Left for the caller to fail on.
+      key = os.path.abspath(f)
+    if key not in seen:
+      seen.add(key)
+      unique.append(f)
+  return unique
+
+
+def _analyze_clips(filenames, cache, workers, progress):
+  """Analyzes clips through cache, or all of them if it's None."""
+  def compute(misses):
+    return _map_clips(analyze, misses, (), workers, 'measuring', progress)
+  if cache is None:
+    return compute(filenames)
+  return cache.analyses(filenames, compute)
+
+
+def normalize_preset(filenames, workers=None, progress=print_progress, store=None, cache=None):
   """Normalizes all the clips in one preset equally.
 
   Goes through each file and gets the needed boost.  Takes the min of those
-  and applies that to all of them
+  and applies that to all of them.  A file listed more than once, because
+  several slots use it, only gets the boost once.
+
+  Both the measuring and the applying are spread over a pool of worker
+  processes, at most one per CPU unless workers says otherwise.  progress is
+  called as progress(phase, done, total, filename) after each clip, and can
+  raise to stop early.  store is the backups.BackupStore to record the clips'
+  undo history in.  cache is the analysis.AnalysisCache to measure through,
+  so clips measured before and unchanged since aren't read again.
+  """
+
+  filenames = _unique(filenames)
+  if not filenames:
+    return
+
+  boosts = {f: normalize_gain(a) for f, a in
+            _analyze_clips(filenames, cache, workers, progress).items()}
+  if progress is print_progress:
+    for f in filenames:
+      print ('%s: %d' % (f, boosts[f]))
+  min_boost = min(boosts.values())
+
+  if store is None:
+    store = backups.BackupStore()
+  try:
+    _map_clips(_apply_gain, filenames, (min_boost, store), workers, 'applying', progress)
+  finally:
+    # The workers' Effectors have no cache to keep in step.
+    if cache is not None:
+      cache.forget(filenames)
+
+
+def _measure_loudness(filename, k_weighted):
+  return WavFile(filename).loudness(k_weighted)
+
+
+def _apply_gain_from(filename, gains, store):
+  Effector(filename, store).apply_gain(gains[filename])
+
+
+def loudness_gains(measured, target=None, ceiling=-1.0):
+  """Solves for the gain that brings each clip to the target loudness.
+
+  A clip's gain never takes its peak above ceiling, so a clip that can't
+  reach the target ends up as loud as it can get.  Silent clips get 0.
+
+  Arguments:
+    measured: dict of filename -> Loudness
+    target: the loudness to aim for.  None for the loudest level that every
+      clip can reach, so they all end up matched.
+    ceiling: the highest peak allowed, in dBFS
+
+  Returns: dict of filename -> gain in dB
+  """
+  audible = [m for m in measured.values() if m.loudness is not None]
+  if target is None and audible:
+    target = min(m.loudness + ceiling - m.peak for m in audible)
+  return {f: min(target - m.loudness, ceiling - m.peak) if m.loudness is not None else 0.0
+          for f, m in measured.items()}
+
+
+def normalize_loudness(filenames, target=None, ceiling=-1.0, k_weighted=True, workers=None,
+                       progress=print_progress, store=None, cache=None):
+  """Brings all the clips in one preset to the same loudness.
+
+  Measures each clip's integrated loudness (K-weighted LUFS, or plain RMS if
+  k_weighted is False) and peak, then applies the gains from
+  loudness_gains().  Gains too small to hear aren't applied.  Workers,
+  progress, store and cache are as for normalize_preset.
+
+  Returns: dict of filename -> gain applied in dB
   """
+  filenames = _unique(filenames)
+  if not filenames:
+    return {}
 
-  min_boost = -1
-  effectors = [Effector(f) for f in filenames]
-  for e in effectors:
-    boost = e.get_normalize_gain()
-    print ('%s: %d' % (e.get_filename(), boost))
-    if min_boost == -1 or boost < min_boost:
-      min_boost = boost
+  def compute(misses):
+    return _map_clips(_measure_loudness, misses, (k_weighted,), workers, 'measuring',
+                      progress)
+  if cache is None:
+    measured = compute(filenames)
+  else:
+    measured = {f: Loudness(*m) for f, m in cache.loudness(filenames, k_weighted, compute).items()}
+  gains = loudness_gains(measured, target, ceiling)
+  if progress is print_progress:
+    unit = 'LUFS' if k_weighted else 'dB RMS'
+    for f in filenames:
+      if measured[f].loudness is None:
+        print ('%s: silent' % f)
+      else:
+        print ('%s: %.1f %s, peak %.1f dB, gain %+.1f dB'
+               % (f, measured[f].loudness, unit, measured[f].peak, gains[f]))
+  gains = {f: g for f, g in gains.items() if abs(g) >= 0.05}
 
-  for e in effectors:
-    e.apply_gain(min_boost)
+  if store is None:
+    store = backups.BackupStore()
+  try:
+    _map_clips(_apply_gain_from, sorted(gains), (gains, store), workers, 'applying', progress)
+  finally:
+    if cache is not None:
+      cache.forget(gains)
+  return gains
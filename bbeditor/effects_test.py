@@ -0,0 +1,273 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+import bbeditor.backups as backups
+import bbeditor.effects as effects
+import bbeditor.testutil as testutil
+
+
+def flatten_blocks(blocks):
+  return [int(s) for b in blocks for s in b.ravel()]
+
+
+class NormalizeTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._store = backups.BackupStore(os.path.join(self._dir, 'backups'))
+    self._files = []
+    for i, peak in enumerate((8000, 16000, 4000)):
+      f = os.path.join(self._dir, 'clip%d.wav' % i)
+      testutil.write_wav(f, [0, 0, peak, -peak // 2, 100, -100] * 50)
+      self._files.append(f)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _check_normalized(self):
+    peaks = [max(abs(s) for s in testutil.read_wav(f)) for f in self._files]
+    # The loudest clip gets close to full scale, the others keep their ratio.
+    self.assertGreater(peaks[1], 32000)
+    self.assertAlmostEqual(peaks[0] * 2, peaks[1], delta=2)
+    self.assertAlmostEqual(peaks[2] * 4, peaks[1], delta=4)
+
+  def test_normalize_preset_pool(self):
+    seen = []
+    effects.normalize_preset(self._files, workers=2,
+                             progress=lambda *args: seen.append(args[:3]), store=self._store)
+    self._check_normalized()
+    self.assertEqual([('measuring', 1, 3), ('measuring', 2, 3), ('measuring', 3, 3),
+                      ('applying', 1, 3), ('applying', 2, 3), ('applying', 3, 3)], seen)
+
+  def test_normalize_preset_inline(self):
+    effects.normalize_preset(self._files, workers=1, progress=None, store=self._store)
+    self._check_normalized()
+
+  def test_shared_sample_normalized_once(self):
+    # Two slots pointing at the loudest clip, by two spellings of its path.
+    shared = os.path.join(self._dir, '.', 'clip1.wav')
+    for workers in (1, 2):
+      effects.normalize_preset(self._files + [shared], workers=workers, progress=None,
+                               store=self._store)
+      self._check_normalized()
+
+  def test_shared_sample_mixed_case(self):
+    # The card doesn't care about case, a second name for the file stands in.
+    shared = os.path.join(self._dir, 'CLIP1.WAV')
+    os.link(os.path.join(self._dir, 'clip1.wav'), shared)
+    for workers in (1, 2):
+      effects.normalize_preset(self._files + [shared], workers=workers, progress=None,
+                               store=self._store)
+      self._check_normalized()
+
+
+class LoudnessTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._store = backups.BackupStore(os.path.join(self._dir, 'backups'))
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _sine(self, name, amplitude, seconds, channels=1, width=2, rate=48000):
+    t = numpy.arange(int(seconds * rate)) / float(rate)
+    wave = amplitude * numpy.sin(2 * numpy.pi * 997 * t) * ((1 << (width * 8 - 1)) - 1)
+    filename = os.path.join(self._dir, name)
+    effects.write_wav(filename, numpy.repeat(wave[:, None], channels, axis=1), rate, width)
+    return filename
+
+  def test_reference_sine(self):
+    # BS.1770: a full scale 997Hz sine in one channel measures -3.01 LUFS.
+    for rate in (44100, 48000):
+      loudness = effects.WavFile(self._sine('a.wav', 1.0, 3, rate=rate)).loudness()
+      self.assertAlmostEqual(-3.01, loudness.loudness, delta=0.02)
+    loudness = effects.WavFile(self._sine('b.wav', 0.5, 3, channels=2, width=3)).loudness()
+    self.assertAlmostEqual(-6.02, loudness.loudness, delta=0.02)
+    self.assertAlmostEqual(-6.02, loudness.peak, delta=0.01)
+    rms = effects.WavFile(self._sine('c.wav', 0.5, 0.2)).loudness(k_weighted=False)
+    self.assertAlmostEqual(-9.03, rms.loudness, delta=0.02)
+
+  def test_silent(self):
+    loudness = effects.WavFile(self._sine('a.wav', 0.0, 1)).loudness()
+    self.assertIsNone(loudness.loudness)
+    self.assertEqual(0.0, effects.loudness_gains({'a': loudness})['a'])
+
+  def test_loudness_gains(self):
+    measured = {
+        'quiet': effects.Loudness(-20.0, -10.0),
+        'loud': effects.Loudness(-12.0, -1.5),
+      }
+    # Matched as loud as the loud clip's peak allows.
+    self.assertEqual({'quiet': 8.5, 'loud': 0.5}, effects.loudness_gains(measured))
+    self.assertEqual({'quiet': 6.0, 'loud': -2.0}, effects.loudness_gains(measured, -14.0))
+    # The ceiling wins over the target.
+    self.assertEqual({'quiet': 9.0, 'loud': 0.5}, effects.loudness_gains(measured, -5.0))
+
+  def test_normalize_loudness(self):
+    files = [self._sine('quiet.wav', 0.05, 2), self._sine('loud.wav', 0.5, 1, channels=2)]
+    gains = effects.normalize_loudness(files, workers=1, progress=None, store=self._store)
+    self.assertEqual(2, len(gains))
+    after = [effects.WavFile(f).loudness() for f in files]
+    self.assertAlmostEqual(after[0].loudness, after[1].loudness, delta=0.05)
+    self.assertLessEqual(max(a.peak for a in after), -0.99)
+    # Already matched, nothing more to do.
+    self.assertEqual({}, effects.normalize_loudness(files, workers=1, progress=None,
+                                                    store=self._store))
+
+
+class WavFileTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._store = backups.BackupStore(os.path.join(self._dir, 'backups'))
+    self._name = os.path.join(self._dir, 'clip.wav')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_16bit(self):
+    samples = [0, 0, 100, -200, 32767, -32768, 5, 5, -7, 3]
+    testutil.write_wav(self._name, samples)
+    wav = effects.WavFile(self._name)
+    self.assertEqual((2, 48000, 2, 5), (wav.channels, wav.rate, wav.width, wav.frames))
+    # Small blocks to cross block boundaries
+    stats = wav.scan(block_frames=2)
+    self.assertEqual(32768, stats.peak)
+    self.assertEqual(2, stats.clipped)
+    self.assertEqual(5, stats.frames)
+    rms = (sum(s * s for s in samples) / float(len(samples))) ** 0.5
+    self.assertAlmostEqual(rms, stats.rms)
+    self.assertEqual(32768.0, wav.max_possible_amplitude())
+
+  def test_24bit_extensible(self):
+    samples = [1, -1, 8388607, -4000000, 0, 12]
+    testutil.write_raw_wav(self._name, testutil.pack_24(samples), 1, 24, extensible=True, extra_chunk=True)
+    wav = effects.WavFile(self._name)
+    self.assertEqual(6, wav.frames)
+    self.assertEqual(samples, flatten_blocks(wav.blocks(block_frames=4)))
+    stats = wav.scan()
+    self.assertEqual(8388607, stats.peak)
+    self.assertEqual(1, stats.clipped)
+
+  def test_32bit_float(self):
+    samples = [0.25, -0.5, 1.0, 0.0]
+    testutil.write_raw_wav(self._name, struct.pack('<4f', *samples), 2, 32, fmt_tag=3)
+    wav = effects.WavFile(self._name)
+    self.assertTrue(wav.is_float)
+    stats = wav.scan()
+    self.assertEqual(1.0, stats.peak)
+    self.assertEqual(1, stats.clipped)
+    self.assertEqual(1.0, wav.max_possible_amplitude())
+
+  def test_32bit_int(self):
+    samples = [-2147483648, 7]
+    testutil.write_raw_wav(self._name, struct.pack('<2i', *samples), 1, 32)
+    self.assertEqual(2147483648, effects.WavFile(self._name).scan().peak)
+
+  def test_not_a_wav(self):
+    with open(self._name, 'wb') as f:
+      f.write(b'nope')
+    with self.assertRaises(effects.WavFormatError):
+      effects.WavFile(self._name)
+
+  def test_apply_gain_in_place(self):
+    samples = [1000, -2000, 4000000, -8000000, 0, 12]
+    testutil.write_raw_wav(self._name, testutil.pack_24(samples), 2, 24, extra_chunk=True)
+    with open(self._name, 'rb') as f:
+      before = f.read()
+    wav = effects.WavFile(self._name)
+    wav.apply_gain(6.0206, block_frames=1)
+    with open(self._name, 'rb') as f:
+      after = f.read()
+    self.assertEqual(len(before), len(after))
+    self.assertEqual(before[:wav.data_offset], after[:wav.data_offset])
+    self.assertEqual([2000, -4000, 8000000, -8388608, 0, 24],
+                     flatten_blocks(effects.WavFile(self._name).blocks()))
+
+  def test_normalize_keeps_width(self):
+    samples = [1000, -2000, 4194304, 0]
+    testutil.write_raw_wav(self._name, testutil.pack_24(samples), 1, 24)
+    effects.Effector(self._name, self._store).normalize()
+    wav = effects.WavFile(self._name)
+    self.assertEqual(3, wav.width)
+    self.assertAlmostEqual(8388608 * 10 ** (-0.1 / 20), wav.scan().peak, delta=1)
+
+  def test_normalize_gain(self):
+    testutil.write_wav(self._name, [0, 16384, -8192, 0])
+    self.assertAlmostEqual(6.02, effects.Effector(self._name, self._store).get_normalize_gain(headroom=0), places=2)
+
+
+class SampleBufferTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._store = backups.BackupStore(os.path.join(self._dir, 'backups'))
+    self._name = os.path.join(self._dir, 'clip.wav')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_24bit_roundtrip(self):
+    samples = [1, -1, 8388607, -8388608, 0, 12]
+    testutil.write_raw_wav(self._name, testutil.pack_24(samples), 2, 24)
+    buf = effects.SampleBuffer.from_wav(self._name)
+    self.assertEqual((3, 2), buf.data.shape)
+    buf.write(self._name)
+    wav = effects.WavFile(self._name)
+    self.assertEqual(3, wav.width)
+    self.assertEqual(samples, flatten_blocks(wav.blocks()))
+
+  def test_gain(self):
+    testutil.write_raw_wav(self._name, testutil.pack_24([1000, -2000, 16000, 0]), 2, 24)
+    buf = effects.SampleBuffer.from_wav(self._name)
+    buf.apply_gain(6.0206)
+    self.assertEqual([[2000, -4000], [32000, 0]], numpy.rint(buf.data).tolist())
+
+  def test_zero_crossing_bounds(self):
+    testutil.write_wav(self._name, [500, 1, 2, 1, 70, 80, 0, 0, 19, 19])
+    wav = effects.WavFile(self._name)
+    self.assertEqual((1, 4), wav.zero_crossing_bounds(10))
+    self.assertEqual((1, 4), wav.zero_crossing_bounds(10, window=2))
+    self.assertIsNone(wav.zero_crossing_bounds(10, window=1))
+
+  def test_to_mono(self):
+    testutil.write_wav(self._name, [100, 300, -100, -300])
+    buf = effects.SampleBuffer.from_wav(self._name)
+    buf.to_mono()
+    self.assertEqual([[200], [-200]], buf.data.tolist())
+
+  def test_trim_mono(self):
+    testutil.write_wav(self._name, [500, 400, 3, 200, 100, -2, 300], channels=1)
+    effector = effects.Effector(self._name, self._store)
+    effector.trim_to_zero_crossings()
+    self.assertEqual([3, 200, 100, -2], testutil.read_wav(self._name))
+
+  def test_trim_stereo(self):
+    testutil.write_wav(self._name, [500, 1, 2, 1, 70, 80, 0, 0, 19, 19])
+    effects.Effector(self._name, self._store).trim_to_zero_crossings()
+    self.assertEqual([2, 1, 70, 80, 0, 0], testutil.read_wav(self._name))
+
+  def test_undo_redo(self):
+    testutil.write_wav(self._name, [500, 400, 3, 200, 100, -2, 300], channels=1)
+    effects.Effector(self._name, self._store).trim_to_zero_crossings()
+    effects.Effector(self._name, self._store).apply_gain(6.0206)
+    self.assertEqual([6, 400, 200, -4], testutil.read_wav(self._name))
+
+    effector = effects.Effector(self._name, self._store)
+    effector.undo(2)
+    self.assertEqual([500, 400, 3, 200, 100, -2, 300], testutil.read_wav(self._name))
+    effector.redo()
+    self.assertEqual([3, 200, 100, -2], testutil.read_wav(self._name))
+    versions, position = effector.history()
+    self.assertEqual((3, 1), (len(versions), position))
+
+  def test_trim_no_zero_crossing(self):
+    testutil.write_wav(self._name, [500, 500, 500, 500])
+    effects.Effector(self._name, self._store).trim_to_zero_crossings()
+    self.assertEqual([500, 500, 500, 500], testutil.read_wav(self._name))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,13 +2,27 @@
 
 There is a stateful player, that's it.
 """
+import collections
+import concurrent.futures
+import fnmatch
+import io
+import os
 import os.path
 import pathlib
+import re
 import shutil
+import threading
 import xml.sax
 
+import bbeditor.analysis as analysis
+import bbeditor.backups as backups
 import bbeditor.bbxml as bbxml
+import bbeditor.cardfs as cardfs
 import bbeditor.effects as effects
+import bbeditor.playback as playback
+import bbeditor.refindex as refindex
+import bbeditor.safewrite as safewrite
+import bbeditor.stats as stats
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -37,44 +51,238 @@ class FileMoveError(Error):
 class InvalidCoordinates(Error):
   pass
 
+class RewriteError(Error):
+  def __init__(self, preset_name, err):
+    self.preset_name = preset_name
+    self.err = err
+
+class TooManyPresets(Error):
+  def __init__(self, count):
+    self.count = count
+
+class SampleInUse(Error):
+  def __init__(self, filename, usage):
+    self.filename = filename
+    self.usage = usage
+
+
+Orphan = collections.namedtuple('Orphan', ['filename', 'size', 'duration'])
+
+# A broken clip path, candidates are the files on the card that match it
+# ignoring case.  Only fixable if there is exactly one.
+CaseMismatch = collections.namedtuple('CaseMismatch',
+                                      ['preset', 'track', 'clip', 'filename', 'candidates'])
+
+# What l shows for a preset.  clips counts the used slots.  bytes and duration
+# add up the distinct samples it uses that are on the card (duration leaves out
+# unreadable ones), missing counts the distinct samples that aren't.
+PresetSummary = collections.namedtuple('PresetSummary',
+                                       ['name', 'clips', 'bytes', 'duration', 'missing'])
+
+
+class AuditionQueue(object):
+  """Iterates over a list of files for auditioning one by one.
+
+  Yields (filename, error) once the file is decoded into the player's cache,
+  so playing it starts at once.  error is the exception if it couldn't be
+  decoded, else None.  While the caller is busy with one clip (playing it,
+  waiting for the user) the next one is already being decoded by the
+  player's prefetch.
+  """
+
+  def __init__(self, filenames, player):
+    self._filenames = list(filenames)
+    self._player = player
+
+  def __iter__(self):
+    for i, filename in enumerate(self._filenames):
+      try:
+        self._player.decoded(filename)
+        error = None
+      except (OSError, effects.Error) as e:
+        error = e
+      self._player.prefetch(self._filenames[i + 1:i + 2])
+      yield filename, error
+
+class PresetCache(object):
+  """A bounded LRU of parsed preset clips.
+
+  Entries are keyed by filename and remember the (mtime, size, inode) of the
+  file when it was parsed, so a preset that changed on disk behind our back is
+  reparsed instead of served stale.  Safe to share between threads.
+  """
+
+  def __init__(self, maxsize=32):
+    self._maxsize = maxsize
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _identity(self, filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+  def get(self, filename, loader):
+    """Returns the cached value for filename, calling loader(filename) on a miss."""
+    identity = self._identity(filename)
+    with self._lock:
+      entry = self._entries.get(filename)
+      if entry is not None and entry[0] == identity:
+        self._entries.move_to_end(filename)
+        self.hits += 1
+        stats.incr('preset_cache.hit')
+        return entry[1]
+      self.misses += 1
+    stats.incr('preset_cache.miss')
+
+    value = loader(filename)
+    with self._lock:
+      self._entries[filename] = (identity, value)
+      self._entries.move_to_end(filename)
+      while len(self._entries) > self._maxsize:
+        self._entries.popitem(last=False)
+    return value
+
+  def invalidate(self, filename):
+    with self._lock:
+      self._entries.pop(filename, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
 class Handler(object):
-  def __init__(self):
-    pass
+  XML_MATCHER = re.compile(fnmatch.translate('*.xml'), re.IGNORECASE)
+  # The preset slots older firmwares read, see export_v1.
+  V1_MATCHER = re.compile(r'SE\d{6}$', re.IGNORECASE)
+  V1_SLOTS = 12
+
+  def __init__(self, cache_size=32, backup_store=None, ref_index=None, player=None,
+               writer=None, analysis_cache=None):
+    """writer: the safewrite.AtomicWriter presets are written with
+    analysis_cache: the analysis.AnalysisCache clips are measured through
+    """
+    self._cache = PresetCache(cache_size)
+    self._backups = backup_store if backup_store is not None else backups.BackupStore()
+    self._refindex = ref_index if ref_index is not None else refindex.RefIndex()
+    self._player = player if player is not None else playback.Player()
+    self._writer = writer if writer is not None else safewrite.AtomicWriter()
+    self._analysis = (analysis_cache if analysis_cache is not None
+                      else analysis.AnalysisCache())
 
   def _preset_filename(self, root, preset_name):
     return os.path.join(root, '%s.xml' % preset_name)
 
-  def _get_clips(self, root, preset_name):
+  def _parse_preset(self, filename):
     parser = xml.sax.make_parser()
     xmlfilter = bbxml.BBXML(parser)
-    xmlfilter.parse(self._preset_filename(root, preset_name))
+    xmlfilter.parse(filename)
     return xmlfilter.clips()
 
-  def get_clips_filenames(self, root, preset_name):
-    clips = self._get_clips(root, preset_name)
-    files = [['' for j in range(0,4)] for i in range(0,4)]
-    for i in range(0, 4):
-      for j in range(0, 4):
-        files[i][j] = clips[i][j]['filename']
-    return files
+  def _get_clips(self, root, preset_name, txn=None):
+    """Returns the parsed clips for a preset, served from the cache if possible.
+
+    If an open transaction is given, returns its working copy instead.  Either
+    way it's an immutable model.Preset, so it can be shared.
+    """
+    if txn is not None:
+      return txn.clips()
+    return self._cache.get(self._preset_filename(root, preset_name), self._parse_preset)
+
+  def _invalidate(self, root, preset_name):
+    self._cache.invalidate(self._preset_filename(root, preset_name))
+
+  def preset_stat(self, root, preset_name):
+    return os.stat(self._preset_filename(root, preset_name))
+
+  def read_clips_filenames(self, root, preset_name):
+    """Like get_clips_filenames, but always parses and doesn't fill the cache.
+
+    For scans over every preset on the card.
+    """
+    return self._filenames(self._parse_preset(self._preset_filename(root, preset_name)))
+
+  def _index_preset(self, root, preset_name, clips):
+    self._refindex.update_preset(root, preset_name, self._filenames(clips),
+                                 self.preset_stat(root, preset_name))
+
+  def lock_keys(self, root, preset_name, txn=None):
+    """Returns the jobs.JobQueue lock keys for writing to a preset.
+
+    One for the preset's XML and one for each sample it uses.  Samples are
+    keyed like in the reference index, so two presets spelling a path
+    differently still share its key.
+    """
+    card = os.path.abspath(root)
+    keys = [('preset', card, preset_name.casefold())]
+    try:
+      clips = self.get_clips_filenames(root, preset_name, txn)
+    except (OSError, xml.sax.SAXException):
+      return keys
+    keys.extend(('sample', card, refindex.sample_key(c)) for t in clips for c in t if c)
+    return keys
+
+  def refresh_index(self, root):
+    """Rescans the presets that changed since they were last indexed.
+
+    Returns: the number of presets that were parsed
+    """
+    return self._refindex.refresh(root, self)
+
+  def sample_usage(self, root, filename):
+    """Returns a sorted list of (preset, track, clip, filename) that use a sample.
+
+    Matching is case-insensitive and accepts either kind of path separator.
+    """
+    self.refresh_index(root)
+    return self._refindex.usage(root, filename)
+
+  def cache_stats(self):
+    """Returns a dict of preset cache hits, misses and current size."""
+    return self._cache.stats()
 
-  def get_clip(self, root, preset_name, coords):
+  def list_presets(self, root):
+    """Return the names of all the files in the root with .xml extensions"""
+    xmls = []
+    for f in os.listdir(root):
+      if self.XML_MATCHER.match(f):
+        xmls.append(os.path.splitext(os.path.basename(f))[0])
+    return xmls
+
+  def _filenames(self, clips):
+    return clips.filenames()
+
+  def get_clips_filenames(self, root, preset_name, txn=None):
+    return self._filenames(self._get_clips(root, preset_name, txn))
+
+  def get_clip(self, root, preset_name, coords, txn=None):
     """Gets the encoded clip name, which is a bad windows-style relative path.
 
     Use _format_clip_filename to get something useful
     """
-    clips = self.get_clips_filenames(root, preset_name)
+    clips = self.get_clips_filenames(root, preset_name, txn)
     clip_filename = clips[coords['track']][coords['clip']]
     return clip_filename
 
   def play_clip(self, root, preset_name, coords):
-    """Parses text and plays the given clip
+    """Starts playing the given clip, stopping whatever was playing.
+
+    Returns straight away.  The other clips of the preset are then decoded in
+    the background, nearest slots first, so auditioning them starts at once.
 
     Raises:
       NoClipError
       FileNotFound
+      effects.WavFormatError
     """
-    clipname = self.get_clip(root, preset_name, coords)
+    clips = self.get_clips_filenames(root, preset_name)
+    clipname = clips[coords['track']][coords['clip']]
     if not clipname:
       raise NoClipError
 
@@ -82,14 +290,32 @@ class Handler(object):
     if not os.path.isfile(filename):
       raise FileNotFound(filename)
 
-    effector = effects.Effector(filename)
-    effector.play()
+    self._player.play(filename)
+
+    neighbours = sorted((abs(t - coords['track']) + abs(c - coords['clip']), t, c)
+                        for t in range(0, 4) for c in range(0, 4) if clips[t][c])
+    self._player.prefetch([self._format_clip_filename(root, clips[t][c])
+                           for _, t, c in neighbours[1:]])
+
+  def play_file(self, filename):
+    """Starts playing a file, see play_clip.
+
+    Raises:
+      OSError
+      effects.WavFormatError
+    """
+    self._player.play(filename)
+
+  def stop_playback(self):
+    self._player.stop()
 
-  def _backup_preset(self, root, preset_name):
-    """Make a copy of the preset file"""
-    oldpath = os.path.join(root, self._preset_filename(root, preset_name))
-    newpath = os.path.splitext(oldpath)[0] + '.bak'
-    shutil.copy(oldpath, newpath)
+  def close(self):
+    """Stops playback and lets go of the player's processes and threads."""
+    self._player.close()
+
+  def player_stats(self):
+    """Returns a dict of 'hits', 'misses', 'size' and 'bytes' for decoded clips."""
+    return self._player.stats()
 
   def _format_clip_filename(self, root, suffix):
     return os.path.join(root, suffix.replace('\\','/'))
@@ -128,37 +354,285 @@ class Handler(object):
       shutil.move(oldpath, newpath)
     except Exception as e:
       raise FileMoveError(e)
+    # The undo history goes with the file.
+    self._backups.rename(oldpath, newpath)
     return True
 
-  def move_clip(self, root, preset_name, coords, newname):
+  def _forget_sample(self, root, filename):
+    """Drops what the caches know about a sample that was moved or deleted."""
+    path = self._format_clip_filename(root, filename)
+    self._player.forget(path)
+    self._analysis.forget([path])
+    self._refindex.update_samples(root, {}, [filename.replace('\\', '/')])
+
+  def begin(self, root, preset_name):
+    """Starts a transaction of clip edits against a preset.
+
+    Nothing is written until the transaction is passed to commit().
+    """
+    return bbxml.Transaction(self._get_clips(root, preset_name))
+
+  def _read_preset(self, root, preset_name):
+    with open(self._preset_filename(root, preset_name), 'rb') as f:
+      data = f.read()
+    stats.incr('bytes.read', len(data))
+    return data
+
+  def _render(self, txn, original):
+    """Returns original, the preset's XML as bytes, with txn's edits applied.
+
+    The edits are spliced into the original bytes so the rest of the file
+    stays exactly as it was.  XML the patcher can't handle is re-serialized
+    instead.
+    """
+    stats.incr('xml.write')
+    try:
+      return txn.patch(original)
+    except bbxml.PatchError:
+      out = io.StringIO()
+      txn.apply(xml.sax.make_parser(), io.BytesIO(original), out)
+      return out.getvalue().encode('utf-8')
+
+  def commit(self, root, preset_name, txn):
+    """Writes all the edits in a transaction to the preset in a single pass.
+
+    The preset is replaced atomically, it is never left half written.
+
+    Raises:
+      RewriteError
+    """
+    self.commit_all(root, {preset_name: txn})
+
+  def commit_all(self, root, txns):
+    """Commits transactions against several presets together.
+
+    Every preset is written aside before any is swapped in, so the writer's
+    durability policy can sync them as one batch.
+
+    Arguments:
+      txns: dict of preset name -> transaction
+
+    Raises:
+      RewriteError: for the first preset, in name order, that couldn't be
+        written.  If it failed while swapping in, the presets before it have
+        been written.
+    """
+    dirty = sorted(name for name, txn in txns.items() if txn.is_dirty())
+    staged = []
+    try:
+      for name in dirty:
+        try:
+          data = self._render(txns[name], self._read_preset(root, name))
+          staged.append(self._writer.stage(self._preset_filename(root, name), data))
+        except Exception as e:
+          raise RewriteError(name, e)
+    except BaseException:
+      self._writer.discard(staged)
+      raise
+
+    try:
+      self._writer.publish(staged)
+    except safewrite.PublishError as e:
+      raise RewriteError(dirty[len(e.published)], e.err)
+    finally:
+      for name in dirty:
+        self._invalidate(root, name)
+    for name in dirty:
+      self._index_preset(root, name, txns[name].clips())
+
+  def move_clip(self, root, preset_name, coords, newname, txn=None):
     """Move file for a clip on disk and update XML to match.
 
+    Every other preset using the same file is repointed too, see
+    rename_sample.  If an open transaction is given, the edit to this preset is
+    left in it for the caller to commit.  The file on disk is moved right away
+    either way.
+
+    Returns: a sorted list of (preset, track, clip) that were repointed
+
     Raises:
       NoClipError
-      Everything that _move_file raises
+      Everything that rename_sample raises
     """
-    clip_filename = self.get_clip(root, preset_name, coords)
+    clip_filename = self.get_clip(root, preset_name, coords, txn)
     if not clip_filename:
       raise NoClipError
 
-    self._backup_preset(root, preset_name)
+    pending = {preset_name: txn} if txn is not None else None
+    return self.rename_sample(root, clip_filename, newname, pending)
 
-    preset_filename = self._preset_filename(root, preset_name)
-    backup_filename = os.path.splitext(preset_filename)[0] + '.bak'
+  def _stage_repoint(self, root, preset_name, coords_list, newname):
+    """Writes a repointed copy of a preset aside, see safewrite.
 
-    self._move_file(root, clip_filename, newname)
+    Returns: (safewrite.Staged, original bytes, new clips)
+    """
+    original = self._read_preset(root, preset_name)
+    txn = bbxml.Transaction(self._parse_preset(io.BytesIO(original)))
+    for coords in coords_list:
+      txn.repoint(coords, newname)
+    staged = self._writer.stage(self._preset_filename(root, preset_name),
+                                self._render(txn, original))
+    return staged, original, txn.clips()
 
-    parser = xml.sax.make_parser()
-    with open(preset_filename, 'w') as out:
-      repointer = bbxml.BBXMLRepoint(parser, out, coords, newname)
-      repointer.parse(backup_filename)
+  def rename_sample(self, root, oldname, newname, pending=None, workers=8):
+    """Moves a sample once and repoints every preset slot that uses it.
+
+    Finds the slots through the reference index.  The affected presets are
+    rewritten in parallel, each exactly once, and only swapped in after the
+    file has moved.  If anything fails, the file and every preset are left as
+    they were.
+
+    Arguments:
+      pending: optional dict of preset name -> open transaction.  Those presets
+        get the repoint in their transaction instead of being written.
+
+    Returns: a sorted list of (preset, track, clip) that were repointed
+
+    Raises:
+      RewriteError
+      Everything that _move_file raises
+    """
+    pending = pending or {}
+    key = refindex.sample_key(oldname)
+    self.refresh_index(root)
+    by_preset = collections.defaultdict(list)
+    for preset, track, clip, _ in self._refindex.usage(root, oldname):
+      if preset not in pending:
+        by_preset[preset].append({'track': track, 'clip': clip})
+    pending_coords = {}
+    for preset, txn in pending.items():
+      clips = txn.clips()
+      pending_coords[preset] = [{'track': t, 'clip': c}
+                                for t in range(0, 4) for c in range(0, 4)
+                                if clips[t][c].filename and
+                                refindex.sample_key(clips[t][c].filename) == key]
+
+    if not self._file_exists(root, oldname):
+      raise FileNotFound(oldname)
+    newpath = self._format_clip_filename(root, newname)
+    if self._file_exists(root, newpath):
+      raise FileAlreadyExists(newpath)
+
+    # Write every new preset aside first, nothing on the card has changed yet.
+    rewritten = {}
+    failed = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      stage_repoint = stats.bound(self._stage_repoint)
+      futures = {pool.submit(stage_repoint, root, preset, coords, newname): preset
+                 for preset, coords in by_preset.items()}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          rewritten[futures[future]] = future.result()
+        except Exception as e:
+          failed = failed or RewriteError(futures[future], e)
+    staged = [rewritten[preset][0] for preset in sorted(rewritten)]
+    if failed:
+      self._writer.discard(staged)
+      raise failed
+
+    try:
+      self._move_file(root, oldname, newname)
+    except BaseException:
+      self._writer.discard(staged)
+      raise
+    self._forget_sample(root, oldname)
+
+    try:
+      self._writer.publish(staged)
+    except safewrite.PublishError as e:
+      # Put back the presets we already replaced, then the file.
+      presets = sorted(rewritten)
+      for preset in presets[:len(e.published)]:
+        self._writer.write(self._preset_filename(root, preset), rewritten[preset][1])
+      for preset in presets:
+        self._invalidate(root, preset)
+      self._refindex.refresh(root, self)
+      shutil.move(newpath, self._format_clip_filename(root, oldname))
+      self._backups.rename(newpath, self._format_clip_filename(root, oldname))
+      raise RewriteError(presets[len(e.published)], e.err)
+    for preset, (_, _, clips) in rewritten.items():
+      self._invalidate(root, preset)
+      self._index_preset(root, preset, clips)
+
+    changed = []
+    for preset, coords_list in pending_coords.items():
+      for coords in coords_list:
+        pending[preset].repoint(coords, newname)
+        changed.append((preset, coords['track'], coords['clip']))
+    for preset, coords_list in by_preset.items():
+      changed.extend((preset, c['track'], c['clip']) for c in coords_list)
+    return sorted(changed)
+
+  def export_presets(self, root, order=None):
+    """Returns the presets export_v1 would export, in slot order."""
+    if order is not None:
+      return list(order)
+    presets = [p for p in self.list_presets(root) if not self.V1_MATCHER.match(p)]
+    return sorted(presets)[:self.V1_SLOTS]
+
+  def export_v1(self, root, order=None):
+    """Copies presets to the SE000001.XML style slots older firmwares read.
+
+    Only slots whose content differs are written, all together through the
+    writer, so exporting again after a small edit writes one file.  Slots
+    past the last exported preset are left alone, they may hold presets made
+    on the device.
+
+    Arguments:
+      order: preset names for slots 1 onwards, defaults to the first 12
+        presets by name (not counting the exported slots themselves)
+
+    Returns: a list of (slot filename, preset, whether it was written)
+
+    Raises:
+      TooManyPresets
+      FileNotFound
+      RewriteError
+    """
+    presets = self.export_presets(root, order)
+    if len(presets) > self.V1_SLOTS:
+      raise TooManyPresets(len(presets))
+    for preset in presets:
+      if not os.path.isfile(self._preset_filename(root, preset)):
+        raise FileNotFound(preset)
+
+    result = []
+    staged = []
+    try:
+      for i, preset in enumerate(presets):
+        slot = 'SE%06d.XML' % (i + 1)
+        data = self._read_preset(root, preset)
+        slot_path = os.path.join(root, slot)
+        try:
+          with open(slot_path, 'rb') as f:
+            unchanged = False
+            if os.fstat(f.fileno()).st_size == len(data):
+              old = f.read()
+              stats.incr('bytes.read', len(old))
+              unchanged = old == data
+        except FileNotFoundError:
+          unchanged = False
+        if not unchanged:
+          staged.append(self._writer.stage(slot_path, data))
+        result.append((slot, preset, not unchanged))
+    except BaseException:
+      self._writer.discard(staged)
+      raise
+    try:
+      self._writer.publish(staged)
+    except safewrite.PublishError as e:
+      raise RewriteError(os.path.basename(staged[len(e.published)].path), e.err)
+    return result
 
   def move_preset(self, root, preset_name, newname):
     preset_filename = self._preset_filename(root, preset_name)
     new_filename = self._preset_filename(root, newname)
     self._move_file(root, preset_filename, new_filename)
+    self._invalidate(root, preset_name)
+    self._refindex.remove_preset(root, preset_name)
+    self._index_preset(root, newname, self._get_clips(root, newname))
 
-  def repoint_clip(self, root, preset_name, coords, newname):
+  def repoint_clip(self, root, preset_name, coords, newname, txn=None):
     """Just repoint the file in the xml, don't move anything.
 
     Doesn't check for old filename in case it was wrong (case problem)
@@ -170,74 +644,241 @@ class Handler(object):
       # Only check for path existence if not blank
       if not self._file_exists(root, newname):
         raise FileNotFound(newname)
-    self._backup_preset(root, preset_name)
-
-    preset_filename = self._preset_filename(root, preset_name)
-    backup_filename = os.path.splitext(preset_filename)[0] + '.bak'
-
-    parser = xml.sax.make_parser()
-    with open(preset_filename, 'w') as out:
-      repointer = bbxml.BBXMLRepoint(parser, out, coords, newname)
-      repointer.parse(backup_filename)
-
-  def swap_clips(self, root, preset_name, this_coords, that_coords):
-    clips = self._get_clips(root, preset_name)
-    self._backup_preset(root, preset_name)
-    preset_filename = self._preset_filename(root, preset_name)
-    backup_filename = os.path.splitext(preset_filename)[0] + '.bak'
-    inter_filename = os.path.splitext(preset_filename)[0] + '.inter'
-
-    parser = xml.sax.make_parser()
-    with open(inter_filename, 'w') as out:
-      overwriter = bbxml.BBXMLOverwrite(
-          parser, out, this_coords,
-          clips[that_coords['track']][that_coords['clip']])
-      overwriter.parse(backup_filename)
-
-    with open(preset_filename, 'w') as out:
-      overwriter = bbxml.BBXMLOverwrite(
-          parser, out, that_coords,
-          clips[this_coords['track']][this_coords['clip']])
-      overwriter.parse(inter_filename)
-
-    os.remove(inter_filename)
-
-  def normalize_clip(self, root, preset_name, coords):
-    clipname = self.get_clip(root, preset_name, coords)
+    t = txn if txn is not None else self.begin(root, preset_name)
+    t.repoint(coords, newname)
+    if txn is None:
+      self.commit(root, preset_name, t)
+
+  def swap_clips(self, root, preset_name, this_coords, that_coords, txn=None):
+    t = txn if txn is not None else self.begin(root, preset_name)
+    t.swap(this_coords, that_coords)
+    if txn is None:
+      self.commit(root, preset_name, t)
+
+  def normalize_clip(self, root, preset_name, coords, txn=None):
+    clipname = self.get_clip(root, preset_name, coords, txn)
     if clipname is None:
       return
-    effector = effects.Effector(self._format_clip_filename(root, clipname))
+    effector = effects.Effector(self._format_clip_filename(root, clipname), self._backups,
+                                self._analysis)
     effector.normalize()
 
-  def normalize_preset(self, root, preset_name):
-    clips = self.get_clips_filenames(root, preset_name)
-    files = [self._format_clip_filename(root, c) for t in clips for c in t if c != '']
-    effects.normalize_preset(files)
+  def normalize_preset(self, root, preset_name, txn=None, progress=effects.print_progress,
+                       mode='peak', target=None, ceiling=-1.0):
+    """Normalizes all the clips in a preset.
 
-  def trim_clip(self, root, preset_name, coords):
-    clipname = self.get_clip(root, preset_name, coords)
+    A sample used by several slots is only normalized once.
+
+    Arguments:
+      progress: called as progress(phase, done, total, filename) after each
+        clip, see effects.normalize_preset
+      mode: 'peak' to boost every clip by the same amount, as far as the
+        loudest peak allows.  'lufs' or 'rms' to match the clips' loudness,
+        see effects.normalize_loudness.
+      target, ceiling: for the loudness modes, the loudness to aim for (None
+        for as loud as they can all get) and the highest peak in dBFS
+    """
+    clips = self.get_clips_filenames(root, preset_name, txn)
+    files = [self._format_clip_filename(root, c) for t in clips for c in t if c != '']
+    if mode == 'peak':
+      effects.normalize_preset(files, progress=progress, store=self._backups,
+                               cache=self._analysis)
+    else:
+      effects.normalize_loudness(files, target, ceiling, k_weighted=mode == 'lufs',
+                                 progress=progress, store=self._backups, cache=self._analysis)
+
+  def trim_clip(self, root, preset_name, coords, txn=None):
+    clipname = self.get_clip(root, preset_name, coords, txn)
     if clipname is None:
       return
-    effector = effects.Effector(self._format_clip_filename(root, clipname))
+    effector = effects.Effector(self._format_clip_filename(root, clipname), self._backups,
+                                self._analysis)
     effector.trim_to_zero_crossings()
 
-  def trim_all(self, root, preset_name):
-    clips = self.get_clips_filenames(root, preset_name)
+  def trim_all(self, root, preset_name, txn=None, progress=None):
+    """Trims every clip in a preset, progress as for normalize_preset."""
+    clips = self.get_clips_filenames(root, preset_name, txn)
     files = [self._format_clip_filename(root, c) for t in clips for c in t if c != '']
-    for f in files:
-      effector = effects.Effector(f)
+    for done, f in enumerate(files, 1):
+      effector = effects.Effector(f, self._backups, self._analysis)
       effector.trim_to_zero_crossings()
+      if progress:
+        progress('trimming', done, len(files), f)
 
-  def clip_to_mono(self, root, preset_name, coords):
-    clipname = self.get_clip(root, preset_name, coords)
+  def clip_to_mono(self, root, preset_name, coords, txn=None):
+    clipname = self.get_clip(root, preset_name, coords, txn)
     if clipname is None:
       return
-    effector = effects.Effector(self._format_clip_filename(root, clipname))
+    effector = effects.Effector(self._format_clip_filename(root, clipname), self._backups,
+                                self._analysis)
     effector.to_mono()
 
-  def undo_clip(self, root, preset_name, coords):
-    clipname = self.get_clip(root, preset_name, coords)
+  def undo_clip(self, root, preset_name, coords, txn=None, steps=1):
+    clipname = self.get_clip(root, preset_name, coords, txn)
+    if clipname is None:
+      return
+    effector = effects.Effector(self._format_clip_filename(root, clipname), self._backups,
+                                self._analysis)
+    effector.undo(steps)
+
+  def redo_clip(self, root, preset_name, coords, txn=None, steps=1):
+    clipname = self.get_clip(root, preset_name, coords, txn)
     if clipname is None:
       return
-    effector = effects.Effector(self._format_clip_filename(root, clipname))
-    effector.undo()
+    effector = effects.Effector(self._format_clip_filename(root, clipname), self._backups,
+                                self._analysis)
+    effector.redo(steps)
+
+  def clip_history(self, root, preset_name, coords, txn=None):
+    """Returns (versions, position) of the undo history of a clip.
+
+    See backups.BackupStore.history.
+    """
+    clipname = self.get_clip(root, preset_name, coords, txn)
+    if not clipname:
+      return ([], -1)
+    return self._backups.history(self._format_clip_filename(root, clipname))
+
+  def find_orphans(self, root, workers=8):
+    """Finds the WAVs on the card that no preset uses.
+
+    Walks the card in parallel and compares against the reference index.  Size
+    and duration only come from the file system and the WAV headers.
+
+    Returns: a list of Orphan sorted by filename, duration is None when the
+    header can't be read
+    """
+    self.refresh_index(root)
+    used = self._refindex.referenced(root)
+    unused = sorted((rel, size) for rel, size in cardfs.walk_files(root, cardfs.is_wav, workers)
+                    if refindex.sample_key(rel) not in used)
+
+    def duration(rel):
+      stats.incr('wav.probe')
+      try:
+        return effects.WavFile(os.path.join(root, rel)).duration()
+      except (OSError, effects.Error):
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      durations = list(pool.map(stats.bound(duration), [rel for rel, _ in unused]))
+    return [Orphan(rel, size, d) for (rel, size), d in zip(unused, durations)]
+
+  def summarize_presets(self, root, workers=8):
+    """Summarizes every preset on the card, for listing.
+
+    Slots come from the reference index.  Samples are only stat()ed and, if
+    they changed since last time, their WAV header read, in parallel.  What
+    was read is cached in the index, so a warm listing reads no WAV at all.
+
+    Returns: a list of PresetSummary sorted by name
+    """
+    self.refresh_index(root)
+    slots = collections.defaultdict(list)
+    for preset, _, _, filename in self._refindex.references(root):
+      slots[preset].append(filename.replace('\\', '/'))
+    cached = self._refindex.samples(root)
+
+    def probe(rel):
+      try:
+        st = os.stat(self._format_clip_filename(root, rel))
+      except OSError:
+        return None
+      old = cached.get(rel)
+      if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+        return old
+      stats.incr('wav.probe')
+      try:
+        duration = effects.WavFile(self._format_clip_filename(root, rel)).duration()
+      except (OSError, effects.Error):
+        duration = None
+      return (st.st_mtime_ns, st.st_size, duration)
+
+    samples = sorted(set(rel for rels in slots.values() for rel in rels))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      probes = dict(zip(samples, pool.map(stats.bound(probe), samples)))
+    self._refindex.update_samples(
+        root, {rel: p for rel, p in probes.items() if p is not None and cached.get(rel) != p},
+        [rel for rel, p in probes.items() if p is None and rel in cached])
+
+    summaries = []
+    for name in sorted(self.list_presets(root)):
+      rels = slots.get(name, [])
+      found = [probes[rel] for rel in set(rels) if probes[rel] is not None]
+      summaries.append(PresetSummary(
+          name, len(rels), sum(p[1] for p in found),
+          sum(p[2] for p in found if p[2] is not None),
+          sum(1 for rel in set(rels) if probes[rel] is None)))
+    return summaries
+
+  def find_case_mismatches(self, root, workers=8):
+    """Finds clips whose file only exists with a different case.
+
+    Scans the card once and compares every clip filename in every preset
+    against it, ignoring case and path separators.  Slots whose file is
+    missing altogether aren't included.
+
+    Returns: a list of CaseMismatch sorted by preset and slot
+    """
+    self.refresh_index(root)
+    exact = set()
+    by_key = collections.defaultdict(list)
+    for rel, _ in cardfs.walk_files(root, workers=workers):
+      exact.add(rel)
+      by_key[refindex.sample_key(rel)].append(rel)
+
+    mismatches = []
+    for preset, track, clip, filename in self._refindex.references(root):
+      if filename.replace('\\', '/').strip('/') in exact:
+        continue
+      candidates = sorted(by_key.get(refindex.sample_key(filename), []))
+      if candidates:
+        mismatches.append(CaseMismatch(preset, track, clip, filename, candidates))
+    return mismatches
+
+  def fix_case(self, root, mismatches):
+    """Repoints every unambiguous mismatch, writing each preset once.
+
+    Arguments:
+      mismatches: CaseMismatch list from find_case_mismatches, the ones with
+        more than one candidate are skipped
+
+    Returns: the list of CaseMismatch that were repointed
+    """
+    by_preset = collections.defaultdict(list)
+    for m in mismatches:
+      if len(m.candidates) == 1:
+        by_preset[m.preset].append(m)
+    fixed = []
+    txns = {}
+    for preset, preset_mismatches in sorted(by_preset.items()):
+      txn = txns[preset] = self.begin(root, preset)
+      for m in preset_mismatches:
+        txn.repoint({'track': m.track, 'clip': m.clip}, m.candidates[0])
+      fixed.extend(preset_mismatches)
+    self.commit_all(root, txns)
+    return fixed
+
+  def delete_sample(self, root, filename):
+    """Deletes a sample from the card, as long as no preset uses it.
+
+    Raises:
+      FileNotFound
+      SampleInUse
+      OSError
+    """
+    if not self._file_exists(root, filename):
+      raise FileNotFound(filename)
+    usage = self.sample_usage(root, filename)
+    if usage:
+      raise SampleInUse(filename, usage)
+    try:
+      self._writer.remove([self._format_clip_filename(root, filename)])
+    except safewrite.PublishError as e:
+      raise e.err
+    finally:
+      self._forget_sample(root, filename)
+
+  def audition(self, root, filenames):
+    """Returns an AuditionQueue over samples, given relative to root."""
+    return AuditionQueue([self._format_clip_filename(root, f) for f in filenames], self._player)
@@ -0,0 +1,332 @@
+import os
+import unittest
+
+import bbeditor.handlers as handlers
+import bbeditor.playback as playback
+import bbeditor.refindex as refindex
+import bbeditor.safewrite as safewrite
+import bbeditor.stats as stats
+import bbeditor.testutil as testutil
+
+
+class HandlerTest(testutil.CardTest):
+  def setUp(self):
+    super().setUp()
+    self._files = testutil.empty_clips()
+    self._files[0][0] = '130\\09\\KICK.WAV'
+    self._files[1][2] = '130\\09\\SNARE.WAV'
+    os.makedirs(os.path.join(self._root, '130', '09'))
+    for name in ('KICK.WAV', 'SNARE.WAV', 'HAT.WAV'):
+      open(os.path.join(self._root, '130', '09', name), 'wb').close()
+    self._write_preset('one', self._files)
+    self._h = self.make_handler(cache_size=2)
+
+  def _write_preset(self, name, filenames):
+    testutil.write_preset(self._root, name, filenames)
+
+  def test_cache_hits(self):
+    self.assertEqual(self._files, self._h.get_clips_filenames(self._root, 'one'))
+    self.assertEqual('130\\09\\KICK.WAV',
+                     self._h.get_clip(self._root, 'one', {'track': 0, 'clip': 0}))
+    self.assertEqual({'hits': 1, 'misses': 1, 'size': 1}, self._h.cache_stats())
+
+  def test_cache_external_change(self):
+    self._h.get_clips_filenames(self._root, 'one')
+    self._files[3][3] = '130\\09\\HAT.WAV'
+    self._write_preset('one', self._files)
+    # Make sure the identity changes even on coarse-mtime filesystems.
+    os.utime(os.path.join(self._root, 'one.xml'), ns=(0, 0))
+    self.assertEqual(self._files, self._h.get_clips_filenames(self._root, 'one'))
+    self.assertEqual(2, self._h.cache_stats()['misses'])
+
+  def test_cache_invalidated_by_writes(self):
+    coords = {'track': 3, 'clip': 3}
+    self._h.get_clips_filenames(self._root, 'one')
+    self._h.repoint_clip(self._root, 'one', coords, '130/09/HAT.WAV')
+    self.assertEqual('130\\09\\HAT.WAV', self._h.get_clip(self._root, 'one', coords))
+
+    self._h.swap_clips(self._root, 'one', coords, {'track': 0, 'clip': 0})
+    self.assertEqual('130\\09\\KICK.WAV', self._h.get_clip(self._root, 'one', coords))
+    self.assertEqual(3, self._h.cache_stats()['misses'])
+
+  def test_commit_patches_in_place(self):
+    filename = os.path.join(self._root, 'one.xml')
+    with open(filename, 'rb') as f:
+      before = f.read()
+    self._h.repoint_clip(self._root, 'one', {'track': 1, 'clip': 2}, '130/09/HAT.WAV')
+    with open(filename, 'rb') as f:
+      after = f.read()
+    self.assertEqual(before.replace(b'SNARE.WAV', b'HAT.WAV'), after)
+
+  def test_cache_eviction(self):
+    self._write_preset('two', self._files)
+    self._write_preset('three', self._files)
+    for name in ('one', 'two', 'three', 'one'):
+      self._h.get_clips_filenames(self._root, name)
+    self.assertEqual({'hits': 0, 'misses': 4, 'size': 2}, self._h.cache_stats())
+
+  def test_sample_usage(self):
+    self._write_preset('two', self._files)
+    self.assertEqual([('one', 0, 0, '130\\09\\KICK.WAV'), ('two', 0, 0, '130\\09\\KICK.WAV')],
+                     self._h.sample_usage(self._root, '130/09/kick.wav'))
+    # Nothing changed, so nothing is parsed again.
+    self.assertEqual(0, self._h.refresh_index(self._root))
+
+    # Our own writes keep the index current without a rescan.
+    self._h.repoint_clip(self._root, 'two', {'track': 0, 'clip': 0}, '130/09/HAT.WAV')
+    self.assertEqual(0, self._h.refresh_index(self._root))
+    self.assertEqual([('two', 0, 0, '130\\09\\HAT.WAV')],
+                     self._h.sample_usage(self._root, '130\\09\\HAT.WAV'))
+
+    os.remove(os.path.join(self._root, 'one.xml'))
+    self.assertEqual([], self._h.sample_usage(self._root, '130/09/KICK.WAV'))
+
+  def test_find_orphans(self):
+    os.makedirs(os.path.join(self._root, 'rec', 'deep'))
+    open(os.path.join(self._root, 'rec', 'deep', 'TAKE1.wav'), 'wb').close()
+    open(os.path.join(self._root, 'rec', 'notes.txt'), 'wb').close()
+    # Referenced in a different case, so still in use on FAT.
+    os.rename(os.path.join(self._root, '130', '09', 'KICK.WAV'),
+              os.path.join(self._root, '130', '09', 'kick.wav'))
+
+    orphans = self._h.find_orphans(self._root, workers=2)
+    self.assertEqual(['130/09/HAT.WAV', 'rec/deep/TAKE1.wav'], [o.filename for o in orphans])
+    self.assertEqual([0, 0], [o.size for o in orphans])
+    self.assertEqual([None, None], [o.duration for o in orphans])
+
+  def test_delete_sample(self):
+    with self.assertRaises(handlers.SampleInUse):
+      self._h.delete_sample(self._root, '130\\09\\KICK.WAV')
+    self._h.delete_sample(self._root, '130/09/HAT.WAV')
+    self.assertFalse(os.path.exists(os.path.join(self._root, '130', '09', 'HAT.WAV')))
+    with self.assertRaises(handlers.FileNotFound):
+      self._h.delete_sample(self._root, '130/09/HAT.WAV')
+
+  def test_delete_sample_forgets(self):
+    hat = os.path.join(self._root, '130', '09', 'HAT.WAV')
+    testutil.write_wav(hat, [100, -100])
+    removed = []
+    class RecordingWriter(safewrite.AtomicWriter):
+      def remove(self, paths):
+        removed.extend(paths)
+        super().remove(paths)
+    player = playback.Player(playback.NullBackend())
+    index = refindex.RefIndex(':memory:')
+    h = self.make_handler(ref_index=index, player=player, writer=RecordingWriter(safewrite.NONE))
+    player.decoded(hat)
+    index.update_samples(self._root, {'130/09/HAT.WAV': (1, 2, 0.5)})
+
+    h.delete_sample(self._root, '130\\09\\HAT.WAV')
+    self.assertEqual([hat], removed)
+    self.assertEqual(0, player.stats()['size'])
+    self.assertEqual({}, index.samples(self._root))
+
+  def test_rename_sample_card_wide(self):
+    other = testutil.empty_clips()
+    other[2][1] = '130/09/kick.wav'
+    other[3][3] = '130\\09\\SNARE.WAV'
+    self._write_preset('two', other)
+    self._h.get_clips_filenames(self._root, 'two')
+
+    changed = self._h.move_clip(self._root, 'one', {'track': 0, 'clip': 0}, 'drums/KICK.WAV')
+    self.assertEqual([('one', 0, 0), ('two', 2, 1)], changed)
+    self.assertTrue(os.path.isfile(os.path.join(self._root, 'drums', 'KICK.WAV')))
+    self.assertEqual('drums\\KICK.WAV', self._h.get_clip(self._root, 'two', {'track': 2, 'clip': 1}))
+    self.assertEqual('130\\09\\SNARE.WAV', self._h.get_clip(self._root, 'two', {'track': 3, 'clip': 3}))
+    self.assertEqual([], self._h.sample_usage(self._root, '130/09/KICK.WAV'))
+    self.assertEqual(2, len(self._h.sample_usage(self._root, 'drums/kick.wav')))
+
+  def test_rename_sample_pending(self):
+    self._write_preset('two', self._files)
+    txn = self._h.begin(self._root, 'one')
+    changed = self._h.rename_sample(self._root, '130/09/KICK.WAV', 'KICK.WAV', {'one': txn})
+    self.assertEqual([('one', 0, 0), ('two', 0, 0)], changed)
+    # The open transaction has the edit, the preset on disk doesn't yet.
+    self.assertEqual('KICK.WAV', self._h.get_clip(self._root, 'one', {'track': 0, 'clip': 0}, txn))
+    self.assertEqual('130\\09\\KICK.WAV', self._h.get_clip(self._root, 'one', {'track': 0, 'clip': 0}))
+    self.assertEqual('KICK.WAV', self._h.get_clip(self._root, 'two', {'track': 0, 'clip': 0}))
+
+  def test_rename_sample_all_or_nothing(self):
+    self._write_preset('two', self._files)
+    with open(os.path.join(self._root, 'two.xml'), 'a') as f:
+      f.write('<broken')
+    with open(os.path.join(self._root, 'one.xml')) as f:
+      before = f.read()
+    # Index the good preset first, the broken one only fails on rewrite.
+    self._h.refresh_index(self._root)
+    self._h._refindex.update_preset(self._root, 'two', self._files,
+                                    self._h.preset_stat(self._root, 'two'))
+
+    with self.assertRaises(handlers.RewriteError) as cm:
+      self._h.rename_sample(self._root, '130/09/KICK.WAV', 'KICK.WAV')
+    self.assertEqual('two', cm.exception.preset_name)
+    self.assertTrue(os.path.isfile(os.path.join(self._root, '130', '09', 'KICK.WAV')))
+    with open(os.path.join(self._root, 'one.xml')) as f:
+      self.assertEqual(before, f.read())
+    self.assertEqual(['one.xml', 'two.xml'],
+                     sorted(n for n in os.listdir(self._root) if n.endswith('.xml') or n.endswith('.tmp')))
+
+  def test_rename_sample_publish_fails(self):
+    class FailingWriter(safewrite.AtomicWriter):
+      """Fails after the first file of the first publish."""
+      failed = False
+
+      def publish(self, staged):
+        if self.failed:
+          return super().publish(staged)
+        self.failed = True
+        super().publish(staged[:1])
+        self.discard(staged[1:])
+        raise safewrite.PublishError([staged[0].path], OSError('card pulled'))
+
+    self._write_preset('two', self._files)
+    before = {}
+    for name in ('one', 'two'):
+      with open(os.path.join(self._root, '%s.xml' % name), 'rb') as f:
+        before[name] = f.read()
+    h = self.make_handler(writer=FailingWriter(safewrite.NONE))
+    with self.assertRaises(handlers.RewriteError) as cm:
+      h.rename_sample(self._root, '130/09/KICK.WAV', 'KICK.WAV')
+    self.assertEqual('two', cm.exception.preset_name)
+    self.assertTrue(os.path.isfile(os.path.join(self._root, '130', '09', 'KICK.WAV')))
+    for name in ('one', 'two'):
+      with open(os.path.join(self._root, '%s.xml' % name), 'rb') as f:
+        self.assertEqual(before[name], f.read())
+    self.assertEqual(['130', 'one.xml', 'two.xml'], sorted(os.listdir(self._root)))
+
+  def test_commit_all(self):
+    self._write_preset('two', self._files)
+    coords = {'track': 3, 'clip': 3}
+    txns = {name: self._h.begin(self._root, name) for name in ('one', 'two')}
+    for txn in txns.values():
+      txn.repoint(coords, '130/09/HAT.WAV')
+    self._h.commit_all(self._root, txns)
+    for name in ('one', 'two'):
+      self.assertEqual('130\\09\\HAT.WAV', self._h.get_clip(self._root, name, coords))
+    # No backup copies or temp files are left on the card.
+    self.assertEqual(['130', 'one.xml', 'two.xml'], sorted(os.listdir(self._root)))
+
+  def test_fix_case(self):
+    os.makedirs(os.path.join(self._root, 'Loops'))
+    for name in ('Loops/a.wav', 'Loops/B.WAV', 'Loops/b.wav'):
+      open(os.path.join(self._root, name), 'wb').close()
+    self._files[0][1] = '130\\09\\kick.WAV'
+    self._files[2][0] = 'loops\\A.WAV'
+    self._files[2][1] = 'LOOPS\\B.wav'
+    self._files[2][2] = 'loops\\GONE.WAV'
+    self._write_preset('one', self._files)
+    self._write_preset('two', self._files)
+
+    mismatches = self._h.find_case_mismatches(self._root, workers=2)
+    self.assertEqual([('one', 0, 1), ('one', 2, 0), ('one', 2, 1), ('two', 0, 1), ('two', 2, 0), ('two', 2, 1)],
+                     [(m.preset, m.track, m.clip) for m in mismatches])
+    self.assertEqual(['Loops/B.WAV', 'Loops/b.wav'], mismatches[2].candidates)
+
+    fixed = self._h.fix_case(self._root, mismatches)
+    self.assertEqual(4, len(fixed))
+    files = self._h.get_clips_filenames(self._root, 'two')
+    self.assertEqual('130\\09\\KICK.WAV', files[0][1])
+    self.assertEqual('Loops\\a.wav', files[2][0])
+    self.assertEqual('LOOPS\\B.wav', files[2][1])
+    self.assertEqual(2, len(self._h.find_case_mismatches(self._root)))
+
+  def test_play_clip_prefetches_neighbours(self):
+    for name in ('KICK.WAV', 'SNARE.WAV'):
+      testutil.write_wav(os.path.join(self._root, '130', '09', name), [1, 2, 3, 4])
+    backend = playback.NullBackend()
+    h = self.make_handler(player=playback.Player(backend))
+    h.play_clip(self._root, 'one', {'track': 0, 'clip': 0})
+    h._player.wait()
+    h._player.wait_prefetch()
+    self.assertEqual(b'\x01\x00\x02\x00\x03\x00\x04\x00', b''.join(backend.streams[0].data))
+    self.assertEqual({'hits': 0, 'misses': 2, 'size': 2, 'bytes': 16}, h.player_stats())
+
+    h.play_clip(self._root, 'one', {'track': 1, 'clip': 2})
+    self.assertEqual(1, h.player_stats()['hits'])
+    with self.assertRaises(handlers.NoClipError):
+      h.play_clip(self._root, 'one', {'track': 3, 'clip': 3})
+
+  def test_summarize_presets(self):
+    kick = os.path.join(self._root, '130', '09', 'KICK.WAV')
+    testutil.write_wav(kick, [0] * 96000)
+    files = testutil.empty_clips()
+    files[0][0] = files[2][2] = '130\\09\\KICK.WAV'
+    files[3][0] = '130\\09\\GONE.WAV'
+    self._write_preset('two', files)
+
+    one, two = self._h.summarize_presets(self._root)
+    size = os.path.getsize(kick)
+    # SNARE.WAV is empty, so it has a size but no duration.
+    self.assertEqual(handlers.PresetSummary('one', 2, size, 1.0, 0), one)
+    self.assertEqual(handlers.PresetSummary('two', 3, size, 1.0, 1), two)
+
+    # Warm, nothing is probed again until a sample changes.
+    before = stats.STATS.snapshot()['wav.probe']
+    self.assertEqual([one, two], self._h.summarize_presets(self._root))
+    self.assertEqual(before, stats.STATS.snapshot()['wav.probe'])
+    testutil.write_wav(kick, [0] * 48000)
+    os.utime(kick, ns=(0, 0))
+    self.assertEqual(0.5, self._h.summarize_presets(self._root)[0].duration)
+    self.assertEqual(before + 1, stats.STATS.snapshot()['wav.probe'])
+
+  def test_export_v1(self):
+    self._write_preset('two', self._files)
+    self.assertEqual([('SE000001.XML', 'one', True), ('SE000002.XML', 'two', True)],
+                     self._h.export_v1(self._root))
+    # The exported slots aren't exported themselves, and nothing changed.
+    self.assertEqual([('SE000001.XML', 'one', False), ('SE000002.XML', 'two', False)],
+                     self._h.export_v1(self._root))
+
+    self._h.repoint_clip(self._root, 'two', {'track': 3, 'clip': 3}, '130/09/HAT.WAV')
+    # Slot 2 already has the same content as one.
+    self.assertEqual([('SE000001.XML', 'two', True), ('SE000002.XML', 'one', False)],
+                     self._h.export_v1(self._root, ['two', 'one']))
+    with open(os.path.join(self._root, 'two.xml'), 'rb') as f:
+      with open(os.path.join(self._root, 'SE000001.XML'), 'rb') as g:
+        self.assertEqual(f.read(), g.read())
+    self.assertEqual([('SE000001.XML', 'one', True)], self._h.export_v1(self._root, ['one']))
+    # Slot 2 may be a preset made on the device, it isn't ours to remove.
+    self.assertTrue(os.path.exists(os.path.join(self._root, 'SE000002.XML')))
+
+    with self.assertRaises(handlers.FileNotFound):
+      self._h.export_v1(self._root, ['nope'])
+    with self.assertRaises(handlers.TooManyPresets):
+      self._h.export_v1(self._root, ['one'] * 13)
+
+  def test_undo_after_rename(self):
+    h = self.make_handler()
+    kick = os.path.join(self._root, '130', '09', 'KICK.WAV')
+    testutil.write_wav(kick, [1000, -1000, 2000, -2000])
+    coords = {'track': 0, 'clip': 0}
+    h.normalize_clip(self._root, 'one', coords)
+    h.move_clip(self._root, 'one', coords, 'drums/KICK.WAV')
+    self.assertEqual(2, len(h.clip_history(self._root, 'one', coords)[0]))
+    h.undo_clip(self._root, 'one', coords)
+    self.assertEqual([1000, -1000, 2000, -2000],
+                     testutil.read_wav(os.path.join(self._root, 'drums', 'KICK.WAV')))
+
+  def test_audition_queue(self):
+    got = [(f, e.__class__.__name__) for f, e in self._h.audition(self._root, ['130/09/HAT.WAV'])]
+    self.assertEqual([(os.path.join(self._root, '130/09/HAT.WAV'), 'WavFormatError')], got)
+
+  def test_audition_plays_through_player(self):
+    backend = playback.NullBackend()
+    player = playback.Player(backend)
+    h = self.make_handler(player=player)
+    for name in ('KICK.WAV', 'SNARE.WAV'):
+      testutil.write_wav(os.path.join(self._root, '130', '09', name), [1, 2, 3, 4])
+    files = ['130/09/KICK.WAV', '130/09/SNARE.WAV']
+    for filename, error in h.audition(self._root, files):
+      self.assertIsNone(error)
+      self.assertTrue(player.cached(filename))
+      h.play_file(filename)
+    player.wait()
+    self.assertEqual(2, len(backend.streams))
+    # The plays came from the cache.
+    self.assertGreaterEqual(player.stats()['hits'], 2)
+    h.close()
+    self.assertFalse(player.is_playing())
+
+
+if __name__ == "__main__":
+  unittest.main()
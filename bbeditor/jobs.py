@@ -0,0 +1,266 @@
+"""jobs.py
+Runs long operations in the background so the prompt stays usable.
+
+A job is a function that takes a progress callback, with the same signature
+the effects module uses: progress(phase, done, total, filename).  The callback
+records how far along the job is and is also where a cancel takes effect, so
+jobs stop between clips rather than halfway through one.
+
+A job takes a lock for every file it may write, the preset XML and each of
+its samples, so jobs on two presets that share a sample never write it at
+once.  Foreground commands take the same locks with try_lock(), which refuses
+rather than waits while a job has or wants one of them.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import threading
+import time
+
+import bbeditor.stats as stats
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class Cancelled(Error):
+  pass
+
+class NoSuchJob(Error):
+  def __init__(self, job_id):
+    self.job_id = job_id
+
+class Busy(Error):
+  """A lock is taken.  job is the active job that wants it, if any."""
+  def __init__(self, job):
+    self.job = job
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job(object):
+  """One background operation and how far along it is."""
+
+  def __init__(self, job_id, description, lock_keys):
+    self.id = job_id
+    self.description = description
+    self.lock_keys = frozenset(lock_keys)
+    self.state = QUEUED
+    self.phase = ''
+    self.done = 0
+    self.total = 0
+    self.filename = ''
+    self.error = None
+    self.started = None
+    self.finished = None
+    self._phase_started = None
+    self._cancel = threading.Event()
+
+  def progress(self, phase, done, total, filename):
+    """Progress callback for the job's function.
+
+    Raises:
+      Cancelled: if the job was cancelled, to stop the function
+    """
+    if phase != self.phase:
+      self._phase_started = time.monotonic()
+    self.phase = phase
+    self.done = done
+    self.total = total
+    self.filename = filename
+    if self._cancel.is_set():
+      raise Cancelled()
+
+  def cancel(self):
+    self._cancel.set()
+
+  def cancelled(self):
+    return self._cancel.is_set()
+
+  def is_active(self):
+    return self.state in (QUEUED, RUNNING)
+
+  def throughput(self):
+    """Returns clips per second in the current phase, or None if unknown."""
+    if self._phase_started is None or not self.done:
+      return None
+    elapsed = time.monotonic() - self._phase_started
+    if elapsed <= 0:
+      return None
+    return self.done / elapsed
+
+  def describe(self):
+    text = '[%d] %s: %s' % (self.id, self.description, self.state)
+    if self.state == RUNNING and self.total:
+      text += ', %s %d/%d' % (self.phase, self.done, self.total)
+      rate = self.throughput()
+      if rate is not None:
+        text += ' (%.1f clips/s)' % rate
+    if self.state == FAILED:
+      text += ': %s' % (str(self.error) or self.error.__class__.__name__)
+    return text
+
+
+class JobQueue(object):
+  """Runs jobs on a pool of worker threads.
+
+  Arguments:
+    workers: how many jobs run at once
+    keep: how many finished jobs to remember for jobs()
+  """
+
+  def __init__(self, workers=2, keep=20):
+    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    self._keep = keep
+    self._jobs = collections.OrderedDict()
+    self._next_id = 1
+    self._lock = threading.Lock()
+    self._key_locks = collections.defaultdict(threading.Lock)
+    self._reported = set()
+
+  def _locks(self, keys):
+    # Always in the same order, so two jobs can't each wait on the other.
+    with self._lock:
+      return [self._key_locks[key] for key in sorted(set(keys))]
+
+  @contextlib.contextmanager
+  def lock(self, keys):
+    """Holds the locks for keys (files, presets...) for the duration."""
+    with contextlib.ExitStack() as stack:
+      for key_lock in self._locks(keys):
+        stack.enter_context(key_lock)
+      yield
+
+  @contextlib.contextmanager
+  def try_lock(self, keys):
+    """Like lock(), but doesn't wait.
+
+    Raises:
+      Busy: if an active job wants any of the keys, or they are taken
+    """
+    job = self.busy(keys)
+    if job is not None:
+      raise Busy(job)
+    with contextlib.ExitStack() as stack:
+      for key_lock in self._locks(keys):
+        if not key_lock.acquire(blocking=False):
+          raise Busy(self.busy(keys))
+        stack.callback(key_lock.release)
+      yield
+
+  def submit(self, description, func, lock_keys=()):
+    """Queues func(progress) to run in the background.
+
+    Arguments:
+      description: shown by jobs()
+      func: called with the job's progress callback
+      lock_keys: jobs sharing a key never run at the same time
+
+    Returns: the Job
+    """
+    with self._lock:
+      job = Job(self._next_id, description, lock_keys)
+      self._next_id += 1
+      self._jobs[job.id] = job
+      self._forget_finished()
+    self._pool.submit(self._run, job, func)
+    return job
+
+  def _run(self, job, func):
+    if job.cancelled():
+      job.state = CANCELLED
+      return
+    with self.lock(job.lock_keys):
+      if job.cancelled():
+        job.state = CANCELLED
+        return
+      job.state = RUNNING
+      job.started = time.time()
+      try:
+        # Counted on its own, not as part of whatever the prompt runs meanwhile.
+        with stats.command(job.description):
+          func(job.progress)
+        job.state = DONE
+      except Cancelled:
+        job.state = CANCELLED
+      except Exception as e:
+        job.error = e
+        job.state = FAILED
+      finally:
+        job.finished = time.time()
+
+  def _forget_finished(self):
+    finished = [j.id for j in self._jobs.values() if not j.is_active()]
+    for job_id in finished[:max(0, len(finished) - self._keep)]:
+      del self._jobs[job_id]
+      self._reported.discard(job_id)
+
+  def jobs(self):
+    """Returns all running, queued and recently finished jobs, oldest first."""
+    with self._lock:
+      return list(self._jobs.values())
+
+  def active(self):
+    return [j for j in self.jobs() if j.is_active()]
+
+  def take_finished(self):
+    """Returns the jobs that finished since the last call, oldest first."""
+    with self._lock:
+      finished = [j for j in self._jobs.values()
+                  if not j.is_active() and j.id not in self._reported]
+      self._reported.update(j.id for j in finished)
+      return finished
+
+  def get(self, job_id):
+    """Raises: NoSuchJob"""
+    with self._lock:
+      if job_id not in self._jobs:
+        raise NoSuchJob(job_id)
+      return self._jobs[job_id]
+
+  def cancel(self, job_id):
+    """Asks a job to stop.  Queued jobs never start, running ones stop after
+    the clip they are on.
+
+    Raises: NoSuchJob
+    """
+    job = self.get(job_id)
+    job.cancel()
+    if job.state == QUEUED:
+      job.state = CANCELLED
+
+  def busy(self, keys):
+    """Returns an active job holding or waiting on any of keys, or None."""
+    keys = set(keys)
+    for job in self.active():
+      if job.lock_keys & keys:
+        return job
+    return None
+
+  def status_line(self):
+    """One line about the active jobs, for a toolbar."""
+    return '  '.join(j.describe() for j in self.active())
+
+  def wait(self, timeout=None):
+    """Waits until no job is active, or the timeout passes.
+
+    Returns: True if no job is active
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while self.active():
+      if deadline is not None and time.monotonic() > deadline:
+        return False
+      time.sleep(0.01)
+    return True
+
+  def shutdown(self, cancel=True):
+    if cancel:
+      for job in self.active():
+        job.cancel()
+    self._pool.shutdown(wait=True)
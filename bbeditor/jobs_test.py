@@ -0,0 +1,110 @@
+import threading
+import unittest
+
+import bbeditor.jobs as jobs
+import bbeditor.stats as stats
+
+
+class JobQueueTest(unittest.TestCase):
+  def setUp(self):
+    self._q = jobs.JobQueue(workers=2)
+
+  def tearDown(self):
+    self._q.shutdown()
+
+  def test_progress_and_done(self):
+    def work(progress):
+      for i in range(1, 4):
+        progress('applying', i, 3, 'clip%d.wav' % i)
+    job = self._q.submit('normall one', work, lock_keys=['one'])
+    self.assertTrue(self._q.wait(5))
+    self.assertEqual((jobs.DONE, 'applying', 3, 3), (job.state, job.phase, job.done, job.total))
+    self.assertEqual('[1] normall one: done', job.describe())
+    self.assertEqual([job], self._q.take_finished())
+    self.assertEqual([], self._q.take_finished())
+
+  def test_cancel_running(self):
+    started = threading.Event()
+    go = threading.Event()
+    def work(progress):
+      progress('trimming', 1, 16, 'a.wav')
+      started.set()
+      go.wait(5)
+      progress('trimming', 2, 16, 'b.wav')
+      self.fail('should have been cancelled')
+    job = self._q.submit('trimall one', work, lock_keys=['one'])
+    started.wait(5)
+    self.assertIn('trimming 1/16', self._q.status_line())
+    self._q.cancel(job.id)
+    go.set()
+    self._q.wait(5)
+    self.assertEqual(jobs.CANCELLED, job.state)
+    with self.assertRaises(jobs.NoSuchJob):
+      self._q.cancel(99)
+
+  def test_same_preset_serialised(self):
+    release = threading.Event()
+    started = threading.Event()
+    order = []
+    def slow(progress):
+      order.append('slow start')
+      started.set()
+      release.wait(5)
+      order.append('slow end')
+    def fast(progress):
+      order.append('fast')
+    first = self._q.submit('normall one', slow, lock_keys=['one'])
+    started.wait(5)
+    second = self._q.submit('trimall one', fast, lock_keys=['one'])
+    self.assertIs(first, self._q.busy(['one', 'x']))
+    self.assertIsNone(self._q.busy(['two']))
+    release.set()
+    self._q.wait(5)
+    self.assertEqual(['slow start', 'slow end', 'fast'], order)
+    self.assertEqual((jobs.DONE, jobs.DONE), (first.state, second.state))
+
+  def test_shared_key_serialised(self):
+    release = threading.Event()
+    started = threading.Event()
+    def slow(progress):
+      started.set()
+      release.wait(5)
+    job = self._q.submit('normall one', slow, lock_keys=['one.xml', 'kick.wav'])
+    started.wait(5)
+    with self.assertRaises(jobs.Busy) as cm:
+      with self._q.try_lock(['two.xml', 'kick.wav']):
+        self.fail('should be busy')
+    self.assertIs(job, cm.exception.job)
+    with self._q.try_lock(['two.xml', 'snare.wav']):
+      pass
+    release.set()
+    self._q.wait(5)
+    with self._q.try_lock(['two.xml', 'kick.wav']):
+      pass
+
+  def test_counted_on_its_own(self):
+    started = threading.Event()
+    go = threading.Event()
+    def work(progress):
+      stats.incr('test.job')
+      started.set()
+      go.wait(5)
+    with stats.command('prompt counted'):
+      self._q.submit('trimall counted', work, lock_keys=['counted'])
+      self.assertTrue(started.wait(5))
+      stats.incr('test.prompt')
+    go.set()
+    self.assertTrue(self._q.wait(5))
+    self.assertEqual({'test.prompt': 1}, dict(stats.STATS.commands['prompt counted']['counters']))
+    self.assertEqual({'test.job': 1}, dict(stats.STATS.commands['trimall counted']['counters']))
+
+  def test_failure(self):
+    def work(progress):
+      raise ValueError('bad clip')
+    job = self._q.submit('normall one', work)
+    self._q.wait(5)
+    self.assertEqual('[1] normall one: failed: bad clip', job.describe())
+
+
+if __name__ == "__main__":
+  unittest.main()
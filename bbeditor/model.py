@@ -0,0 +1,123 @@
+"""model.py
+Compact, immutable clip data for a preset.
+
+A Preset is 4 Tracks of 4 Clips.  All three are immutable tuples, so a parsed
+preset can be shared freely (between the preset cache, transactions and
+callers) without copying.  Changing a clip builds a new Preset that shares
+every untouched track and clip with the old one.
+
+Clip attributes that are numbers in the XML are held as ints, slices as an
+array of ints.  Empty slots all share EMPTY_CLIP.
+"""
+import array
+import collections
+
+# The clip attributes we know about, in the order the BitBox writes them.
+ATTRS = ('reverse', 'file', 'slicemode', 'trigtype', 'start', 'length', 'level',
+         'quant', 'loop', 'pitch', 'filename', 'slize', 'midimode')
+
+
+def _parse_value(value):
+  """Attribute values are ints, except for filename and anything unexpected."""
+  try:
+    return int(value)
+  except ValueError:
+    return value
+
+
+def make_slices(positions):
+  """Returns slice positions as a read-only-by-convention array of ints."""
+  return array.array('i', (int(p) for p in positions))
+
+
+class Clip(collections.namedtuple('Clip', ATTRS + ('slices', 'extra'))):
+  """One clip slot.
+
+  Attributes are named as in the XML.  slices is an array of ints, which
+  must not be modified in place.  extra is a tuple of (name, value) pairs for
+  attributes this version doesn't know about, so they survive edits.
+  """
+  __slots__ = ()
+
+  @classmethod
+  def from_attrs(cls, attrs, slices=()):
+    """Builds a Clip from XML attributes (strings) and slice positions."""
+    known = {}
+    extra = []
+    for k, v in attrs.items():
+      if k in ATTRS:
+        known[k] = v if k == 'filename' else _parse_value(v)
+      elif k != 'slices':
+        extra.append((k, v))
+    return EMPTY_CLIP._replace(slices=make_slices(slices), extra=tuple(extra), **known)
+
+  def is_empty(self):
+    return not self.filename
+
+  def attrs(self):
+    """Returns every attribute as it would be written to the XML.
+
+    Values are strings, except 'slices' which is a list of ints.
+    """
+    d = {k: str(getattr(self, k)) for k in ATTRS}
+    d.update(self.extra)
+    d['slices'] = list(self.slices)
+    return d
+
+  def with_attrs(self, attrs):
+    """Returns a copy with some attributes replaced, in the form attrs() returns."""
+    known = {}
+    extra = dict(self.extra)
+    for k, v in attrs.items():
+      if k == 'slices':
+        known[k] = make_slices(v)
+      elif k == 'filename':
+        known[k] = v
+      elif k in ATTRS:
+        known[k] = _parse_value(v) if isinstance(v, str) else v
+      else:
+        extra[k] = v
+    return self._replace(extra=tuple(extra.items()), **known)
+
+
+EMPTY_CLIP = Clip(reverse=0, file=0, slicemode=0, trigtype=0, start=0, length=0, level=0,
+                  quant=0, loop=0, pitch=0, filename='', slize=0, midimode=0,
+                  slices=array.array('i'), extra=())
+
+
+class Track(tuple):
+  """The 4 clips of one track."""
+  __slots__ = ()
+
+
+class Preset(tuple):
+  """The 4 tracks of a preset, index as preset[track][clip]."""
+  __slots__ = ()
+
+  @classmethod
+  def empty(cls):
+    return EMPTY_PRESET
+
+  @classmethod
+  def from_clips(cls, clips):
+    """Builds a Preset from a 4x4 nested sequence of Clips."""
+    return cls(Track(track) for track in clips)
+
+  def clip(self, coords):
+    return self[coords['track']][coords['clip']]
+
+  def with_clip(self, coords, clip):
+    """Returns a new Preset with one clip replaced, sharing everything else."""
+    t, c = coords['track'], coords['clip']
+    track = self[t]
+    tracks = list(self)
+    tracks[t] = Track(track[:c] + (clip,) + track[c + 1:])
+    return Preset(tracks)
+
+  def filenames(self):
+    """Returns a new 4x4 list of the clip filenames, '' for empty slots."""
+    return [[clip.filename for clip in track] for track in self]
+
+
+EMPTY_TRACK = Track((EMPTY_CLIP,) * 4)
+EMPTY_PRESET = Preset((EMPTY_TRACK,) * 4)
@@ -0,0 +1,54 @@
+import unittest
+
+
+import bbeditor.model as model
+
+
+class ModelTest(unittest.TestCase):
+  def setUp(self):
+    self.clip = model.Clip.from_attrs(
+        {'filename': '130\\09\\KICK.WAV', 'level': '400', 'slize': '4', 'polymode': '2'},
+        ['0', '512'])
+    self.preset = model.EMPTY_PRESET.with_clip({'track': 1, 'clip': 2}, self.clip)
+
+  def test_from_attrs(self):
+    self.assertEqual(400, self.clip.level)
+    self.assertEqual(0, self.clip.pitch)
+    self.assertEqual([0, 512], list(self.clip.slices))
+    self.assertEqual((('polymode', '2'),), self.clip.extra)
+    self.assertFalse(self.clip.is_empty())
+    self.assertTrue(model.EMPTY_CLIP.is_empty())
+
+  def test_attrs_round_trip(self):
+    attrs = self.clip.attrs()
+    self.assertEqual('400', attrs['level'])
+    self.assertEqual('2', attrs['polymode'])
+    self.assertEqual([0, 512], attrs['slices'])
+    self.assertEqual(self.clip, model.EMPTY_CLIP.with_attrs(attrs))
+
+  def test_no_instance_dict(self):
+    with self.assertRaises(AttributeError):
+      self.clip.__dict__
+    with self.assertRaises(AttributeError):
+      self.preset.__dict__
+
+  def test_with_clip_shares_untouched(self):
+    self.assertIs(self.clip, self.preset.clip({'track': 1, 'clip': 2}))
+    self.assertIs(model.EMPTY_TRACK, self.preset[0])
+    self.assertIs(model.EMPTY_CLIP, self.preset[1][0])
+    # The original is unchanged.
+    self.assertIs(model.EMPTY_CLIP, model.EMPTY_PRESET[1][2])
+
+    louder = self.preset.with_clip({'track': 3, 'clip': 0}, self.clip.with_attrs({'level': '800'}))
+    self.assertIs(self.preset[1], louder[1])
+    self.assertEqual(800, louder[3][0].level)
+    self.assertEqual(400, self.preset.clip({'track': 1, 'clip': 2}).level)
+
+  def test_filenames(self):
+    names = self.preset.filenames()
+    self.assertEqual('130\\09\\KICK.WAV', names[1][2])
+    self.assertEqual(['', '', '', ''], names[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,384 @@
+"""playback.py
+Streams clips to an audio output without blocking the prompt.
+
+Clips are decoded once to 16 bit PCM and kept in an LRU bounded by bytes, so
+playing a clip again, or one that was prefetched, starts straight away.  A
+new play() stops whatever is playing.
+
+Output goes through a backend.  FfplayBackend pipes raw PCM into ffplay and
+keeps a spare ffplay process started, so there is no process startup on the
+next play.  NullBackend and FileBackend are sinks for testing and headless
+use.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import wave
+
+import numpy
+
+import bbeditor.effects as effects
+import bbeditor.stats as stats
+
+log = logging.getLogger(__name__)
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class NoBackend(Error):
+  pass
+
+
+# pcm is interleaved signed 16 bit little endian bytes.
+DecodedClip = collections.namedtuple('DecodedClip', ['pcm', 'rate', 'channels'])
+
+
+def decode_clip(filename):
+  """Reads a wav file as 16 bit PCM, ready to stream.
+
+  16 bit files are passed through as they are, everything else is converted.
+
+  Raises:
+    effects.WavFormatError
+  """
+  wav = effects.WavFile(filename)
+  if wav.frames == 0:
+    return DecodedClip(b'', wav.rate, wav.channels)
+  stats.incr('wav.decode')
+  if wav.width == 2 and not wav.is_float:
+    with open(filename, 'rb') as f:
+      f.seek(wav.data_offset)
+      pcm = f.read(wav.frames * wav.block_align)
+    stats.incr('bytes.read', len(pcm))
+    return DecodedClip(pcm, wav.rate, wav.channels)
+  scale = 32768.0 / wav.max_possible_amplitude()
+  out = []
+  for block in wav.blocks():
+    out.append(numpy.clip(numpy.rint(block * scale), -32768, 32767).astype('<i2').tobytes())
+  return DecodedClip(b''.join(out), wav.rate, wav.channels)
+
+
+class NullStream(object):
+  def __init__(self, rate, channels):
+    self.rate = rate
+    self.channels = channels
+    self.data = []
+    self.aborted = False
+
+  def write(self, data):
+    self.data.append(bytes(data))
+
+  def drain(self):
+    pass
+
+  def abort(self):
+    self.aborted = True
+
+
+class NullBackend(object):
+  """Discards the audio, but keeps every stream for inspection."""
+
+  def __init__(self):
+    self.streams = []
+
+  def open(self, rate, channels):
+    stream = NullStream(rate, channels)
+    self.streams.append(stream)
+    return stream
+
+  def close(self):
+    pass
+
+
+class FileStream(object):
+  def __init__(self, filename, rate, channels):
+    self._wav = wave.open(filename, 'wb')
+    self._wav.setnchannels(channels)
+    self._wav.setsampwidth(2)
+    self._wav.setframerate(rate)
+
+  def write(self, data):
+    self._wav.writeframes(data)
+
+  def drain(self):
+    self._wav.close()
+
+  def abort(self):
+    # The streaming thread stops at the next chunk and closes the file.
+    pass
+
+
+class FileBackend(object):
+  """Writes what would have been played to a wav file, the last play wins."""
+
+  def __init__(self, filename):
+    self._filename = filename
+
+  def open(self, rate, channels):
+    return FileStream(self._filename, rate, channels)
+
+  def close(self):
+    pass
+
+
+class FfplayStream(object):
+  def __init__(self, proc):
+    self._proc = proc
+
+  def write(self, data):
+    self._proc.stdin.write(data)
+
+  def drain(self):
+    """Waits for ffplay to finish playing."""
+    self._proc.stdin.close()
+    self._proc.wait()
+
+  def abort(self):
+    self._proc.kill()
+    self._proc.wait()
+
+
+class FfplayBackend(object):
+  """Plays through an ffplay process reading raw PCM from stdin.
+
+  Starting ffplay takes a noticeable moment, so a spare process is kept
+  running for the last format used and handed out on the next open().
+  """
+
+  def __init__(self, ffplay=None):
+    self._ffplay = ffplay or shutil.which('ffplay')
+    if not self._ffplay:
+      raise NoBackend('ffplay not found')
+    self._spare = None
+    self._lock = threading.Lock()
+
+  def _start(self, rate, channels):
+    args = [self._ffplay, '-nodisp', '-autoexit', '-loglevel', 'quiet',
+            '-f', 's16le', '-ar', str(rate), '-ac', str(channels), '-i', '-']
+    return subprocess.Popen(args, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  def open(self, rate, channels):
+    with self._lock:
+      spare, self._spare = self._spare, None
+      if spare is not None and (spare[0] != (rate, channels) or spare[1].poll() is not None):
+        spare[1].kill()
+        spare[1].wait()
+        spare = None
+      proc = spare[1] if spare is not None else self._start(rate, channels)
+      self._spare = ((rate, channels), self._start(rate, channels))
+    return FfplayStream(proc)
+
+  def close(self):
+    with self._lock:
+      if self._spare is not None:
+        self._spare[1].kill()
+        self._spare[1].wait()
+        self._spare = None
+
+
+def default_backend():
+  """Returns an FfplayBackend if ffplay is installed, else a NullBackend."""
+  try:
+    return FfplayBackend()
+  except NoBackend:
+    log.warning('ffplay not found, playback is silent')
+    return NullBackend()
+
+
+class Player(object):
+  """Plays one clip at a time in the background, with a cache of decoded clips.
+
+  Arguments:
+    backend: where the audio goes, defaults to default_backend(), created on
+      first play
+    cache_bytes: how much decoded PCM to keep
+    chunk_frames: how much to write to the backend at a time, which is also
+      how quickly a stop takes effect
+  """
+
+  def __init__(self, backend=None, cache_bytes=128 * 1024 * 1024, chunk_frames=4096):
+    self._backend = backend
+    self._cache_bytes = cache_bytes
+    self._chunk_frames = chunk_frames
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+    self._play_lock = threading.Lock()
+    self._thread = None
+    self._stream = None
+    self._stop = None
+
+    self._prefetcher = None
+    self._prefetching = None
+    self._generation = 0
+
+  def _identity(self, filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+  def _lookup(self, filename, identity):
+    with self._lock:
+      entry = self._entries.get(filename)
+      if entry is not None and entry[0] == identity:
+        self._entries.move_to_end(filename)
+        return entry[1]
+    return None
+
+  def _store(self, filename, identity, clip):
+    with self._lock:
+      old = self._entries.pop(filename, None)
+      if old is not None:
+        self._bytes -= len(old[1].pcm)
+      if len(clip.pcm) > self._cache_bytes:
+        return
+      self._entries[filename] = (identity, clip)
+      self._bytes += len(clip.pcm)
+      while self._bytes > self._cache_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self._bytes -= len(evicted.pcm)
+
+  def decoded(self, filename):
+    """Returns the DecodedClip for a file, from the cache if it hasn't changed.
+
+    Raises:
+      OSError
+      effects.WavFormatError
+    """
+    identity = self._identity(filename)
+    clip = self._lookup(filename, identity)
+    if clip is not None:
+      with self._lock:
+        self.hits += 1
+      return clip
+    with self._lock:
+      self.misses += 1
+    clip = decode_clip(filename)
+    self._store(filename, identity, clip)
+    return clip
+
+  def forget(self, filename):
+    """Drops a file's decoded clip, eg because the file is gone."""
+    with self._lock:
+      entry = self._entries.pop(filename, None)
+      if entry is not None:
+        self._bytes -= len(entry[1].pcm)
+
+  def cached(self, filename):
+    try:
+      return self._lookup(filename, self._identity(filename)) is not None
+    except OSError:
+      return False
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+              'bytes': self._bytes}
+
+  def _stream_clip(self, clip, stream, stop):
+    chunk = self._chunk_frames * clip.channels * 2
+    pcm = memoryview(clip.pcm)
+    try:
+      for start in range(0, len(pcm), chunk):
+        if stop.is_set():
+          break
+        stream.write(pcm[start:start + chunk])
+      stream.drain()
+    except (OSError, ValueError):
+      # The output went away, most likely stop() killed it.
+      pass
+
+  def play(self, filename):
+    """Stops whatever is playing and starts playing filename.
+
+    Returns as soon as playback has started.
+
+    Raises:
+      OSError
+      effects.WavFormatError
+    """
+    clip = self.decoded(filename)
+    with self._play_lock:
+      self._stop_locked()
+      if self._backend is None:
+        self._backend = default_backend()
+      self._stop = threading.Event()
+      self._stream = self._backend.open(clip.rate, clip.channels)
+      self._thread = threading.Thread(target=self._stream_clip,
+                                      args=(clip, self._stream, self._stop), daemon=True)
+      self._thread.start()
+
+  def _stop_locked(self):
+    if self._thread is None:
+      return
+    self._stop.set()
+    self._stream.abort()
+    self._thread.join()
+    self._thread = None
+    self._stream = None
+
+  def stop(self):
+    """Stops playing, if anything is."""
+    with self._play_lock:
+      self._stop_locked()
+
+  def is_playing(self):
+    thread = self._thread
+    return thread is not None and thread.is_alive()
+
+  def wait(self, timeout=None):
+    """Waits for the current clip to finish."""
+    thread = self._thread
+    if thread is not None:
+      thread.join(timeout)
+
+  def prefetch(self, filenames):
+    """Decodes files into the cache in the background, in order.
+
+    Replaces any prefetch that is still pending, so the latest call wins.
+
+    Returns: a Future that is done when this prefetch is
+    """
+    with self._lock:
+      self._generation += 1
+      generation = self._generation
+      if self._prefetcher is None:
+        self._prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def run():
+      for filename in filenames:
+        if self._generation != generation:
+          return
+        try:
+          if not self.cached(filename):
+            self.decoded(filename)
+        except (OSError, effects.Error):
+          pass
+    future = self._prefetcher.submit(run)
+    self._prefetching = future
+    return future
+
+  def wait_prefetch(self, timeout=None):
+    """Waits for the latest prefetch to finish."""
+    future = self._prefetching
+    if future is not None:
+      concurrent.futures.wait([future], timeout)
+
+  def close(self):
+    self.stop()
+    with self._lock:
+      self._generation += 1
+      prefetcher, self._prefetcher = self._prefetcher, None
+    if prefetcher is not None:
+      prefetcher.shutdown(wait=True)
+    if self._backend is not None:
+      self._backend.close()
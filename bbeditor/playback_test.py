@@ -0,0 +1,120 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+
+import bbeditor.playback as playback
+import bbeditor.testutil as testutil
+
+
+class BlockingStream(object):
+  """A stream that stalls after the first write until aborted."""
+
+  def __init__(self):
+    self.written = 0
+    self.aborted = threading.Event()
+    self.started = threading.Event()
+
+  def write(self, data):
+    self.written += len(data)
+    self.started.set()
+    self.aborted.wait()
+    raise OSError('aborted')
+
+  def drain(self):
+    pass
+
+  def abort(self):
+    self.aborted.set()
+
+
+class BlockingBackend(object):
+  def __init__(self):
+    self.streams = []
+
+  def open(self, rate, channels):
+    self.streams.append(BlockingStream())
+    return self.streams[-1]
+
+  def close(self):
+    pass
+
+
+class PlaybackTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _wav(self, name, samples, channels=2):
+    filename = os.path.join(self._dir, name)
+    testutil.write_wav(filename, samples, channels=channels)
+    return filename
+
+  def test_decode_16bit_passthrough(self):
+    clip = playback.decode_clip(self._wav('a.wav', [1, -2, 300, -400]))
+    self.assertEqual((48000, 2), (clip.rate, clip.channels))
+    self.assertEqual(struct.pack('<4h', 1, -2, 300, -400), clip.pcm)
+
+  def test_decode_24bit(self):
+    filename = os.path.join(self._dir, 'a.wav')
+    testutil.write_raw_wav(filename, testutil.pack_24([256, -8388608, 8388607]), 1, 24)
+    clip = playback.decode_clip(filename)
+    self.assertEqual(struct.pack('<3h', 1, -32768, 32767), clip.pcm)
+
+  def test_play_to_file(self):
+    out = os.path.join(self._dir, 'out.wav')
+    player = playback.Player(playback.FileBackend(out), chunk_frames=3)
+    player.play(self._wav('a.wav', list(range(-10, 10))))
+    player.wait()
+    self.assertEqual(list(range(-10, 10)), testutil.read_wav(out))
+
+  def test_play_interrupts(self):
+    backend = BlockingBackend()
+    player = playback.Player(backend)
+    player.play(self._wav('a.wav', [1] * 20000))
+    backend.streams[0].started.wait(5)
+    player.play(self._wav('b.wav', [2] * 20000))
+    self.assertTrue(backend.streams[0].aborted.is_set())
+    self.assertFalse(backend.streams[1].aborted.is_set())
+    player.stop()
+    self.assertFalse(player.is_playing())
+
+  def test_cache_is_bounded_by_bytes(self):
+    player = playback.Player(playback.NullBackend(), cache_bytes=1000)
+    a = self._wav('a.wav', [0] * 200)
+    b = self._wav('b.wav', [0] * 200)
+    big = self._wav('big.wav', [0] * 1000)
+    player.decoded(a)
+    player.decoded(b)
+    player.decoded(a)
+    self.assertEqual({'hits': 1, 'misses': 2, 'size': 2, 'bytes': 800}, player.stats())
+    # Too big to cache at all, and evicts nothing.
+    player.decoded(big)
+    self.assertEqual(2, player.stats()['size'])
+    c = self._wav('c.wav', [0] * 200)
+    player.decoded(c)
+    self.assertFalse(player.cached(b))
+    self.assertTrue(player.cached(a))
+
+  def test_cache_sees_changes(self):
+    player = playback.Player(playback.NullBackend())
+    a = self._wav('a.wav', [1, 1])
+    player.decoded(a)
+    self._wav('a.wav', [2, 2, 2, 2])
+    os.utime(a, ns=(0, 0))
+    self.assertEqual(struct.pack('<4h', 2, 2, 2, 2), player.decoded(a).pcm)
+
+  def test_prefetch(self):
+    player = playback.Player(playback.NullBackend())
+    names = [self._wav('%d.wav' % i, [i, i]) for i in range(3)]
+    player.prefetch(names + [os.path.join(self._dir, 'missing.wav')]).result()
+    self.assertTrue(all(player.cached(n) for n in names))
+    player.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -10,16 +10,24 @@ It also looks like state belongs in the handler, not here.
 
 """
 import fnmatch
+import functools
 import glob
 import os.path
 import re
-import shutil
+import threading
+import time
 
 from prompt_toolkit import prompt
-from prompt_toolkit.completion import Completer, Completion
+from prompt_toolkit.completion import Completer, Completion, ThreadedCompleter
 from prompt_toolkit.history import FileHistory
 
+import bbeditor.backups as backups
+import bbeditor.effects as effects
 import bbeditor.handlers as handlers
+import bbeditor.jobs as jobs
+import bbeditor.safewrite as safewrite
+import bbeditor.staging as staging
+import bbeditor.stats as stats
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -28,49 +36,295 @@ class Error(Exception):
 class InvalidCoordinates(Error):
   pass
 
+def parse_coords(text):
+  """Parses a comma-separated pair of ints and does valiation.
+
+  Returns: a tuple of two ints, or None on error
+
+  Throws: InvalidCoordinates if it looks like coordinates but is invalid.
+  """
+  coords = text.split(',')
+  if len(coords) != 2:
+    return None
+
+  (track_num, clip_num) = (0, 0)
+  try:
+    track_num = int(coords[0])
+    clip_num = int(coords[1])
+  except ValueError:
+    return None
+
+  if track_num < 0 or track_num > 3:
+    raise InvalidCoordinates(text)
+  if clip_num < 0 or clip_num > 3:
+    raise InvalidCoordinates(text)
+
+  return {'track': track_num, 'clip': clip_num}
+
+def parse_normall(text):
+  """Parses the argument of normall.
+
+  Either nothing, for peak normalizing, or 'lufs' or 'rms' with an optional
+  target loudness, like 'lufs -16'.
+
+  Returns: a dict of keyword arguments for Handler.normalize_preset
+
+  Throws: ValueError if it doesn't parse
+  """
+  words = text.split()
+  if not words:
+    return {'mode': 'peak'}
+  if words[0] not in ('lufs', 'rms') or len(words) > 2:
+    raise ValueError(text)
+  options = {'mode': words[0]}
+  if len(words) == 2:
+    options['target'] = float(words[1])
+  return options
+
+def parse_command(text):
+  """Takes a raw command and returns a dictionary to describe it.
+
+  Commands are of the form:
+    [command] (coords...) (string argument)
+
+  Where coords are zero or more int pairs like '3,4' (no quotes needed).
+
+  If the coords are out of bounds they won't be returned, which could cause
+  problems for things like: norm 3,6 because it'll just return norm and
+  operate on the current clip.
+
+  Returns:
+    dict: {
+      'command':  the command specified
+      'coords': a List of coordinates, usually one
+      'arg': a List of remaining arguments
+    }
+  """
+  command = {
+    'command': '',
+    'coords': [],
+    'arg': '',
+  }
+
+  found_cmd = False
+  found_noncoord = False
+  while text:
+    space_idx = text.find(' ')
+    if space_idx == -1:
+      t = text
+      text = ''
+    else:
+      t = text[:space_idx]
+      text = text[space_idx + 1:]
+
+    if not t.strip():
+      continue
+
+    if not found_cmd:
+      command['command'] = t.strip()
+      found_cmd = True
+      continue
+
+    try:
+      coords = parse_coords(t)
+    except InvalidCoordinates:
+      return {
+          'command': '',
+          'coords': [],
+          'arg': '',
+        }
+    if coords is not None:
+      if found_noncoord:
+        # Coords after args are invalid.
+        return {
+          'command': '',
+          'coords': [],
+          'arg': '',
+        }
+      command['coords'].append(coords)
+      continue
+
+    if found_noncoord:
+      continue
+
+    found_noncoord = True
+    command['arg'] = t
+    if text:
+      command['arg'] += ' ' + text
+  return command
+
+
+class CompletionIndex(object):
+  """In-memory index of preset names and occupied slots, for completion.
+
+  Lookups only ever read what is already in memory.  All disk access happens on
+  a background thread, which relists the presets whenever the mtime of the root
+  changes and loads the slots of any preset that was asked for but isn't known
+  yet.  Call invalidate() after anything that may have changed a preset.
+  """
+
+  def __init__(self, handler, interval=1.0):
+    self._handler = handler
+    self._interval = interval
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._root = None
+    self._root_mtime = None
+    self._presets = []
+    self._slots = {}
+    self._wanted = set()
+    self._thread = None
+
+  def start(self):
+    """Starts the background refresh thread."""
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, daemon=True)
+      self._thread.start()
+
+  def set_root(self, root):
+    with self._lock:
+      if root == self._root:
+        return
+      self._root = root
+      self._root_mtime = None
+      self._presets = []
+      self._slots = {}
+      self._wanted = set()
+    self._wake.set()
+
+  def presets(self):
+    with self._lock:
+      return list(self._presets)
+
+  def slots(self, preset):
+    """Returns the occupied 'x,y' slots of preset, or [] if not loaded yet."""
+    with self._lock:
+      if preset in self._slots:
+        return self._slots[preset]
+      self._wanted.add(preset)
+    self._wake.set()
+    return []
+
+  def invalidate(self, preset=None):
+    """Forgets a preset's slots (or all of them) and relists the root."""
+    with self._lock:
+      if preset is None:
+        self._wanted.update(self._slots)
+        self._slots = {}
+      elif preset in self._slots:
+        del self._slots[preset]
+        self._wanted.add(preset)
+      self._root_mtime = None
+    self._wake.set()
+
+  def refresh(self):
+    """Brings the index up to date.  Does disk I/O, so don't call from the UI."""
+    with self._lock:
+      root = self._root
+      known_mtime = self._root_mtime
+      wanted = set(self._wanted)
+    if root is None:
+      return
+
+    try:
+      mtime = os.stat(root).st_mtime_ns
+      presets = None
+      if mtime != known_mtime:
+        presets = sorted(self._handler.list_presets(root))
+      slots = {}
+      for preset in wanted:
+        try:
+          files = self._handler.get_clips_filenames(root, preset)
+        except Exception:
+          files = []
+        slots[preset] = ['%d,%d' % (x, y)
+                         for x, track in enumerate(files)
+                         for y, clip in enumerate(track) if clip]
+    except OSError:
+      return
+
+    with self._lock:
+      if root != self._root:
+        return
+      if presets is not None:
+        self._presets = presets
+        self._root_mtime = mtime
+      self._slots.update(slots)
+      self._wanted -= set(slots)
+
+  def _run(self):
+    while True:
+      self._wake.wait(self._interval)
+      self._wake.clear()
+      self.refresh()
+
+
 class BBCompleter(Completer):
   """Handles completions for commands.
 
-  Needs access to the parent prompt for certain operations, and has its own Handler when it
-  needs access to information about the preset.
+  Needs access to the parent prompt for certain operations.  Everything it
+  offers comes from the prompt's CompletionIndex, so it never touches the disk.
   """
 
   def __init__(self, prompt):
     self._prompt = prompt
-    self._handler = handlers.Handler()
+    self._index = prompt.get_completion_index()
 
   def get_completions(self, document, complete_event):
     command = self._prompt.parse_command(document.current_line_before_cursor)
     # Completion for choosing a new preset
     if command['command'] == 'c':
       if command['arg']:
-        for p in self._prompt.list_presets():
+        for p in self._index.presets():
           if p.startswith(command['arg']):
             yield Completion(p, start_position=0-len(command['arg']))
     # Completion for specifying coordinates
     elif not command['coords'] and self._prompt.get_cur_preset():
-      root = self._prompt.get_root()
       preset = self._prompt.get_cur_preset()
       # Match partial coordinates
       coord_matcher = re.compile(r'[0-3],?$')
       if coord_matcher.match(command['arg']):
-        for x, track in enumerate(self._handler.get_clips_filenames(root, preset)):
-          for y, clip in enumerate(track):
-            coords = '%d,%d' % (x,y)
-            # If this slot has a clip in it and it matches the partial coordinates, offer completion
-            if clip and coords.startswith(command['arg']):
-              yield Completion(coords, start_position=0-len(command['arg']))
+        for coords in self._index.slots(preset):
+          # If this slot has a clip in it and it matches the partial coordinates, offer completion
+          if coords.startswith(command['arg']):
+            yield Completion(coords, start_position=0-len(command['arg']))
 
 
 class Prompt(object):
   XML_MATCHER = re.compile(fnmatch.translate('*.xml'), re.IGNORECASE)
-
-  def __init__(self, herstory_file):
+  # Commands that change the current preset or its clips.  Not allowed while
+  # a background job works on the same preset or any of its samples.
+  WRITE_COMMANDS = ('f', 'm', 's', 'norm', 'trim', 'mono', 'undo', 'redo')
+  # Commands that may touch any file on the card, or switch to another one.
+  # Not allowed while any background job runs.
+  CARD_COMMANDS = ('dir', 'r', 'fixcase', 'orphans', 'exportv1', 'stage', 'sync')
+  # Commands that may change presets other than the current one, or which
+  # presets there are.  The completion index forgets everything after them.
+  INDEX_COMMANDS = ('dir', 'r', 'fixcase', 'exportv1', 'stage')
+
+  def __init__(self, herstory_file, profile_dir=None, durability=safewrite.BATCH,
+               compress_backups=False):
+    """profile_dir: if given, a cProfile of each command is written there.
+    durability: the safewrite policy presets are written with.
+    compress_backups: whether to compress the clip versions kept for undo.
+    """
     self._herstory = FileHistory(herstory_file)
-    self._handler = handlers.Handler()
+    self._profile_dir = profile_dir
+    self._durability = durability
+    self._handler = handlers.Handler(
+        writer=safewrite.AtomicWriter(durability),
+        backup_store=backups.BackupStore(compress=compress_backups))
+    # The staging.Mirror being edited instead of the card, see stage.
+    self._mirror = None
+    # The preset order for exportv1, None for the first 12 by name.
+    self._export_order = None
+    self._index = CompletionIndex(self._handler)
+    self._jobs = jobs.JobQueue()
+    # The preset each background job works on, by job id.
+    self._job_presets = {}
 
     self._root = None
-    for l in reversed(self._herstory):
+    for l in self._history_strings():
       command = self.parse_command(l)
       if command['command'] == 'dir':
         path = self.handle_dir(command)
@@ -81,6 +335,14 @@ class Prompt(object):
         break
     self._cur_preset = None
     self._cur_clip = {'track': None, 'clip':None}
+    self._completer = ThreadedCompleter(BBCompleter(self))
+
+  def _history_strings(self):
+    """Returns the command history, most recent first."""
+    if hasattr(self._herstory, 'load_history_strings'):
+      # prompt_toolkit >= 2 no longer supports reversed() on a history.
+      return list(self._herstory.load_history_strings())
+    return list(reversed(self._herstory))
 
   def get_root(self):
     return self._root
@@ -88,18 +350,77 @@ class Prompt(object):
   def get_cur_preset(self):
     return self._cur_preset
 
+  def get_handler(self):
+    return self._handler
+
+  def get_completion_index(self):
+    return self._index
+
+  def get_jobs(self):
+    return self._jobs
+
   def do_prompt(self):
     """Returns false if asked to quit."""
 
-    text = prompt('bitbox-editor (? for help) > ', history=self._herstory, completer=BBCompleter(self))
+    self._index.set_root(self._root)
+    self._index.start()
+    self.report_finished_jobs()
+    # Only show the toolbar while something runs in the background.
+    toolbar = self._jobs.status_line if self._jobs.active() else None
+    text = prompt('bitbox-editor (? for help) > ', history=self._herstory, completer=self._completer,
+                  bottom_toolbar=toolbar, refresh_interval=0.5)
     command = self.parse_command(text)
+    preset = self._cur_preset
+    if command['command'] == 'stats':
+      # Don't let looking at the stats count as the last command.
+      running = self.run_command(command)
+    else:
+      with stats.command(command['command'] or '?', self._profile_dir):
+        running = self.run_command(command)
+    self.invalidate_index(command, preset)
+    return running
+
+  def report_finished_jobs(self):
+    """Prints the jobs that finished, the index forgets the presets they wrote."""
+    for job in self._jobs.take_finished():
+      print (job.describe())
+      preset = self._job_presets.pop(job.id, None)
+      if preset is not None:
+        self._index.invalidate(preset)
+
+  def invalidate_index(self, command, preset):
+    """Lets the completion index catch up with what command wrote.
+
+    preset: the current preset when command started
+    """
+    if command['command'] in self.INDEX_COMMANDS:
+      self._index.invalidate()
+    elif command['command'] in self.WRITE_COMMANDS and preset is not None:
+      self._index.invalidate(preset)
 
+  def run_command(self, command):
+    """Runs one parsed command.  Returns false if asked to quit."""
     if command['command'] == '?':
       self.help()
       return True
     elif command['command'] == 'q':
+      self._handler.stop_playback()
+      self._warn_unsynced()
+      active = self._jobs.active()
+      if active:
+        print ('Cancelling %d background job(s)' % len(active))
+      self._jobs.shutdown()
+      self._handler.close()
       return False
-    elif command['command'] == 'dir':
+
+    if command['command'] in self.CARD_COMMANDS and self._jobs.active():
+      print ('Wait for the background jobs to finish first, see jobs')
+      return True
+
+    if command['command'] == 'dir':
+      self._warn_unsynced()
+      self._mirror = None
+      self._export_order = None
       self._root = self.handle_dir(command)
       return True
 
@@ -114,17 +435,58 @@ class Prompt(object):
       return True
 
     if command['command'] == 'l':
-      print ('Presets in %s:' % self._root)
-      print ('\n'.join(self.list_presets()))
+      self.show_presets()
       return True
     if command['command'] == 'exportv1':
-      self.export_v1()
+      self.export_v1(command)
+      return True
+    if command['command'] == 'uses':
+      self.show_sample_usage(command)
+      return True
+    if command['command'] == 'orphans':
+      self.handle_orphans(command)
+      return True
+    if command['command'] == 'fixcase':
+      self.handle_fixcase()
+      return True
+    if command['command'] == 'jobs':
+      self.show_jobs()
+      return True
+    if command['command'] == 'stats':
+      self.show_stats(command)
+      return True
+    if command['command'] == 'cancel':
+      self.cancel_job(command)
+      return True
+    if command['command'] == 'stage':
+      self.handle_stage(command)
+      return True
+    if command['command'] == 'sync':
+      self.handle_sync(command)
       return True
 
     if not self._cur_preset:
       print ('Please choose a preset with c')
       return True
 
+    keys = []
+    if command['command'] in self.WRITE_COMMANDS:
+      keys = self._handler.lock_keys(self._root, self._cur_preset)
+    try:
+      with self._jobs.try_lock(keys):
+        self._run_preset_command(command)
+    except jobs.Busy as e:
+      print ('%s is busy with a background job, wait for it or cancel it:' % self._cur_preset)
+      if e.job is not None:
+        print (e.job.describe())
+      return True
+
+    self.show_current_preset()
+
+    return True
+
+  def _run_preset_command(self, command):
+    """Runs a command on the current preset."""
     if command['command'] == 'p':
       self._cur_clip = self._choose_clip(command)
       if self._cur_clip is not None:
@@ -143,148 +505,81 @@ class Prompt(object):
         self._handler.normalize_clip(self._root, self._cur_preset, self._cur_clip)
         self.play_current_clip()
     elif command['command'] == 'normall':
-      self._handler.normalize_preset(self._root, self._cur_preset)
+      try:
+        options = parse_normall(command['arg'])
+      except ValueError:
+        print ('Expected nothing, or lufs or rms and an optional target, like: normall lufs -16')
+      else:
+        name = ' '.join(['normall', command['arg']]).strip()
+        self.start_job(name, functools.partial(self._handler.normalize_preset, **options))
     elif command['command'] == 'trim':
       self._cur_clip = self._choose_clip(command)
       if self._cur_clip is not None:
         self._handler.trim_clip(self._root, self._cur_preset, self._cur_clip)
         self.play_current_clip()
     elif command['command'] == 'trimall':
-      self._handler.trim_all(self._root, self._cur_preset)
+      self.start_job('trimall', self._handler.trim_all)
     elif command['command'] == 'mono':
       self._cur_clip = self._choose_clip(command)
       if self._cur_clip is not None:
         self._handler.clip_to_mono(self._root, self._cur_preset, self._cur_clip)
         self.play_current_clip()
     elif command['command'] == 'undo':
+      self.handle_undo(command, self._handler.undo_clip)
+    elif command['command'] == 'redo':
+      self.handle_undo(command, self._handler.redo_clip)
+    elif command['command'] == 'history':
       self._cur_clip = self._choose_clip(command)
       if self._cur_clip is not None:
-        self._handler.undo_clip(self._root, self._cur_preset, self._cur_clip)
-        self.play_current_clip()
+        self.show_clip_history()
     else:
       self.help()
 
-    self.show_current_preset()
-
-    return True
-
   def help(self):
     print ('Known commands:')
     print ('')
     print ('  dir      # set which dir the bitbox files are in')
-    print ('  l        # list presets')
+    print ('  l        # list presets with their clip count, size, length and missing files')
     print ('  c        # choose current preset by name')
     print ('  m        # move preset to new name')
     print ('  p        # play a clip for the current preset: X,Y')
     print ('  f        # fix a clip with a bad filename')
-    print ('  r        # rename clip, specify coords and new name (can include subdir)')
+    print ('  r        # rename clip, specify coords and new name (can include subdir),')
+    print ('           #   every preset using the file is repointed')
     print ('  s        # swap clips, specify two sets of coords: 0,0 1,2')
     print ('  norm     # Normalize a single clip')
-    print ('  normall  # Normalize a whole preset by an equal amount per clip')
+    print ('  normall  # Normalize a whole preset by an equal amount per clip,')
+    print ('           #   or "normall lufs" / "normall rms" to match their loudness,')
+    print ('           #   optionally to a target: normall lufs -16')
     print ('  trim     # trim start and end of clip to zero crossings for better looping (EXPERIMENTAL)')
     print ('  trimall  # trim all clips in preset (EXPERIMENTAL)')
-    print ('  mono     # convert to mono (BROKEN in pydub master)')
-    print ('  undo     # restore a clip from its most recent backup')
+    print ('  mono     # convert to mono by averaging the channels')
+    print ('  undo     # restore an earlier version of a clip, optionally N steps back: 0,0 3')
+    print ('  redo     # re-apply an undone edit to a clip, optionally N steps')
+    print ('  history  # list the saved versions of a clip')
+    print ('  orphans  # list recordings no preset uses, "orphans play" to audition and delete them')
+    print ('  uses     # list every preset and slot that uses a sample: 0,0 or a filename')
+    print ('  fixcase  # repoint every clip whose file only exists with a different case')
+    print ('  jobs     # list background jobs (normall and trimall run in the background)')
+    print ('  cancel   # cancel a background job by number: cancel 1')
+    print ('  stage    # edit a local copy of the card\'s presets and the samples they use,')
+    print ('           #   "stage all" copies every file, "stage off" goes back to the card')
+    print ('  sync     # write what changed in the local copy back to the card,')
+    print ('           #   "sync force" even if those files changed on the card too')
+    print ('  stats    # show timings and counts of XML parses, WAV decodes and bytes read/written,')
+    print ('           #   "stats reset" to start over')
     print ('  exportv1 # Export the first 12 xml files in the directory as old-style ' +
-           'SE000001.xml presets for use on older firmwares')
+           'SE000001.xml presets for use on older firmwares,')
+    print ('           #   or the presets you list in slot order: exportv1 Whatever, My Track 1')
+    print ('           #   The order is remembered, "exportv1 -" goes back to by name')
+    print ('           #   Only slots that changed are written')
     print ('  q        # quit')
 
   def _parse_coords(self, text):
-    """Parses a comma-separated pair of ints and does valiation.
-
-    Returns: a tuple of two ints, or None on error
-
-    Throws: InvalidCoordinates if it looks like coordinates but is invalid.
-    """
-    coords = text.split(',')
-    if len(coords) != 2:
-      return None
-
-    (track_num, clip_num) = (0, 0)
-    try:
-      track_num = int(coords[0])
-      clip_num = int(coords[1])
-    except ValueError:
-      return None
-
-    if track_num < 0 or track_num > 3:
-      raise InvalidCoordinates(text)
-    if clip_num < 0 or clip_num > 3:
-      raise InvalidCoordinates(text)
-
-    return {'track': track_num, 'clip': clip_num}
+    return parse_coords(text)
 
   def parse_command(self, text):
-    """Takes a raw command and returns a dictionary to describe it.
-
-    Commands are of the form:
-      [command] (coords...) (string argument)
-
-    Where coords are zero or more int pairs like '3,4' (no quotes needed).
-
-    If the coords are out of bounds they won't be returned, which could cause
-    problems for things like: norm 3,6 because it'll just return norm and
-    operate on the current clip.
-
-    Returns:
-      dict: {
-        'command':  the command specified
-        'coords': a List of coordinates, usually one
-        'arg': a List of remaining arguments
-      }
-    """
-    command = {
-      'command': '',
-      'coords': [],
-      'arg': '',
-    }
-
-    found_cmd = False
-    found_noncoord = False
-    while text:
-      space_idx = text.find(' ')
-      if space_idx == -1:
-        t = text
-        text = ''
-      else:
-        t = text[:space_idx]
-        text = text[space_idx + 1:]
-
-      if not t.strip():
-        continue
-
-      if not found_cmd:
-        command['command'] = t.strip()
-        found_cmd = True
-        continue
-
-      try:
-        coords = self._parse_coords(t)
-      except InvalidCoordinates:
-        return {
-            'command': '',
-            'coords': [],
-            'arg': '',
-          }
-      if coords is not None:
-        if found_noncoord:
-          # Coords after args are invalid.
-          return {
-            'command': '',
-            'coords': [],
-            'arg': '',
-          }
-        command['coords'].append(coords)
-        continue
-
-      if found_noncoord:
-        continue
-
-      found_noncoord = True
-      command['arg'] = t
-      if text:
-        command['arg'] += ' ' + text
-    return command
+    return parse_command(text)
 
   def handle_dir(self, command):
     """Parses out which directory the user specified and returns it.
@@ -305,11 +600,21 @@ class Prompt(object):
 
   def list_presets(self):
     """Return all the files in the root with .xml extensions"""
-    xmls = []
-    for f in os.listdir(self._root):
-      if self.XML_MATCHER.match(f):
-        xmls.append(os.path.splitext(os.path.basename(f))[0])
-    return xmls
+    return self._handler.list_presets(self._root)
+
+  def show_presets(self):
+    """Lists the presets with their clip count, size, length and missing files."""
+    print ('Presets in %s:' % self._root)
+    summaries = self._handler.summarize_presets(self._root)
+    if not summaries:
+      return
+    width = max(len(s.name) for s in summaries)
+    for s in summaries:
+      line = ' %-*s  %2d clips  %7.1f MB  %5d:%02d' % (
+          width, s.name, s.clips, s.bytes / (1024.0 * 1024), s.duration // 60, s.duration % 60)
+      if s.missing:
+        line += '  %d missing' % s.missing
+      print (line)
 
   def play_current_clip(self):
     try:
@@ -318,8 +623,9 @@ class Prompt(object):
       print ('No clip at that position')
     except handlers.FileNotFound as e:
       print ('File not found: %s' % e.filename)
-      print ('(Case sensitive issue?  Try fix)')
-      return
+      print ('(Case sensitive issue?  Try fix, or fixcase for the whole card)')
+    except effects.WavFormatError as e:
+      print ('Could not play %s: %s' % (e.filename, e.reason))
 
   def show_current_preset(self):
     """Lists clips in given preset"""
@@ -336,14 +642,33 @@ class Prompt(object):
           print (' ', end='')
         print ('%d,%d: %s' % (tracknum, clipnum, clips[tracknum][clipnum]))
 
-  def export_v1(self):
-    xmls = [f for f in os.listdir(self._root) if self.XML_MATCHER.match(f)]
-    for i, f in enumerate(sorted(xmls)[:12]):
-      print ("exporting" + f)
-      oldpath = os.path.join(self._root, f)
-      newpath = os.path.join(self._root, 'SE%06d.XML' % (i + 1))
-      print ('Copying %s to %s' % (oldpath, newpath))
-      shutil.copy(oldpath, newpath)
+  def export_v1(self, command):
+    """Exports presets as SE000001.XML... for older firmwares.
+
+    The argument is an optional comma separated list of presets in slot
+    order, which is remembered for the next export this session once it
+    worked.  '-' goes back to the first 12 by name.
+    """
+    order = self._export_order
+    if command['arg'] == '-':
+      order = None
+    elif command['arg']:
+      order = [p.strip() for p in command['arg'].split(',') if p.strip()]
+    try:
+      exported = self._handler.export_v1(self._root, order)
+    except handlers.TooManyPresets as e:
+      print ('Only %d slots, got %d presets' % (handlers.Handler.V1_SLOTS, e.count))
+      return
+    except handlers.FileNotFound as e:
+      print ("Didn't find preset: '%s'" % e.filename)
+      return
+    except handlers.RewriteError as e:
+      print ('Could not write %s: %s' % (e.preset_name, e.err))
+      return
+    self._export_order = order
+    for slot, preset, written in exported:
+      print (' %s  %s%s' % (slot, preset, '' if written else '  (unchanged)'))
+    print ('Wrote %d of %d slots' % (sum(1 for e in exported if e[2]), len(exported)))
 
   def choose_preset(self, command):
     """Parses text and extracts preset name
@@ -443,7 +768,8 @@ class Prompt(object):
   def handle_rename(self, command):
     """Rename clip filename on disk.
 
-    Unlike fix above, this renames the file on disk as well as updates the XML.
+    Unlike fix above, this renames the file on disk as well as updates the XML,
+    of this preset and every other preset that uses the file.
     """
     def print_error():
       print ('Expected coordinates and new filename, like: 0,0 foo/bar/baz.wav')
@@ -462,7 +788,9 @@ class Prompt(object):
 
     newname = command['arg']
     try:
-      self._handler.move_clip(self._root, self._cur_preset, self._cur_clip, newname)
+      changed = self._handler.move_clip(self._root, self._cur_preset, self._cur_clip, newname)
+      presets = set(preset for preset, _, _ in changed)
+      print ('Repointed %d slot(s) in %d preset(s)' % (len(changed), len(presets)))
     except handlers.NoClipError:
       print ('No clip at that position')
     except handlers.FileNotFound as e:
@@ -473,6 +801,217 @@ class Prompt(object):
       print ('Error creating dir for %s: %s' % (e.path, e.err))
     except handlers.FileMoveError as e:
       print ('Error moving file: %s' % e.err)
+    except handlers.RewriteError as e:
+      print ('Error rewriting preset %s, nothing was changed: %s' % (e.preset_name, e.err))
+
+  def show_sample_usage(self, command):
+    """Lists the presets and slots using a sample, given by filename or coords."""
+    if command['arg']:
+      filename = command['arg']
+    elif self._cur_preset is None:
+      print ('Expected a filename, or choose a preset with c and give coordinates')
+      return
+    else:
+      self._cur_clip = self._choose_clip(command)
+      if self._cur_clip is None:
+        return
+      filename = self._handler.get_clip(self._root, self._cur_preset, self._cur_clip)
+
+    usage = self._handler.sample_usage(self._root, filename)
+    if not usage:
+      print ('No presets use %s' % filename)
+      return
+    print ('Presets using %s:' % filename)
+    for preset, track, clip, name in usage:
+      print (' %s %d,%d: %s' % (preset, track, clip, name))
+
+  def handle_orphans(self, command):
+    """Lists samples that no preset uses, and optionally auditions them.
+
+    With the argument 'play', plays each one and asks whether to delete it.
+    """
+    if command['arg'] not in ('', 'play'):
+      print ('Expected nothing or "play", like: orphans play')
+      return
+    orphans = self._handler.find_orphans(self._root)
+    if not orphans:
+      print ('No orphaned recordings')
+      return
+    for o in orphans:
+      duration = '?' if o.duration is None else '%.1fs' % o.duration
+      print (' %s  %d KB  %s' % (o.filename, o.size // 1024, duration))
+    print ('%d orphaned recordings, %d MB' % (len(orphans), sum(o.size for o in orphans) // (1024 * 1024)))
+    if command['arg'] == 'play':
+      self.audition_orphans([o.filename for o in orphans])
+
+  def start_job(self, name, op):
+    """Runs op(root, preset, progress=...) on the current preset in the background."""
+    root, preset = self._root, self._cur_preset
+    job = self._jobs.submit('%s %s' % (name, preset),
+                            lambda progress: op(root, preset, progress=progress),
+                            lock_keys=self._handler.lock_keys(root, preset))
+    self._job_presets[job.id] = preset
+    print ('Started job %d, see jobs' % job.id)
+
+  def _warn_unsynced(self):
+    if self._mirror is None:
+      return
+    changed, deleted = self._mirror.changes()
+    if changed or deleted:
+      print ('%d change(s) in %s are not synced to the card, stage it again to sync them'
+             % (len(changed) + len(deleted), self._mirror.root))
+
+  def handle_stage(self, command):
+    """Switches to editing a local copy of the card, or back with "stage off"."""
+    if command['arg'] not in ('', 'all', 'off'):
+      print ('Expected nothing, "all" or "off", like: stage all')
+      return
+    if command['arg'] == 'off':
+      if self._mirror is None:
+        print ('Not staging')
+        return
+      changed, deleted = self._mirror.changes()
+      if changed or deleted:
+        print ('%d change(s) not synced yet, sync first' % (len(changed) + len(deleted)))
+        return
+      self._root = self._mirror.card_root
+      self._mirror = None
+      print ('Editing the card in %s again' % self._root)
+      return
+    if self._mirror is not None:
+      changed, deleted = self._mirror.changes()
+      print ('Staging %s in %s, %d change(s) not synced'
+             % (self._mirror.card_root, self._mirror.root, len(changed) + len(deleted)))
+      return
+
+    mirror = staging.Mirror(self._root, writer=safewrite.AtomicWriter(self._durability))
+    copied = mirror.pull(self._handler, everything=command['arg'] == 'all')
+    print ('Copied %d file(s) to %s' % (len(copied), mirror.root))
+    print ('Edits now go to the local copy, use sync to write them to the card')
+    self._mirror = mirror
+    self._root = mirror.root
+
+  def handle_sync(self, command):
+    """Writes the changes in the local copy back to the card."""
+    if self._mirror is None:
+      print ('Not staging, see stage')
+      return
+    if command['arg'] not in ('', 'force'):
+      print ('Expected nothing or "force", like: sync force')
+      return
+    try:
+      written, deleted = self._mirror.sync(force=command['arg'] == 'force')
+    except staging.Conflict as e:
+      print ('Not syncing, these changed on the card too (sync force to overwrite them):')
+      for path in e.paths:
+        print ('  %s' % path)
+      return
+    except safewrite.PublishError as e:
+      print ('Sync stopped part way, %d file(s) written: %s' % (len(e.published), e.err))
+      return
+    print ('Wrote %d and deleted %d file(s) on the card' % (len(written), len(deleted)))
+
+  def show_stats(self, command):
+    if command['arg'] == 'reset':
+      stats.STATS.reset()
+      print ('Stats reset')
+      return
+    print ('\n'.join(stats.STATS.report()))
+
+  def show_jobs(self):
+    all_jobs = self._jobs.jobs()
+    if not all_jobs:
+      print ('No jobs')
+    for job in all_jobs:
+      print (job.describe())
+
+  def cancel_job(self, command):
+    try:
+      job_id = int(command['arg'])
+    except ValueError:
+      print ('Expected a job number, like: cancel 1')
+      return
+    try:
+      self._jobs.cancel(job_id)
+    except jobs.NoSuchJob:
+      print ('No job %d' % job_id)
+      return
+    print ('Cancelling job %d, it stops after the current clip' % job_id)
+
+  def handle_fixcase(self):
+    """Lists clips whose path is only wrong by case, and repoints them."""
+    mismatches = self._handler.find_case_mismatches(self._root)
+    if not mismatches:
+      print ('No clips with a case mismatch')
+      return
+    fixable = [m for m in mismatches if len(m.candidates) == 1]
+    for m in mismatches:
+      print (' %s %d,%d  %s' % (m.preset, m.track, m.clip, m.filename))
+      if len(m.candidates) == 1:
+        print ('    -> %s' % m.candidates[0])
+      else:
+        print ('    ambiguous, could be any of: %s' % ', '.join(m.candidates))
+    if not fixable:
+      print ('Nothing that can be fixed automatically')
+      return
+    presets = set(m.preset for m in fixable)
+    answer = prompt('Repoint %d slot(s) in %d preset(s)? [y/n] > ' % (len(fixable), len(presets)))
+    if answer.strip().lower()[:1] != 'y':
+      return
+    fixed = self._handler.fix_case(self._root, fixable)
+    print ('Repointed %d slot(s)' % len(fixed))
+
+  def audition_orphans(self, filenames):
+    """Plays each file and asks what to do with it."""
+    self._handler.stop_playback()
+    deleted = 0
+    for filename, error in self._handler.audition(self._root, filenames):
+      print ('')
+      print (filename)
+      if error is not None:
+        print ('Could not decode: %s' % error)
+      answer = 'r'
+      while answer == 'r':
+        if error is None:
+          self._handler.play_file(filename)
+        answer = prompt('[k]eep, [d]elete, [r]eplay, [q]uit > ').strip().lower()[:1]
+      self._handler.stop_playback()
+      if answer == 'q':
+        break
+      if answer == 'd':
+        try:
+          self._handler.delete_sample(self._root, filename)
+          deleted += 1
+        except handlers.SampleInUse as e:
+          print ('Not deleting, still used by %d slots' % len(e.usage))
+        except (handlers.FileNotFound, OSError) as e:
+          print ('Could not delete: %s' % e)
+    print ('Deleted %d recordings' % deleted)
+
+  def handle_undo(self, command, op):
+    """Steps a clip back or forward through its history with op."""
+    steps = 1
+    if command['arg']:
+      try:
+        steps = int(command['arg'])
+      except ValueError:
+        print ('Expected a number of steps, like: 0,0 2')
+        return
+    self._cur_clip = self._choose_clip(command)
+    if self._cur_clip is not None:
+      op(self._root, self._cur_preset, self._cur_clip, steps=steps)
+      self.play_current_clip()
+
+  def show_clip_history(self):
+    versions, position = self._handler.clip_history(self._root, self._cur_preset, self._cur_clip)
+    if not versions:
+      print ('No saved versions of this clip')
+      return
+    for i, v in enumerate(versions):
+      marker = '*' if i == position else ' '
+      print ('%s%d: %s %s %d bytes' % (marker, i, v['hash'][:10],
+                                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(v['time'])),
+                                      v['size']))
 
   def handle_swap(self, command):
     def print_error():
@@ -1,8 +1,12 @@
+import contextlib
+import io
 import os
+import threading
 import unittest
 import tempfile
 
-import prompt
+import bbeditor.prompt as prompt
+import bbeditor.testutil as testutil
 
 
 class PromptTest(unittest.TestCase):
@@ -51,6 +55,13 @@ class PromptTest(unittest.TestCase):
     self.assertEqual({'command': '', 'coords': [], 'arg': ''},
                      self._p.parse_command('s some text 2,1'))
 
+  def test_parse_normall(self):
+    self.assertEqual({'mode': 'peak'}, prompt.parse_normall(''))
+    self.assertEqual({'mode': 'lufs'}, prompt.parse_normall('lufs'))
+    self.assertEqual({'mode': 'rms', 'target': -16.0}, prompt.parse_normall(' rms  -16 '))
+    for bad in ('loud', 'lufs x', 'lufs -16 -1'):
+      self.assertRaises(ValueError, prompt.parse_normall, bad)
+
   def test_handle_dir(self):
     d = tempfile.mkdtemp()
     command = {
@@ -89,5 +100,157 @@ class PromptTest(unittest.TestCase):
       self.assertIsNone(self._p.choose_preset(command))
 
 
+class PromptCardTest(testutil.CardTest):
+  """A Prompt on a temp card, with a handler that keeps nothing locally."""
+
+  def setUp(self):
+    super().setUp()
+    history = tempfile.NamedTemporaryFile()
+    self.addCleanup(history.close)
+    self._p = prompt.Prompt(history.name)
+    self._p._handler = self.make_handler()
+    self._p._root = self._root
+    self.addCleanup(self._p.get_jobs().shutdown)
+
+  def _run(self, text):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+      self._p.run_command(self._p.parse_command(text))
+    return out.getvalue()
+
+
+class JobLockTest(PromptCardTest):
+  def setUp(self):
+    super().setUp()
+    for name in ('KICK.WAV', 'SNARE.WAV'):
+      testutil.write_wav(os.path.join(self._root, name), [100, -100, 200, -200])
+    one = testutil.empty_clips()
+    one[0][0] = 'KICK.WAV'
+    two = testutil.empty_clips()
+    two[1][1] = 'SNARE.WAV'
+    two[2][2] = 'KICK.WAV'
+    for name, files in (('one', one), ('two', two)):
+      testutil.write_preset(self._root, name, files)
+    self._release = threading.Event()
+    self._started = threading.Event()
+    # Cleanups run last first, so the job is let go before the queue shuts down.
+    self.addCleanup(self._release.set)
+
+  def _block(self, root, preset, progress=None):
+    self._started.set()
+    self._release.wait(5)
+
+  def test_job_blocks_shared_sample(self):
+    self._run('c one')
+    self._p.start_job('normall', self._block)
+    self._started.wait(5)
+    kick = os.path.join(self._root, 'KICK.WAV')
+    before = testutil.read_wav(kick)
+
+    self._run('c two')
+    self.assertIn('busy with a background job', self._run('norm 2,2'))
+    self.assertEqual(before, testutil.read_wav(kick))
+    self.assertIn('Wait for the background jobs', self._run('r 2,2 KICK2.WAV'))
+    self.assertIn('Wait for the background jobs', self._run('dir %s' % self._root))
+
+    self._release.set()
+    self._p.get_jobs().wait(5)
+    self.assertNotIn('busy', self._run('norm 2,2'))
+    self.assertNotEqual(before, testutil.read_wav(kick))
+
+
+class ExportTest(PromptCardTest):
+  def setUp(self):
+    super().setUp()
+    for name in ('one', 'two'):
+      testutil.write_preset(self._root, name, testutil.empty_clips())
+
+  def test_order_kept_only_when_it_works(self):
+    self.assertIn('SE000001.XML  two', self._run('exportv1 two'))
+    self.assertIn("Didn't find preset: 'nope'", self._run('exportv1 nope'))
+    # The typo didn't replace the order that worked.
+    self.assertIn('SE000001.XML  two  (unchanged)', self._run('exportv1'))
+    out = self._run('exportv1 -')
+    self.assertIn('SE000001.XML  one', out)
+    self.assertIn('SE000002.XML  two', out)
+    out = self._run('exportv1 one')
+    self.assertNotIn('SE000002.XML', out)
+    self.assertIn('Wrote 0 of 1 slots', out)
+
+
+class CompletionIndexTest(testutil.CardTest):
+  def setUp(self):
+    super().setUp()
+    files = testutil.empty_clips()
+    files[0][1] = 'KICK.WAV'
+    files[2][3] = 'SNARE.WAV'
+    for name in ('one', 'two'):
+      testutil.write_preset(self._root, name, files)
+    self._index = prompt.CompletionIndex(self.make_handler())
+
+  def test_empty_until_refreshed(self):
+    self._index.set_root(self._root)
+    self.assertEqual([], self._index.presets())
+    self.assertEqual([], self._index.slots('one'))
+    self._index.refresh()
+    self.assertEqual(['one', 'two'], self._index.presets())
+    self.assertEqual(['0,1', '2,3'], self._index.slots('one'))
+
+  def test_invalidate(self):
+    self._index.set_root(self._root)
+    self._index.slots('one')
+    self._index.refresh()
+    open(os.path.join(self._root, 'three.xml'), 'w').close()
+    os.utime(self._root, ns=(0, 0))
+    self._index.refresh()
+    self.assertEqual(['one', 'three', 'two'], self._index.presets())
+
+    testutil.write_preset(self._root, 'one', testutil.empty_clips())
+    self.assertEqual(['0,1', '2,3'], self._index.slots('one'))
+    self._index.invalidate('one')
+    self._index.refresh()
+    self.assertEqual([], self._index.slots('one'))
+
+
+class PromptIndexTest(PromptCardTest):
+  def setUp(self):
+    super().setUp()
+    files = testutil.empty_clips()
+    files[0][1] = 'KICK.WAV'
+    for name in ('one', 'two'):
+      testutil.write_preset(self._root, name, files)
+    self._p._index = prompt.CompletionIndex(self._p._handler)
+    self._index = self._p.get_completion_index()
+    self._index.set_root(self._root)
+
+  def _loaded(self):
+    """Returns the presets whose slots the index still has."""
+    self._index.slots('one')
+    self._index.slots('two')
+    self._index.refresh()
+    with self._index._lock:
+      return sorted(self._index._slots)
+
+  def test_invalidate_after_writes(self):
+    self.assertEqual(['one', 'two'], self._loaded())
+    self._p.invalidate_index(self._p.parse_command('l'), None)
+    self._p.invalidate_index(self._p.parse_command('p 0,1'), 'one')
+    self.assertEqual(['one', 'two'], sorted(self._index._slots))
+    self._p.invalidate_index(self._p.parse_command('norm 0,1'), 'one')
+    self.assertEqual(['two'], sorted(self._index._slots))
+    self.assertEqual(['one', 'two'], self._loaded())
+    self._p.invalidate_index(self._p.parse_command('fixcase'), None)
+    self.assertEqual([], sorted(self._index._slots))
+
+  def test_invalidate_after_job(self):
+    self.assertEqual(['one', 'two'], self._loaded())
+    self._p._cur_preset = 'two'
+    with contextlib.redirect_stdout(io.StringIO()):
+      self._p.start_job('normall', lambda root, preset, progress=None: None)
+      self._p.get_jobs().wait(5)
+      self._p.report_finished_jobs()
+    self.assertEqual(['one'], sorted(self._index._slots))
+
+
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,204 @@
+"""refindex.py
+A persistent index of which preset slots use which samples.
+
+Lives in a SQLite database in the local cache dir and covers every card the
+editor has seen.  refresh() only rereads presets whose XML changed since they
+were last indexed, and the Handler keeps it current for its own writes.
+
+It also caches what was learned from each sample's WAV header, keyed by the
+sample's mtime and size.
+"""
+import concurrent.futures
+import os
+import os.path
+import sqlite3
+import threading
+
+import bbeditor.stats as stats
+from bbeditor.cachedir import cache_dir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presets (
+  root TEXT NOT NULL,
+  name TEXT NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  PRIMARY KEY (root, name)
+);
+CREATE TABLE IF NOT EXISTS refs (
+  root TEXT NOT NULL,
+  preset TEXT NOT NULL,
+  track INTEGER NOT NULL,
+  clip INTEGER NOT NULL,
+  filename TEXT NOT NULL,
+  samplekey TEXT NOT NULL,
+  PRIMARY KEY (root, preset, track, clip)
+);
+CREATE INDEX IF NOT EXISTS refs_by_sample ON refs (root, samplekey);
+CREATE TABLE IF NOT EXISTS samples (
+  root TEXT NOT NULL,
+  filename TEXT NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  duration REAL,
+  PRIMARY KEY (root, filename)
+);
+"""
+
+
+def sample_key(filename):
+  """Normalizes a clip filename for lookups.
+
+  The card is FAT, so names are compared case-insensitively and with either
+  kind of path separator.
+  """
+  return filename.replace('\\', '/').strip('/').casefold()
+
+
+class RefIndex(object):
+  """Maps preset -> slot -> filename, and filename -> presets and slots.
+
+  Safe to share between threads.  The database is only opened on first use.
+
+  Arguments:
+    path: the SQLite database file, defaults to one in the local cache dir
+    workers: how many presets to parse at once when refreshing
+  """
+
+  def __init__(self, path=None, workers=8):
+    self._path = path or cache_dir('refindex.sqlite')
+    self._workers = workers
+    self._conn = None
+    self._lock = threading.RLock()
+
+  def _db(self):
+    if self._conn is None:
+      if self._path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+      self._conn = sqlite3.connect(self._path, check_same_thread=False)
+      self._conn.executescript(SCHEMA)
+    return self._conn
+
+  def _root(self, root):
+    return os.path.abspath(root)
+
+  def _write_preset(self, db, root, name, filenames, st):
+    db.execute('DELETE FROM refs WHERE root = ? AND preset = ?', (root, name))
+    db.execute('INSERT OR REPLACE INTO presets VALUES (?, ?, ?, ?)',
+               (root, name, st.st_mtime_ns, st.st_size))
+    db.executemany('INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?)',
+                   [(root, name, t, c, f, sample_key(f))
+                    for t, track in enumerate(filenames)
+                    for c, f in enumerate(track) if f])
+
+  def refresh(self, root, handler):
+    """Brings the index up to date with the presets on disk.
+
+    Only presets that are new, or whose mtime or size changed, are parsed, in
+    parallel.  Presets that are gone are dropped.
+
+    Returns: the number of presets that were parsed
+    """
+    key = self._root(root)
+    current = {}
+    for name in handler.list_presets(root):
+      try:
+        current[name] = handler.preset_stat(root, name)
+      except OSError:
+        pass
+
+    with self._lock:
+      known = {name: (mtime, size) for name, mtime, size in self._db().execute(
+          'SELECT name, mtime_ns, size FROM presets WHERE root = ?', (key,))}
+    stale = [name for name, st in current.items()
+             if known.get(name) != (st.st_mtime_ns, st.st_size)]
+    gone = [name for name in known if name not in current]
+
+    def parse(name):
+      try:
+        return handler.read_clips_filenames(root, name)
+      except Exception:
+        # Unreadable presets are indexed as empty, and retried once they change.
+        return []
+
+    parsed = {}
+    if stale:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+        for name, filenames in zip(stale, pool.map(stats.bound(parse), stale)):
+          parsed[name] = filenames
+
+    with self._lock:
+      db = self._db()
+      with db:
+        for name in gone:
+          self._delete_preset(db, key, name)
+        for name, filenames in parsed.items():
+          self._write_preset(db, key, name, filenames, current[name])
+    return len(parsed)
+
+  def update_preset(self, root, name, filenames, st):
+    """Records the clip filenames (4x4 list) of a preset that was just written.
+
+    st is the os.stat() of the preset file after the write.
+    """
+    with self._lock:
+      db = self._db()
+      with db:
+        self._write_preset(db, self._root(root), name, filenames, st)
+
+  def _delete_preset(self, db, root, name):
+    db.execute('DELETE FROM refs WHERE root = ? AND preset = ?', (root, name))
+    db.execute('DELETE FROM presets WHERE root = ? AND name = ?', (root, name))
+
+  def remove_preset(self, root, name):
+    with self._lock:
+      db = self._db()
+      with db:
+        self._delete_preset(db, self._root(root), name)
+
+  def usage(self, root, filename):
+    """Returns a sorted list of (preset, track, clip, filename) that use a sample."""
+    with self._lock:
+      return sorted(self._db().execute(
+          'SELECT preset, track, clip, filename FROM refs WHERE root = ? AND samplekey = ?',
+          (self._root(root), sample_key(filename))))
+
+  def referenced(self, root):
+    """Returns the set of sample keys (see sample_key) used by any preset."""
+    with self._lock:
+      return set(row[0] for row in self._db().execute(
+          'SELECT DISTINCT samplekey FROM refs WHERE root = ?', (self._root(root),)))
+
+  def references(self, root):
+    """Returns a sorted list of every (preset, track, clip, filename) on the card."""
+    with self._lock:
+      return sorted(self._db().execute(
+          'SELECT preset, track, clip, filename FROM refs WHERE root = ?', (self._root(root),)))
+
+  def samples(self, root):
+    """Returns the cached sample probes, filename -> (mtime_ns, size, duration).
+
+    filename is as in the card's file system, with '/'.  duration is None if
+    the header couldn't be read.
+    """
+    with self._lock:
+      return {row[0]: tuple(row[1:]) for row in self._db().execute(
+          'SELECT filename, mtime_ns, size, duration FROM samples WHERE root = ?',
+          (self._root(root),))}
+
+  def update_samples(self, root, probes, gone=()):
+    """Caches sample probes, a dict like samples() returns, and forgets gone."""
+    key = self._root(root)
+    with self._lock:
+      db = self._db()
+      with db:
+        db.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)',
+                       [(key, f) + tuple(p) for f, p in probes.items()])
+        db.executemany('DELETE FROM samples WHERE root = ? AND filename = ?',
+                       [(key, f) for f in gone])
+
+  def close(self):
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
@@ -0,0 +1,208 @@
+"""safewrite.py
+Crash-safe file replacement for files on the card.
+
+A file is never written in place.  The new content goes to a temp file in
+the same directory, which is renamed over the old file, so a crash or a
+pulled card leaves either the old file or the new one, never half of each.
+
+How hard we push the data to the media is the durability policy:
+
+  ALWAYS  fsync every temp file before its rename, and the directory after
+  BATCH   like ALWAYS, but when several files are published together their
+          temp files are all written before any is synced, and each
+          directory is synced once at the end
+  NONE    no fsync, leave it to the OS (fine for local disks and tests)
+
+Writing a group of files is done in two steps: stage() each one, then
+publish() them all together.  remove() deletes files under the same policy.
+"""
+import collections
+import os
+import os.path
+import shutil
+import tempfile
+
+import bbeditor.stats as stats
+
+ALWAYS = 'always'
+BATCH = 'batch'
+NONE = 'none'
+POLICIES = (ALWAYS, BATCH, NONE)
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+
+class BadPolicy(Error):
+  def __init__(self, policy):
+    super().__init__('Unknown durability policy: %s' % policy)
+    self.policy = policy
+
+
+class PublishError(Error):
+  """Publishing stopped part way.
+
+  published is the list of paths that were already replaced, in order.  The
+  temp files of the rest have been removed.
+  """
+  def __init__(self, published, err):
+    super().__init__(str(err))
+    self.published = published
+    self.err = err
+
+
+# A staged write: the temp file holding the new content, and where it goes.
+Staged = collections.namedtuple('Staged', ['tmp', 'path'])
+
+
+def _fsync_path(path, directory=False):
+  flags = os.O_RDONLY
+  if directory and hasattr(os, 'O_DIRECTORY'):
+    flags |= os.O_DIRECTORY
+  try:
+    fd = os.open(path, flags)
+  except OSError:
+    # Some platforms can't open directories, there is nothing to sync then.
+    if directory:
+      return
+    raise
+  try:
+    os.fsync(fd)
+    stats.incr('fsync')
+  except OSError:
+    if not directory:
+      raise
+  finally:
+    os.close(fd)
+
+
+class AtomicWriter(object):
+  """Replaces files atomically, with a durability policy.
+
+  Arguments:
+    policy: ALWAYS, BATCH or NONE
+
+  Raises:
+    BadPolicy
+  """
+
+  def __init__(self, policy=BATCH):
+    if policy not in POLICIES:
+      raise BadPolicy(policy)
+    self.policy = policy
+
+  def _stage(self, path, write, mode_from):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        write(f)
+        if self.policy == ALWAYS:
+          f.flush()
+          os.fsync(f.fileno())
+          stats.incr('fsync')
+      if os.path.exists(mode_from):
+        shutil.copymode(mode_from, tmp)
+    except BaseException:
+      os.remove(tmp)
+      raise
+    stats.incr('bytes.written', os.path.getsize(tmp))
+    return Staged(tmp, path)
+
+  def stage(self, path, data):
+    """Writes data, bytes, to a temp file next to path.
+
+    Nothing at path changes until the Staged is published.  The temp file
+    gets path's permissions if path exists.
+
+    Returns: a Staged
+    """
+    return self._stage(path, lambda f: f.write(data), path)
+
+  def stage_copy(self, path, source):
+    """Like stage(), but copies the content of the file source.
+
+    Creates path's directory if needed.  A new file gets source's
+    permissions.
+
+    Returns: a Staged
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    def copy(f):
+      with open(source, 'rb') as src:
+        shutil.copyfileobj(src, f)
+    return self._stage(path, copy, path if os.path.exists(path) else source)
+
+  def discard(self, staged):
+    """Removes the temp files of staged writes that won't be published."""
+    for s in staged:
+      if os.path.exists(s.tmp):
+        os.remove(s.tmp)
+
+  def publish(self, staged):
+    """Renames staged temp files over their paths, in order.
+
+    Raises:
+      PublishError
+    """
+    published = []
+    try:
+      if self.policy == BATCH:
+        for s in staged:
+          _fsync_path(s.tmp)
+      directories = []
+      for s in staged:
+        os.replace(s.tmp, s.path)
+        published.append(s.path)
+        directory = os.path.dirname(s.path) or '.'
+        if self.policy == ALWAYS:
+          _fsync_path(directory, directory=True)
+        elif directory not in directories:
+          directories.append(directory)
+      if self.policy == BATCH:
+        for directory in directories:
+          _fsync_path(directory, directory=True)
+    except Exception as e:
+      self.discard(s for s in staged if s.path not in published)
+      raise PublishError(published, e)
+    except BaseException:
+      self.discard(s for s in staged if s.path not in published)
+      raise
+
+  def remove(self, paths):
+    """Deletes files, in order, then syncs their directories like publish().
+
+    Files that are already gone count as removed.
+
+    Raises:
+      PublishError: published is the list of paths removed so far
+    """
+    removed = []
+    directories = []
+    try:
+      for path in paths:
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        removed.append(path)
+        directory = os.path.dirname(path) or '.'
+        if self.policy == ALWAYS:
+          _fsync_path(directory, directory=True)
+        elif directory not in directories:
+          directories.append(directory)
+      if self.policy == BATCH:
+        for directory in directories:
+          _fsync_path(directory, directory=True)
+    except Exception as e:
+      raise PublishError(removed, e)
+
+  def write(self, path, data):
+    """Atomically replaces path with data, bytes.
+
+    Raises:
+      PublishError
+    """
+    self.publish([self.stage(path, data)])
@@ -0,0 +1,82 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import bbeditor.safewrite as safewrite
+import bbeditor.stats as stats
+
+
+class SafeWriteTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._paths = [os.path.join(self._dir, '%d.xml' % i) for i in range(3)]
+    for path in self._paths:
+      with open(path, 'wb') as f:
+        f.write(b'old')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def test_write_keeps_mode(self):
+    os.chmod(self._paths[0], 0o600)
+    safewrite.AtomicWriter().write(self._paths[0], b'new')
+    self.assertEqual(b'new', self._read(self._paths[0]))
+    self.assertEqual(0o600, stat.S_IMODE(os.stat(self._paths[0]).st_mode))
+    self.assertEqual(3, len(os.listdir(self._dir)))
+
+  def test_staged_not_visible(self):
+    writer = safewrite.AtomicWriter()
+    staged = [writer.stage(path, b'new') for path in self._paths]
+    self.assertEqual([b'old'] * 3, [self._read(p) for p in self._paths])
+    writer.discard(staged)
+    self.assertEqual(3, len(os.listdir(self._dir)))
+
+  def test_publish_fails_part_way(self):
+    writer = safewrite.AtomicWriter(safewrite.NONE)
+    staged = [writer.stage(path, b'new') for path in self._paths]
+    os.remove(self._paths[1])
+    os.mkdir(self._paths[1])
+    with self.assertRaises(safewrite.PublishError) as cm:
+      writer.publish(staged)
+    self.assertEqual([self._paths[0]], cm.exception.published)
+    self.assertEqual(b'new', self._read(self._paths[0]))
+    self.assertEqual(b'old', self._read(self._paths[2]))
+    self.assertEqual(3, len(os.listdir(self._dir)))
+
+  def _fsyncs(self, policy):
+    writer = safewrite.AtomicWriter(policy)
+    before = stats.STATS.snapshot()['fsync']
+    writer.publish([writer.stage(path, b'new') for path in self._paths])
+    self.assertEqual([b'new'] * 3, [self._read(p) for p in self._paths])
+    return stats.STATS.snapshot()['fsync'] - before
+
+  def test_remove(self):
+    writer = safewrite.AtomicWriter(safewrite.BATCH)
+    before = stats.STATS.snapshot()['fsync']
+    writer.remove(self._paths[:2] + [os.path.join(self._dir, 'gone.xml')])
+    self.assertEqual(['2.xml'], os.listdir(self._dir))
+    # Just the directory, once.
+    self.assertEqual(1, stats.STATS.snapshot()['fsync'] - before)
+
+    os.mkdir(self._paths[0])
+    with self.assertRaises(safewrite.PublishError) as cm:
+      writer.remove([self._paths[2], self._paths[0]])
+    self.assertEqual([self._paths[2]], cm.exception.published)
+
+  def test_policies(self):
+    # Every file either way, but the directory only once for a batch.
+    self.assertEqual(6, self._fsyncs(safewrite.ALWAYS))
+    self.assertEqual(4, self._fsyncs(safewrite.BATCH))
+    self.assertEqual(0, self._fsyncs(safewrite.NONE))
+    with self.assertRaises(safewrite.BadPolicy):
+      safewrite.AtomicWriter('sometimes')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,287 @@
+"""staging.py
+A local working copy of a card, synced back in one go.
+
+pull() mirrors the card's presets and the samples they use into a local
+dir, so editing runs against a fast local disk instead of the card.  sync()
+then pushes back only the files that changed, in an order that is safe if
+it is interrupted:
+
+  1. new and changed samples
+  2. new and changed presets, which may point at the samples from 1
+  3. deleted presets
+  4. deleted samples, which no preset on the card uses any more
+
+Every file is replaced atomically through safewrite, and each step is
+published, or removed, as one batch.
+
+A manifest records every mirrored file as it was on the card and in the
+copy at the last pull or sync.  A local file changed if its size or mtime
+differs and its content hash does too.  A card file changed behind our back
+if its size or mtime differs, that is a conflict and sync() refuses.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import os.path
+import shutil
+
+import bbeditor.cardfs as cardfs
+import bbeditor.safewrite as safewrite
+import bbeditor.stats as stats
+from bbeditor.cachedir import cache_dir
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Error(Exception):
+  """Base class for exceptions in this module."""
+  pass
+
+class Conflict(Error):
+  """Files changed on the card since they were pulled."""
+  def __init__(self, paths):
+    super().__init__(', '.join(paths))
+    self.paths = paths
+
+
+def _digest(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _is_temp(rel):
+  # Temp files left by safewrite, or by an editor.
+  return os.path.basename(rel).startswith('.')
+
+
+class Mirror(object):
+  """A local copy of the card in card_root.
+
+  Arguments:
+    card_root: where the card is mounted
+    path: where to keep the copy, defaults to a dir per card under the local
+      cache dir
+    writer: the safewrite.AtomicWriter used to write to the card
+  """
+
+  def __init__(self, card_root, path=None, writer=None):
+    self.card_root = card_root
+    key = hashlib.sha1(os.path.abspath(card_root).encode('utf-8')).hexdigest()[:16]
+    self._path = path or cache_dir('staging', key)
+    # The copy of the card itself.
+    self.root = os.path.join(self._path, 'card')
+    self._manifest_path = os.path.join(self._path, 'manifest.json')
+    self._writer = writer if writer is not None else safewrite.AtomicWriter()
+    self._manifest = self._load_manifest()
+    # Whether _manifest has changes that aren't saved.
+    self._dirty = False
+
+  def _load_manifest(self):
+    try:
+      with open(self._manifest_path) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def _save_manifest(self):
+    os.makedirs(self._path, exist_ok=True)
+    data = json.dumps(self._manifest, indent=1, sort_keys=True).encode('utf-8')
+    safewrite.AtomicWriter(safewrite.NONE).write(self._manifest_path, data)
+    self._dirty = False
+
+  def _card_path(self, rel):
+    return os.path.join(self.card_root, *rel.split('/'))
+
+  def _local_path(self, rel):
+    return os.path.join(self.root, *rel.split('/'))
+
+  def _record(self, rel):
+    """Remembers rel as it is now, the same on the card and in the copy."""
+    card = os.stat(self._card_path(rel))
+    local_path = self._local_path(rel)
+    local = os.stat(local_path)
+    self._manifest[rel] = {
+        'size': local.st_size,
+        'card_mtime_ns': card.st_mtime_ns,
+        'local_mtime_ns': local.st_mtime_ns,
+        'digest': _digest(local_path),
+      }
+
+  def _local_changed(self, rel):
+    entry = self._manifest.get(rel)
+    try:
+      st = os.stat(self._local_path(rel))
+    except OSError:
+      return True
+    if entry is None:
+      return True
+    if st.st_size == entry['size'] and st.st_mtime_ns == entry['local_mtime_ns']:
+      return False
+    if _digest(self._local_path(rel)) != entry['digest']:
+      return True
+    # Only touched.  Remember the new mtime so it isn't hashed again.
+    entry['local_mtime_ns'] = st.st_mtime_ns
+    self._dirty = True
+    return False
+
+  def _card_changed(self, rel):
+    entry = self._manifest.get(rel)
+    try:
+      st = os.stat(self._card_path(rel))
+    except OSError:
+      # Gone from the card.  Only a conflict if we knew about it.
+      return entry is not None
+    if entry is None:
+      return True
+    return st.st_size != entry['size'] or st.st_mtime_ns != entry['card_mtime_ns']
+
+  def _wanted(self, handler, everything):
+    """Returns the set of card files to mirror, relative with '/'."""
+    if everything:
+      return set(rel for rel, _ in cardfs.walk_files(self.card_root) if not _is_temp(rel))
+    wanted = set()
+    for preset in handler.list_presets(self.card_root):
+      wanted.add('%s.xml' % preset)
+      for track in handler.read_clips_filenames(self.card_root, preset):
+        for filename in track:
+          if filename:
+            rel = filename.replace('\\', '/')
+            if os.path.isfile(self._card_path(rel)):
+              wanted.add(rel)
+    return wanted
+
+  def pull(self, handler, everything=False, workers=8):
+    """Copies the card's presets and the samples they use into the copy.
+
+    Files already in the copy and unchanged on the card aren't copied again.
+    Files with local changes that haven't been synced are left alone.
+
+    Arguments:
+      handler: a handlers.Handler, for reading the presets on the card
+      everything: mirror every file on the card, not just the used samples
+
+    Returns: a sorted list of the paths that were copied
+    """
+    wanted = self._wanted(handler, everything)
+    to_copy = []
+    for rel in sorted(wanted):
+      local_exists = os.path.exists(self._local_path(rel))
+      if local_exists and self._local_changed(rel):
+        continue
+      if not local_exists or self._card_changed(rel):
+        to_copy.append(rel)
+
+    def copy(rel):
+      local_path = self._local_path(rel)
+      os.makedirs(os.path.dirname(local_path), exist_ok=True)
+      shutil.copy2(self._card_path(rel), local_path)
+      stats.incr('bytes.read', os.path.getsize(local_path))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      list(pool.map(stats.bound(copy), to_copy))
+    for rel in to_copy:
+      self._record(rel)
+    self._save_manifest()
+    return to_copy
+
+  def is_pulled(self):
+    return bool(self._manifest)
+
+  def changes(self):
+    """Finds what was edited in the copy since the last pull or sync.
+
+    Returns: (changed, deleted), sorted lists of paths.  changed includes new
+    files.
+    """
+    local = set(rel for rel, _ in cardfs.walk_files(self.root) if not _is_temp(rel))
+    changed = sorted(rel for rel in local if self._local_changed(rel))
+    deleted = sorted(rel for rel in self._manifest if rel not in local)
+    if self._dirty:
+      self._save_manifest()
+    return changed, deleted
+
+  def conflicts(self, changed, deleted):
+    """Returns the paths in changed or deleted that also changed on the card.
+
+    A file deleted from both isn't a conflict.
+    """
+    return ([rel for rel in changed if self._card_changed(rel)] +
+            [rel for rel in deleted
+             if os.path.exists(self._card_path(rel)) and self._card_changed(rel)])
+
+  def sync(self, force=False):
+    """Pushes back every file that changed in the copy.
+
+    Arguments:
+      force: overwrite files that changed on the card too
+
+    Returns: (written, deleted), sorted lists of paths.  A file renamed only
+    in case is just written: the card doesn't tell the two names apart, so
+    deleting the old one would delete the new one.
+
+    Raises:
+      Conflict: nothing is written
+      safewrite.PublishError: the steps before the failed one were synced
+    """
+    changed, deleted = self.changes()
+    written = set(rel.casefold() for rel in changed)
+    renamed = [rel for rel in deleted if rel.casefold() in written]
+    deleted = [rel for rel in deleted if rel.casefold() not in written]
+    if not force:
+      # The new name of a renamed file is checked as the old one, which the
+      # card would find under either name.
+      old = set(rel.casefold() for rel in renamed)
+      conflicts = self.conflicts([rel for rel in changed if rel.casefold() not in old],
+                                 deleted + renamed)
+      if conflicts:
+        raise Conflict(conflicts)
+
+    def is_preset(rel):
+      return '/' not in rel and rel.lower().endswith('.xml')
+
+    steps = [
+        [rel for rel in changed if not is_preset(rel)],
+        [rel for rel in changed if is_preset(rel)],
+      ]
+    for step in steps:
+      staged = []
+      try:
+        for rel in step:
+          staged.append(self._writer.stage_copy(self._card_path(rel), self._local_path(rel)))
+      except BaseException:
+        self._writer.discard(staged)
+        raise
+      published = [s.path for s in staged]
+      try:
+        self._writer.publish(staged)
+      except safewrite.PublishError as e:
+        published = e.published
+        raise
+      finally:
+        for rel, s in zip(step, staged):
+          if s.path in published:
+            self._record(rel)
+        self._save_manifest()
+    for rel in renamed:
+      del self._manifest[rel]
+    if renamed:
+      self._save_manifest()
+
+    for step in ([rel for rel in deleted if is_preset(rel)],
+                 [rel for rel in deleted if not is_preset(rel)]):
+      removed = [self._card_path(rel) for rel in step]
+      try:
+        self._writer.remove(removed)
+      except safewrite.PublishError as e:
+        removed = e.published
+        raise
+      finally:
+        for rel in step:
+          if self._card_path(rel) in removed:
+            del self._manifest[rel]
+        self._save_manifest()
+    return changed, deleted
@@ -0,0 +1,101 @@
+import os
+import unittest
+
+import bbeditor.safewrite as safewrite
+import bbeditor.staging as staging
+import bbeditor.testutil as testutil
+
+
+class MirrorTest(testutil.CardTest):
+  def setUp(self):
+    super().setUp()
+    self._card = self._root
+    os.makedirs(os.path.join(self._card, '130', '09'))
+    files = testutil.empty_clips()
+    files[0][0] = '130\\09\\KICK.WAV'
+    files[1][2] = '130\\09\\SNARE.WAV'
+    testutil.write_preset(self._card, 'one', files)
+    for name in ('KICK.WAV', 'SNARE.WAV', 'UNUSED.WAV'):
+      with open(os.path.join(self._card, '130', '09', name), 'wb') as f:
+        f.write(name.encode('ascii'))
+    self._h = self.make_handler()
+    self._mirror = self._new_mirror()
+
+  def _new_mirror(self):
+    return staging.Mirror(self._card, path=os.path.join(self._local, 'staging'),
+                          writer=safewrite.AtomicWriter(safewrite.NONE))
+
+  def _card_file(self, *parts):
+    with open(os.path.join(self._card, *parts), 'rb') as f:
+      return f.read()
+
+  def test_pull(self):
+    self.assertEqual(['130/09/KICK.WAV', '130/09/SNARE.WAV', 'one.xml'],
+                     self._mirror.pull(self._h))
+    self.assertFalse(os.path.exists(os.path.join(self._mirror.root, '130', '09', 'UNUSED.WAV')))
+    # A new Mirror picks up the manifest, nothing needs copying again.
+    self.assertEqual([], self._new_mirror().pull(self._h))
+    self.assertEqual(['130/09/UNUSED.WAV'], self._new_mirror().pull(self._h, everything=True))
+
+  def test_sync_edits(self):
+    self._mirror.pull(self._h)
+    root = self._mirror.root
+    self._h.rename_sample(root, '130/09/KICK.WAV', 'drums/KICK.WAV')
+    self.assertEqual((['drums/KICK.WAV', 'one.xml'], ['130/09/KICK.WAV']),
+                     self._new_mirror().changes())
+
+    written, deleted = self._mirror.sync()
+    self.assertEqual(['drums/KICK.WAV', 'one.xml'], written)
+    self.assertEqual(['130/09/KICK.WAV'], deleted)
+    self.assertEqual(['130', 'drums', 'one.xml'], sorted(os.listdir(self._card)))
+    self.assertEqual(b'KICK.WAV', self._card_file('drums', 'KICK.WAV'))
+    self.assertFalse(os.path.exists(os.path.join(self._card, '130', '09', 'KICK.WAV')))
+    self.assertEqual('drums\\KICK.WAV', self._h.get_clip(self._card, 'one', {'track': 0, 'clip': 0}))
+    self.assertEqual(([], []), self._mirror.changes())
+    self.assertEqual(([], []), self._mirror.sync())
+
+  def test_case_only_rename(self):
+    self._mirror.pull(self._h)
+    self._h.rename_sample(self._mirror.root, '130/09/KICK.WAV', '130/09/kick.wav')
+    removed = []
+    remove = self._mirror._writer.remove
+    self._mirror._writer.remove = lambda paths: removed.extend(paths) or remove(paths)
+    written, deleted = self._mirror.sync()
+    self.assertEqual(['130/09/kick.wav', 'one.xml'], written)
+    # On the card that is the file just written.
+    self.assertEqual([], deleted)
+    self.assertEqual([], removed)
+    self.assertEqual(b'KICK.WAV', self._card_file('130', '09', 'kick.wav'))
+    self.assertEqual(([], []), self._new_mirror().changes())
+
+  def test_touched_but_same(self):
+    self._mirror.pull(self._h)
+    os.utime(os.path.join(self._mirror.root, 'one.xml'), ns=(0, 0))
+    self.assertEqual(([], []), self._mirror.changes())
+    # The new mtime is remembered, so it isn't hashed again.
+    hashed = []
+    digest = staging._digest
+    staging._digest = lambda path: hashed.append(path) or digest(path)
+    try:
+      self.assertEqual(([], []), self._new_mirror().changes())
+    finally:
+      staging._digest = digest
+    self.assertEqual([], hashed)
+
+  def test_conflict(self):
+    self._mirror.pull(self._h)
+    with open(os.path.join(self._mirror.root, '130', '09', 'SNARE.WAV'), 'wb') as f:
+      f.write(b'local')
+    with open(os.path.join(self._card, '130', '09', 'SNARE.WAV'), 'wb') as f:
+      f.write(b'changed on the card')
+    with self.assertRaises(staging.Conflict) as cm:
+      self._mirror.sync()
+    self.assertEqual(['130/09/SNARE.WAV'], cm.exception.paths)
+    self.assertEqual(b'changed on the card', self._card_file('130', '09', 'SNARE.WAV'))
+
+    self._mirror.sync(force=True)
+    self.assertEqual(b'local', self._card_file('130', '09', 'SNARE.WAV'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,164 @@
+"""stats.py
+Counters and timers for seeing where a command spends its time.
+
+The modules doing the work count what they do into the shared STATS:
+
+  xml.parse      presets parsed (bbxml)
+  xml.write      presets written (handlers)
+  fsync          files and directories synced to the card (safewrite)
+  wav.decode     WAVs decoded whole (effects, playback)
+  wav.scan       WAVs scanned block by block (effects)
+  wav.probe      WAV headers read for listings (handlers)
+  wav.write      WAVs written or patched in place (effects)
+  bytes.read     bytes read from preset and WAV files
+  bytes.written  bytes written to them
+
+Timers add up the seconds spent in an activity, like parsing XML.  Each
+prompt or batch command, and each background job, runs inside command(),
+which records how long it took and what it counted, and can write a cProfile
+file for it.
+
+A command only counts what is done in its own thread (its own context), so
+a background job's work isn't charged to the prompt command running next to
+it.  Worker threads helping a command run their functions through bound() to
+count into it.  Work done in worker processes (normall spreads clips over a
+process pool) isn't counted.
+"""
+import collections
+import contextlib
+import contextvars
+import cProfile
+import os
+import os.path
+import re
+import threading
+import time
+
+
+class Stats(object):
+  """Thread-safe counters and timers, with totals per command."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # The counters of the commands running in this context, outermost first.
+    self._scopes = contextvars.ContextVar('scopes', default=())
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.counters = collections.Counter()
+      # name -> [calls, seconds]
+      self.timers = collections.defaultdict(lambda: [0, 0.0])
+      # command name -> {'count', 'seconds', 'counters'}
+      self.commands = collections.OrderedDict()
+      self.last = None
+      self._seq = 0
+
+  def incr(self, name, n=1):
+    scopes = self._scopes.get()
+    with self._lock:
+      self.counters[name] += n
+      for scope in scopes:
+        scope[name] += n
+
+  def add_time(self, name, seconds):
+    with self._lock:
+      timer = self.timers[name]
+      timer[0] += 1
+      timer[1] += seconds
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    """Adds the time spent in the with block to a timer."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_time(name, time.perf_counter() - start)
+
+  def bound(self, func):
+    """Wraps func to count into the commands running here, wherever it runs.
+
+    For functions handed to worker threads, which don't share our context.
+    """
+    scopes = self._scopes.get()
+    def run(*args, **kwargs):
+      token = self._scopes.set(scopes)
+      try:
+        return func(*args, **kwargs)
+      finally:
+        self._scopes.reset(token)
+    return run
+
+  def snapshot(self):
+    with self._lock:
+      return collections.Counter(self.counters)
+
+  @contextlib.contextmanager
+  def command(self, name, profile_dir=None):
+    """Records one command: how long it took and what it counted.
+
+    Arguments:
+      name: the command, eg 'c' or 'normall'
+      profile_dir: if given, a cProfile of the command is written there as
+        <sequence number>-<name>.prof
+    """
+    counted = collections.Counter()
+    token = self._scopes.set(self._scopes.get() + (counted,))
+    profiler = None
+    if profile_dir:
+      profiler = cProfile.Profile()
+      profiler.enable()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      if profiler is not None:
+        profiler.disable()
+      self._scopes.reset(token)
+      with self._lock:
+        counted = +counted
+        self._seq += 1
+        seq = self._seq
+        entry = self.commands.setdefault(
+            name, {'count': 0, 'seconds': 0.0, 'counters': collections.Counter()})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['counters'].update(counted)
+        self.last = {'name': name, 'seconds': seconds, 'counters': counted}
+      if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        safe = re.sub(r'[^\w.-]', '_', name) or 'empty'
+        profiler.dump_stats(os.path.join(profile_dir, '%04d-%s.prof' % (seq, safe)))
+
+  def report(self):
+    """Returns the stats as a list of lines, for printing."""
+    def counters(c):
+      return ', '.join('%s %d' % (k, v) for k, v in sorted(c.items())) or 'nothing counted'
+
+    with self._lock:
+      lines = []
+      if self.last:
+        lines.append('Last command: %s, %.1f ms' % (self.last['name'], self.last['seconds'] * 1000))
+        lines.append('  ' + counters(self.last['counters']))
+      if self.commands:
+        lines.append('Per command:   count   total ms    mean ms')
+        for name, entry in self.commands.items():
+          lines.append('  %-10s %6d %10.1f %10.1f' % (
+              name, entry['count'], entry['seconds'] * 1000,
+              entry['seconds'] * 1000 / entry['count']))
+      lines.append('Totals: ' + counters(self.counters))
+      if self.timers:
+        lines.append('Timers:')
+        for name, (calls, seconds) in sorted(self.timers.items()):
+          lines.append('  %-14s %6d calls %10.1f ms' % (name, calls, seconds * 1000))
+      return lines
+
+
+# Shared by everything in the process.
+STATS = Stats()
+incr = STATS.incr
+timer = STATS.timer
+command = STATS.command
+bound = STATS.bound
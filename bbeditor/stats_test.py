@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import bbeditor.stats as stats
+import bbeditor.testutil as testutil
+
+
+class StatsTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._stats = stats.Stats()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_command(self):
+    self._stats.incr('xml.parse')
+    with self._stats.command('c'):
+      self._stats.incr('xml.parse')
+      self._stats.incr('bytes.read', 100)
+      with self._stats.timer('xml.parse'):
+        pass
+    with self._stats.command('c'):
+      pass
+    self.assertEqual({'xml.parse': 2, 'bytes.read': 100}, dict(self._stats.counters))
+    self.assertEqual(2, self._stats.commands['c']['count'])
+    self.assertEqual({'xml.parse': 1, 'bytes.read': 100}, dict(self._stats.commands['c']['counters']))
+    self.assertEqual({}, dict(self._stats.last['counters']))
+    self.assertEqual(1, self._stats.timers['xml.parse'][0])
+    report = '\n'.join(self._stats.report())
+    self.assertIn('Last command: c', report)
+    self.assertIn('bytes.read 100', report)
+
+  def test_other_threads(self):
+    def elsewhere(n):
+      self._stats.incr('xml.parse', n)
+    with self._stats.command('outer'):
+      with self._stats.command('inner'):
+        self._stats.incr('bytes.read', 10)
+        t = threading.Thread(target=elsewhere, args=(1,))
+        t.start()
+        t.join()
+        t = threading.Thread(target=self._stats.bound(elsewhere), args=(2,))
+        t.start()
+        t.join()
+    self.assertEqual({'xml.parse': 3, 'bytes.read': 10}, dict(self._stats.counters))
+    self.assertEqual({'xml.parse': 2, 'bytes.read': 10},
+                     dict(self._stats.commands['inner']['counters']))
+    self.assertEqual({'xml.parse': 2, 'bytes.read': 10},
+                     dict(self._stats.commands['outer']['counters']))
+
+  def test_profile(self):
+    with self._stats.command('s 0,0', profile_dir=self._dir):
+      sum(range(1000))
+    self.assertEqual(['0001-s_0_0.prof'], os.listdir(self._dir))
+
+  def test_handler_counts(self):
+    files = testutil.empty_clips()
+    files[0][0] = 'KICK.WAV'
+    testutil.write_preset(self._dir, 'one', files)
+    h = testutil.make_handler(self._dir)
+    with stats.command('l'):
+      h.get_clips_filenames(self._dir, 'one')
+      h.get_clips_filenames(self._dir, 'one')
+    counted = stats.STATS.last['counters']
+    self.assertEqual(1, counted['xml.parse'])
+    self.assertEqual(1, counted['preset_cache.hit'])
+    self.assertEqual(os.path.getsize(os.path.join(self._dir, 'one.xml')), counted['bytes.read'])
+
+
+if __name__ == "__main__":
+  unittest.main()
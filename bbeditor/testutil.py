@@ -0,0 +1,120 @@
+"""testutil.py
+Fixtures shared by the tests.
+
+Cards are temp dirs with preset XML and WAV files written by the helpers
+here.  Handlers made by make_handler keep their caches in memory and their
+backups in a temp dir, so tests never touch the local cache dir.
+"""
+import array
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+import wave
+
+import bbeditor.analysis as analysis
+import bbeditor.backups as backups
+import bbeditor.handlers as handlers
+import bbeditor.refindex as refindex
+
+
+CLIP = ('            <clip reverse="0" file="0" slicemode="0" trigtype="3" start="0" '
+        'length="0" level="0" quant="4" loop="1" pitch="0" filename="%s" slize="1" '
+        'midimode="0">\n'
+        '                <slices></slices>\n'
+        '            </clip>\n')
+
+
+def empty_clips():
+  """Returns a 4x4 list of clip filenames, all empty."""
+  return [['' for j in range(0, 4)] for i in range(0, 4)]
+
+
+def make_preset_xml(filenames):
+  """Builds preset XML from a 4x4 list of clip filenames."""
+  xml = '<document>\n    <session>\n'
+  for track in filenames:
+    xml += '        <track excl="0" out="3" level="0">\n'
+    for f in track:
+      xml += CLIP % f
+    xml += '        </track>\n'
+  xml += '    </session>\n</document>\n'
+  return xml
+
+
+def write_preset(root, name, filenames):
+  """Writes root/<name>.xml from a 4x4 list of clip filenames."""
+  with open(os.path.join(root, '%s.xml' % name), 'w') as f:
+    f.write(make_preset_xml(filenames))
+
+
+def write_wav(filename, samples, channels=2, width=2, rate=48000):
+  """Writes integer samples (interleaved) to a PCM wav file."""
+  typecode = {1: 'b', 2: 'h', 4: 'i'}[width]
+  data = array.array(typecode, samples).tobytes()
+  w = wave.open(filename, 'wb')
+  w.setnchannels(channels)
+  w.setsampwidth(width)
+  w.setframerate(rate)
+  w.writeframes(data)
+  w.close()
+
+
+def write_raw_wav(filename, data, channels, bits, fmt_tag=1, extensible=False, extra_chunk=False):
+  """Writes already-encoded sample bytes with a hand-built RIFF header."""
+  width = bits // 8
+  block_align = channels * width
+  if extensible:
+    fmt = struct.pack('<HHIIHHHHI', 0xFFFE, channels, 48000, 48000 * block_align,
+                      block_align, bits, 22, bits, 0)
+    fmt += struct.pack('<H', fmt_tag) + b'\x00' * 14
+  else:
+    fmt = struct.pack('<HHIIHH', fmt_tag, channels, 48000, 48000 * block_align,
+                      block_align, bits)
+  body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+  if extra_chunk:
+    body += b'LIST' + struct.pack('<I', 3) + b'abc\x00'
+  body += b'data' + struct.pack('<I', len(data)) + data
+  with open(filename, 'wb') as f:
+    f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+
+
+def pack_24(samples):
+  return b''.join(struct.pack('<i', s)[:3] for s in samples)
+
+
+def read_wav(filename):
+  w = wave.open(filename, 'rb')
+  typecode = {1: 'b', 2: 'h', 4: 'i'}[w.getsampwidth()]
+  samples = array.array(typecode, w.readframes(w.getnframes()))
+  w.close()
+  return list(samples)
+
+
+def make_handler(local, handler_class=handlers.Handler, **kwargs):
+  """Returns a Handler that keeps nothing in the local cache dir.
+
+  The reference index and analysis cache are in memory, backups go under
+  local.  kwargs are passed on, and win over these.
+  """
+  kwargs.setdefault('ref_index', refindex.RefIndex(':memory:'))
+  kwargs.setdefault('analysis_cache', analysis.AnalysisCache(':memory:'))
+  kwargs.setdefault('backup_store', backups.BackupStore(os.path.join(local, 'backups')))
+  return handler_class(**kwargs)
+
+
+class CardTest(unittest.TestCase):
+  """A test with an empty card in self._root and a dir for what is kept off
+  the card in self._local.  Both are removed afterwards.
+  """
+
+  def setUp(self):
+    self._root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._root)
+    self._local = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._local)
+
+  def make_handler(self, **kwargs):
+    return make_handler(self._local, **kwargs)
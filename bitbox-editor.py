@@ -1,10 +1,47 @@
 #!/usr/bin/python3
 
+import argparse
 import os.path
+import sys
 
-import bbeditor.prompt
+def run_batch(args):
+  import bbeditor.batch
+
+  batch = bbeditor.batch.Batch(args.dir, profile_dir=args.profile, durability=args.durability,
+                               compress_backups=args.compress_backups)
+  try:
+    if args.batch == '-':
+      batch.run(sys.stdin)
+    else:
+      with open(args.batch) as f:
+        batch.run(f)
+  except bbeditor.batch.BatchError as e:
+    print ('Error: %s' % e, file=sys.stderr)
+    return 1
+  finally:
+    if args.profile:
+      import bbeditor.stats
+      print ('\n'.join(bbeditor.stats.STATS.report()), file=sys.stderr)
+  return 0
 
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Edit presets and clips on a BitBox card.')
+  parser.add_argument('--batch', metavar='FILE',
+                      help='run commands from FILE (- for stdin) instead of prompting')
+  parser.add_argument('--dir', help='the bitbox directory, for --batch')
+  parser.add_argument('--profile', metavar='DIR',
+                      help='write a cProfile of each command to DIR, view them with pstats or snakeviz')
+  parser.add_argument('--durability', choices=('always', 'batch', 'none'), default='batch',
+                      help='how hard to sync preset writes to the card (default: batch)')
+  parser.add_argument('--compress-backups', action='store_true',
+                      help='compress the clip versions kept for undo, slower but smaller')
+  args = parser.parse_args()
+
+  if args.batch:
+    sys.exit(run_batch(args))
+
+  import bbeditor.prompt
+
   home = ""
   try:
     import pathlib
@@ -14,7 +51,9 @@ if __name__ == "__main__":
     home = expanduser("~")
   herstory_file = os.path.join(home, '.bitboxeditor-history-file')
 
-  prog = bbeditor.prompt.Prompt(herstory_file)
+  prog = bbeditor.prompt.Prompt(herstory_file, profile_dir=args.profile,
+                                durability=args.durability,
+                                compress_backups=args.compress_backups)
   running = True
   while running:
     running = prog.do_prompt()